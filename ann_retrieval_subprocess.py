@@ -0,0 +1,123 @@
+import datetime
+import sys
+from datetime import date
+from pathlib import Path
+import pandas as pd
+import multiprocessing
+import os
+from descriptor_storage import load_descriptors
+from descriptor_index import descriptor_index_dir, open_index, update_descriptor_index
+from comparison_engine import comparison_map
+from pipeline_options import split_arguments
+from pipeline_metrics import stage_clock, record_stage
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+BASE_DIR = Path(sys.argv[1])
+focal_file = sys.argv[2]
+# All remaining arguments are types of comparison to rank candidates with, plus optional --name=value settings
+comparison_types, options = split_arguments(sys.argv[3:])
+# how many candidate images to keep for each focal image and algorithm
+top_n = int(options.get("top_n", 50))
+# Define the target subdirectory (should only be fingerprints)
+directory = BASE_DIR / "fingerprints"
+index_dir = descriptor_index_dir(BASE_DIR)
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Project_name"
+#focal_file = "focal.csv"
+#comparison_types = ['orb_compare', 'sift_compare']
+#top_n = 50
+########################################################################################################################
+
+
+def extract_name(image_id):
+    # focal name is the "[date]_[name]" part of the image name
+    return "_".join(image_id.split("_")[:2])
+
+# per algorithm, the indexed images of every "[date]_[name]" individual, built once in each pool worker
+_individual_images = {}
+
+def individual_images(algorithm, index):
+    if algorithm not in _individual_images:
+        images = {}
+        for name in index.images:
+            images.setdefault(extract_name(name), []).append(name)
+        _individual_images[algorithm] = images
+    return _individual_images[algorithm]
+
+def rank_candidates(focal_image):
+    """Query every chosen algorithm's index with one focal image. Returns a list of output rows."""
+    rows = []
+    focal_name = extract_name(focal_image)
+    for comp_type in comparison_types:
+        algorithm = comparison_map[comp_type]['suffix']
+        index = open_index(index_dir, algorithm)
+        try:
+            descriptors = load_descriptors(directory, focal_image, algorithm)
+            # other photos of the same individual on the same date are not candidates
+            exclude = individual_images(algorithm, index).get(focal_name, [])
+            candidates = index.query(descriptors, top_n=top_n, exclude=exclude)
+        except Exception as e:
+            with open(log_file, 'a') as f:
+                f.write(f'\nAn error occurred while ranking candidates for {focal_image} with {algorithm}: {str(e)} \n')
+            continue
+        for rank, (test_image, votes) in enumerate(candidates, start=1):
+            rows.append([focal_image, test_image, algorithm, votes, rank])
+    return rows
+
+
+log_file = BASE_DIR / "logs" / "cross-matching_error_logs.txt"
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    clock = stage_clock()
+
+    with open(log_file, 'a') as f:
+        f.write(f'\n{datetime.datetime.now()} - Ranking candidates with the descriptor index for: {", ".join(comparison_types)} \n')
+
+    # bring the index up to date with the fingerprints folder. only new or re-extracted fingerprints are hashed
+    images_list = sorted(os.listdir(str(directory)))
+    algorithms = [comparison_map[comp_type]['suffix'] for comp_type in comparison_types]
+    print("Updating the descriptor index...")
+    added, unchanged, failed = update_descriptor_index(directory, index_dir, images_list, algorithms)
+    print(f"Descriptor index: {added} fingerprints added, {unchanged} already indexed")
+    with open(log_file, 'a') as f:
+        for name, algorithm, err in failed:
+            f.write(f'\nCould not add {name} to the {algorithm} descriptor index: {err} \n')
+
+    # every photo of every focal individual in the focal file, as in generating_pairwise_lists_subprocess.py
+    focal_df = pd.read_csv(str(BASE_DIR / "data" / focal_file))
+    focal_names = set(focal_df.iloc[:, 0].astype(str))
+    focal_images = [image for image in images_list if extract_name(image) in focal_names]
+    print(f"Ranking candidates for {len(focal_images)} focal images - this may take some time!")
+
+    n_workers = multiprocessing.cpu_count()
+    with multiprocessing.Pool(n_workers) as pool:
+        results = pool.map(rank_candidates, focal_images, chunksize=16)
+    pool.close()
+    pool.join()
+
+    candidates_df = pd.DataFrame([row for rows in results for row in rows],
+                                 columns=['focal_image', 'test_image', 'algorithm', 'votes', 'rank'])
+    candidates_df['focal_name'] = candidates_df['focal_image'].apply(extract_name)
+    candidates_df['test_name'] = candidates_df['test_image'].apply(extract_name)
+
+    output_file = BASE_DIR / 'data' / f'ann_candidates_{date.today()}.csv'
+    candidates_df.to_csv(output_file, index=False)
+
+    processing_time = datetime.datetime.now() - start_time
+    print("Time taken: ", processing_time)
+
+    timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
+    with open(timing_log_file, 'a') as f:
+        f.write(f'\n Candidate ranking - {len(focal_images)} focal images ranked for {", ".join(comparison_types)} '
+                f'in {processing_time} minutes. {added} fingerprints added to the index. {date.today()} \n')
+
+    record_stage(BASE_DIR, "ann_retrieval", clock, len(focal_images), n_workers, len(failed),
+                 {'focal_file': focal_file, 'comparison_types': comparison_types, 'top_n': top_n},
+                 candidates=len(candidates_df), indexed=added)
@@ -1,5 +1,6 @@
 # General core use and image processing.
 import os
+import shutil
 import datetime
 from datetime import date
 from pathlib import Path
@@ -8,12 +9,37 @@ import numpy as np
 import cv2 as cv
 import multiprocessing
 import sys
+from progress_status import ProgressReporter
+from pipeline_metrics import stage_clock, record_stage, parameters_hash
+from processing_manifest import manifest_path, load_manifest, file_signature, add_content_hash, is_unchanged, ManifestWriter
+from pipeline_options import split_arguments
+from thread_pipeline import run_thread_pipeline, DEFAULT_QUEUE_DEPTH
 
 
 ########################################################################################################################
 ########################################## GUI-DEFINED PATHS AND VALUES ################################################
 BASE_DIR = Path(sys.argv[1])
 directory = sys.argv[2]
+# number of worker processes, one per core unless --workers=n is given
+_, options = split_arguments(sys.argv[3:])
+n_workers = int(options.get("workers", multiprocessing.cpu_count()))
+# --segment-scale=n finds the patches on a copy decoded n times smaller (2, 4 or 8 are fastest for JPEGs), then crops
+# the full-resolution photo
+segment_scale = int(options.get("segment_scale", 1))
+# --fused-warp crops, straightens and orients each photo with a single warp (see fused_crop_rotate_flip)
+fused_warp = options.get("fused_warp", False)
+# photos already cropped with the same settings are skipped (see processing_manifest.py). --hash also stores a hash of
+# the contents of each photo it crops, so photos that were only touched or copied since are recognised too. --reprocess
+# crops everything
+hash_contents = options.get("hash", False)
+reprocess = options.get("reprocess", False)
+# --threads runs the photos through a pipeline of threads in this process instead of a pool of worker processes:
+# --readers=n threads decode photos ahead, n_workers threads crop them and --writers=n threads save the PNGs. At most
+# --queue-depth=n photos wait between each step, which bounds memory use
+use_threads = options.get("threads", False)
+n_readers = int(options.get("readers", 2))
+n_writers = int(options.get("writers", 2))
+queue_depth = int(options.get("queue_depth", DEFAULT_QUEUE_DEPTH))
 # Load user-set parameters for cropping and rotating
 df = pd.read_csv(BASE_DIR / "data/user_parameters.csv")
 # Convert to dictionary (keys = parameters, values = converted numbers)
@@ -74,6 +100,19 @@ def read_image(BASE_DIR, directory, image_file):
     name = image_file.split('.')[0] #drop file extension
     return img, name
 
+# decoding flags that let libjpeg decode JPEGs straight to a half, quarter or eighth of their size (DCT scaling)
+REDUCED_READ_FLAGS = {2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4, 8: cv.IMREAD_REDUCED_COLOR_8}
+
+def read_reduced_image(BASE_DIR, directory, image_file, scale):
+    """The photo decoded scale times smaller, cheaply for JPEGs at scales 2, 4 and 8, otherwise decoded and resized"""
+    image_path = BASE_DIR / directory / image_file
+    if scale in REDUCED_READ_FLAGS:
+        return cv.imread(str(image_path), REDUCED_READ_FLAGS[scale])
+    img = cv.imread(str(image_path))
+    if img is None:
+        return None
+    return cv.resize(img, None, fx=1 / scale, fy=1 / scale, interpolation=cv.INTER_AREA)
+
 def correct_image_rotation(img):
     if img.shape[1] > img.shape[0]:
         img = cv.rotate(img, cv.ROTATE_90_COUNTERCLOCKWISE)
@@ -116,6 +155,64 @@ def filter_contours(img, mask, contours, min_area, num_patches):
 
     return conts, filtered_mask
 
+def scaled_kernel_size(kernel_size, scale):
+    """The blurring kernel for an image downscaled scale times, still odd"""
+    k = max(1, round(kernel_size / scale))
+    return k if k % 2 == 1 else k + 1
+
+def find_scaled_patches(small, full_shape, lower, upper, kernel_size, threshold_value, min_area, num_patches, scale):
+    """
+    Contours of the largest patches found on a copy of the photo downscaled scale times (min_area and kernel_size scaled
+    to match), mapped back to the coordinates of the full-resolution photo of shape full_shape. The outlines land
+    within about scale pixels of a full-resolution pass, close enough to tell refine_patches where to look.
+    """
+    mask, blurred_regions = apply_thresholds(small, lower, upper, scaled_kernel_size(kernel_size, scale))
+    contours = find_contours(blurred_regions, threshold_value)
+    small_conts, _ = filter_contours(small, mask, contours, min_area / scale ** 2, num_patches)
+    # pixel centres of the small image back to full-resolution coordinates
+    ratio = (full_shape[1] / small.shape[1], full_shape[0] / small.shape[0])
+    return [np.int32(np.round((contour + 0.5) * ratio - 0.5)) for contour in small_conts]
+
+def refine_patches(img, conts, lower, upper, kernel_size, threshold_value, min_area, num_patches, scale):
+    """
+    Find the patches again at full resolution, but only in a window around the contours found by find_scaled_patches,
+    so the box around them is the one a full-resolution pass over the whole photo gives
+    """
+    x, y, w, h = cv.boundingRect(np.vstack(conts))
+    # room for the coarse outlines being off by up to scale pixels, and for the blurring at the window's edge
+    margin = kernel_size + 2 * scale
+    left, top = max(0, x - margin), max(0, y - margin)
+    window = img[top:min(img.shape[0], y + h + margin), left:min(img.shape[1], x + w + margin)]
+    mask, blurred_regions = apply_thresholds(window, lower, upper, kernel_size)
+    contours = find_contours(blurred_regions, threshold_value)
+    window_conts, _ = filter_contours(window, mask, contours, min_area, num_patches)
+    return [contour + np.int32([left, top]) for contour in window_conts]
+
+def crop_window(img, conts, box, mult):
+    """
+    The part of img that crop_and_rotate_image reads for this box, the patch mask drawn within it, and the window's
+    top-left corner in img (subtract it from box to crop from the window). Cropping from the window gives the same result as cropping from the whole image, while the
+    full-resolution masking only touches the pixels that end up in the crop.
+    """
+    Xs = [r[0] for r in box]
+    Ys = [s[1] for s in box]
+    x1, x2, y1, y2 = min(Xs), max(Xs), min(Ys), max(Ys)
+    center = (int((x1+x2)/2), int((y1+y2)/2))
+    # half the crop size, plus a margin for interpolation
+    half_width = mult * (x2 - x1) / 2 + 2
+    half_height = mult * (y2 - y1) / 2 + 2
+    left = max(0, int(center[0] - half_width))
+    top = max(0, int(center[1] - half_height))
+    right = min(img.shape[1], int(np.ceil(center[0] + half_width)) + 1)
+    bottom = min(img.shape[0], int(np.ceil(center[1] + half_height)) + 1)
+
+    window = img[top:bottom, left:right]
+    offset = np.array([left, top], np.int32)
+    filled_mask = np.zeros(window.shape[:2], np.uint8)
+    for contour in conts:
+        cv.drawContours(filled_mask, [contour - offset], -1, 255, thickness=-1)
+    filtered_mask = cv.bitwise_and(window, cv.cvtColor(filled_mask, cv.COLOR_GRAY2BGR))
+    return window, filtered_mask, offset
 
 def find_minimum_rotated_bounding_box(conts):
     length = len(conts)
@@ -125,7 +222,8 @@ def find_minimum_rotated_bounding_box(conts):
     box = np.int32(box)
     return rect, box
 
-def crop_and_rotate_image(filtered_mask, img, rect, box, mult):
+def crop_geometry(rect, box, mult):
+    """Centre and size of the upright crop around box, the rotation that straightens it, and the final crop size"""
     W = rect[1][0]
     H = rect[1][1]
     Xs = [r[0] for r in box]
@@ -147,33 +245,44 @@ def crop_and_rotate_image(filtered_mask, img, rect, box, mult):
     M = cv.getRotationMatrix2D((size[0]/2, size[1]/2), angle, 1.0)
     cropped_W = W if not rotated else H
     cropped_H = H if not rotated else W
+    return center, size, M, (int(cropped_W*mult), int(cropped_H*mult))
 
-    cropped_mask = cv.getRectSubPix(filtered_mask, size, center)
-    cropped_mask = cv.warpAffine(cropped_mask, M, size)
-    cropped_Rotated_mask = cv.getRectSubPix(cropped_mask, (int(cropped_W*mult), int(cropped_H*mult)), (size[0]/2, size[1]/2))
+def straightened_crop(src, center, size, M, cropped_size):
+    """Crop the box out upright, straighten it and crop it again to its own size"""
+    cropped = cv.getRectSubPix(src, size, center)
+    cropped = cv.warpAffine(cropped, M, size)
+    return cv.getRectSubPix(cropped, cropped_size, (size[0]/2, size[1]/2))
 
-    cropped_img = cv.getRectSubPix(img, size, center)
-    cropped_img = cv.warpAffine(cropped_img, M, size)
-    cropped_Rotated_img = cv.getRectSubPix(cropped_img, (int(cropped_W*mult), int(cropped_H*mult)), (size[0]/2, size[1]/2))
+def crop_and_rotate_image(filtered_mask, img, rect, box, mult):
+    center, size, M, cropped_size = crop_geometry(rect, box, mult)
+
+    cropped_Rotated_mask = straightened_crop(filtered_mask, center, size, M, cropped_size)
+    cropped_Rotated_img = straightened_crop(img, center, size, M, cropped_size)
 
     height = cropped_Rotated_mask.shape[0]
     width = cropped_Rotated_mask.shape[1]
     return cropped_Rotated_mask, cropped_Rotated_img, height, width
 
-def flip_image(cropped_Rotated_mask, cropped_Rotated_img, height, width):
-    hsv = cv.cvtColor(cropped_Rotated_mask, cv.COLOR_BGR2HSV)
+def patch_centre(cropped_mask):
+    """Centre (x, y) of the patch-coloured pixels of a cropped mask"""
+    hsv = cv.cvtColor(cropped_mask, cv.COLOR_BGR2HSV)
     mask = cv.inRange(hsv, lower, upper)
     M = cv.moments(mask)
-    cx = int(M['m10'] / M['m00'])
-    cy = int(M['m01'] / M['m00'])
+    return M['m10'] / M['m00'], M['m01'] / M['m00']
 
+def quarter_turn(cx, cy, width, height):
+    """The turn (a multiple of 90 degrees) that flip_image gives a crop of this size with its patch centre at cx, cy"""
     # Calculate the angle of rotation required
-    angle = np.arctan2(cy - mask.shape[0] / 2, cx - mask.shape[1] / 2) * 180 / np.pi
+    angle = np.arctan2(int(cy) - height / 2, int(cx) - width / 2) * 180 / np.pi
     # Calculate the closest 90-degree angle to the calculated angle
-    rounded_angle = 90 * round(angle / 90)
+    return 90 * round(angle / 90)
+
+def flip_image(cropped_Rotated_mask, cropped_Rotated_img, height, width):
+    rows, cols = cropped_Rotated_mask.shape[:2]
+    cx, cy = patch_centre(cropped_Rotated_mask)
+    rounded_angle = quarter_turn(cx, cy, cols, rows)
 
     # Rotate the image
-    rows, cols = mask.shape[:2]
     M = cv.getRotationMatrix2D((cols / 2, rows / 2), rounded_angle, 1)
     cropped_Rotated_mask = cv.warpAffine(cropped_Rotated_mask, M, (cols, rows))
     cropped_Rotated_img = cv.warpAffine(cropped_Rotated_img, M, (cols, rows))
@@ -186,13 +295,111 @@ def flip_image(cropped_Rotated_mask, cropped_Rotated_img, height, width):
         cropped_Rotated_mask = cv.rotate(cropped_Rotated_mask, cv.ROTATE_90_COUNTERCLOCKWISE)
     return cropped_Rotated_mask, cropped_Rotated_img, height, width
 
-def output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size, img1, cropped_Rotated_img, cropped_Rotated_mask):
+def shift(x, y):
+    return np.array([[1, 0, x], [0, 1, y], [0, 0, 1]], np.float64)
+
+def inverse_map(M):
+    """A 2x3 warpAffine matrix as the 3x3 map from output pixels back to input pixels"""
+    return np.linalg.inv(np.vstack([M, [0, 0, 1]]))
+
+# the quarter turn of the fused warp is first measured on every ORIENTATION_SCALE-th pixel of the straightened crop,
+# which puts the patch centre within ORIENTATION_SCALE pixels of where flip_image measures it
+ORIENTATION_SCALE = 2
+
+def clamped_maps(to_straightened, to_crop, to_source, size, output_size):
+    """
+    cv.remap maps from output pixels to the photo, through the straightened first crop of crop_and_rotate_image (size
+    wide and high). Points past the edge of that crop are clamped to it, as getRectSubPix repeats its edge pixels.
+    Also returns the mask of output pixels within the rotated first crop, which warpAffine leaves black elsewhere.
+    float32 keeps the maps small.
+    """
+    to_straightened, to_crop, to_source = (M.astype(np.float32) for M in (to_straightened, to_crop, to_source))
+    xs, ys = np.meshgrid(np.arange(output_size[0], dtype=np.float32), np.arange(output_size[1], dtype=np.float32))
+    straight_x = to_straightened[0, 0] * xs + to_straightened[0, 1] * ys + to_straightened[0, 2]
+    straight_y = to_straightened[1, 0] * xs + to_straightened[1, 1] * ys + to_straightened[1, 2]
+    straight_x = np.clip(straight_x, 0, size[0] - 1)
+    straight_y = np.clip(straight_y, 0, size[1] - 1)
+    first_x = to_crop[0, 0] * straight_x + to_crop[0, 1] * straight_y + to_crop[0, 2]
+    first_y = to_crop[1, 0] * straight_x + to_crop[1, 1] * straight_y + to_crop[1, 2]
+    inside = ((first_x >= -0.5) & (first_x < size[0] - 0.5) & (first_y >= -0.5) & (first_y < size[1] - 0.5))
+    return first_x + to_source[0, 2], first_y + to_source[1, 2], np.uint8(inside) * 255
+
+def fused_crop_rotate_flip(filtered_mask, img, rect, box, mult):
+    """
+    crop_and_rotate_image followed by flip_image, as one warp of the image and one of the mask. Each of their steps is
+    written as a map from its output pixels back to its input pixels and the maps are multiplied together, so every
+    output pixel is interpolated once instead of up to four times. The quarter turn is measured as flip_image measures
+    it, on the patch colours of the straightened crop, sampled through the same maps on a coarser grid. Where that
+    could tip the turn the other way, the mask is cropped step by step to measure it exactly as flip_image does. Areas
+    the separate steps leave black (beyond the rotated first crop, or turned out of the final crop) are blacked out
+    the same way. Returns the same values as flip_image; pixels agree up to the blur the repeated interpolation adds.
+    """
+    center, size, M, cropped_size = crop_geometry(rect, box, mult)
+    to_source = shift(center[0] - (size[0] - 1) / 2, center[1] - (size[1] - 1) / 2)  # getRectSubPix
+    to_crop = inverse_map(M)  # warpAffine
+    to_rotated = shift(size[0] / 2 - (cropped_size[0] - 1) / 2, size[1] / 2 - (cropped_size[1] - 1) / 2)  # getRectSubPix
+
+    # the quarter turn that brings the patch centre nearest the top, as flip_image rounds it
+    s = ORIENTATION_SCALE
+    to_coarse = np.array([[s, 0, (s - 1) / 2], [0, s, (s - 1) / 2], [0, 0, 1]], np.float64)
+    coarse_size = (max(1, cropped_size[0] // s), max(1, cropped_size[1] // s))
+    map_x, map_y, inside = clamped_maps(to_rotated @ to_coarse, to_crop, to_source, size, coarse_size)
+    coarse_mask = cv.remap(filtered_mask, map_x, map_y, cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+    coarse_mask = cv.inRange(cv.cvtColor(coarse_mask, cv.COLOR_BGR2HSV), lower, upper) & inside
+    moments = cv.moments(coarse_mask)
+    cx = moments['m10'] / moments['m00'] * s + (s - 1) / 2
+    cy = moments['m01'] / moments['m00'] * s + (s - 1) / 2
+    turns = {quarter_turn(cx + dx, cy + dy, *cropped_size) for dx in (-s, s) for dy in (-s, s)}
+    if len(turns) == 1:
+        rounded_angle = turns.pop()
+    else:
+        # the patch centre lies too close to a diagonal of the crop to be sure
+        cx, cy = patch_centre(straightened_crop(filtered_mask, center, size, M, cropped_size))
+        rounded_angle = quarter_turn(cx, cy, *cropped_size)
+    to_flipped = inverse_map(cv.getRotationMatrix2D((cropped_size[0] / 2, cropped_size[1] / 2), rounded_angle, 1))
+
+    # flip_image's turn to landscape
+    output_size = cropped_size
+    to_output = np.eye(3)
+    if cropped_size[1] > cropped_size[0]:
+        to_output = np.array([[0, -1, cropped_size[0] - 1], [1, 0, 0], [0, 0, 1]], np.float64)
+        output_size = (cropped_size[1], cropped_size[0])
+
+    to_turned = to_flipped @ to_output
+    to_straightened = to_rotated @ to_turned
+    # corners of the final crop in the straightened first crop
+    corner_x = to_rotated[0, 2] + np.array([0, cropped_size[0] - 1])
+    corner_y = to_rotated[1, 2] + np.array([0, cropped_size[1] - 1])
+    if corner_x.min() >= 0 and corner_y.min() >= 0 and corner_x.max() <= size[0] - 1 and corner_y.max() <= size[1] - 1:
+        # the final crop lies within the straightened first crop: one affine warp
+        to_first_crop = to_crop @ to_straightened
+        to_image = (to_source @ to_first_crop)[:2]
+        flags = cv.INTER_LINEAR | cv.WARP_INVERSE_MAP
+        cropped_Rotated_img = cv.warpAffine(img, to_image, output_size, flags=flags, borderMode=cv.BORDER_REPLICATE)
+        cropped_Rotated_mask = cv.warpAffine(filtered_mask, to_image, output_size, flags=flags,
+                                             borderMode=cv.BORDER_REPLICATE)
+        inside = cv.warpAffine(np.full((size[1], size[0]), 255, np.uint8), to_first_crop[:2], output_size,
+                               flags=cv.INTER_NEAREST | cv.WARP_INVERSE_MAP)
+    else:
+        # it reaches past the edge of the straightened first crop, which getRectSubPix fills by repeating the edge
+        # pixels: clamp to the edge, then map on to the photo, still interpolating once
+        map_x, map_y, inside = clamped_maps(to_straightened, to_crop, to_source, size, output_size)
+        cropped_Rotated_img = cv.remap(img, map_x, map_y, cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+        cropped_Rotated_mask = cv.remap(filtered_mask, map_x, map_y, cv.INTER_LINEAR, borderMode=cv.BORDER_REPLICATE)
+    inside &= cv.warpAffine(np.full((cropped_size[1], cropped_size[0]), 255, np.uint8), to_turned[:2], output_size,
+                            flags=cv.INTER_NEAREST | cv.WARP_INVERSE_MAP)
+    cropped_Rotated_img = cv.bitwise_and(cropped_Rotated_img, cropped_Rotated_img, mask=inside)
+    cropped_Rotated_mask = cv.bitwise_and(cropped_Rotated_mask, cropped_Rotated_mask, mask=inside)
+    return cropped_Rotated_mask, cropped_Rotated_img, cropped_size[1], cropped_size[0]
+
+def output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size, img1, cropped_Rotated_img, cropped_Rotated_mask, overwrite=False):
+    # overwrite replaces the output of an earlier run on the same photo (it changed since), rather than a duplicate
     if (height * width) > cutoff_size:
 
         try:
             # Create directory for this error case
             error_dir = BASE_DIR / "processing_errors" / "crop_rotate_size" / name
-            error_dir.mkdir()
+            error_dir.mkdir(exist_ok=overwrite)
 
             # Write files to error directory
             cv.imwrite(str(error_dir / f"{name}_mask.png"), cropped_Rotated_mask)
@@ -214,7 +421,7 @@ def output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size,
         try:
             # Create directory for this specific fingerprint
             fingerprint_dir = BASE_DIR / "fingerprints" / name
-            fingerprint_dir.mkdir()
+            fingerprint_dir.mkdir(exist_ok=overwrite)
 
             # Write files with naming convention to new folder
             cv.imwrite(str(fingerprint_dir / f"{name}_mask.png"), cropped_Rotated_mask)
@@ -231,40 +438,108 @@ def output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size,
 
 
 ########################################################################################################################
-# the main workhorse of this script, combines the processes above and handles generic errors that crop up.
-def process_image(image_info):
-    i, BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size = image_info
+# the main workhorse of this script, combines the processes above and handles generic errors that crop up. It runs in
+# three parts, reading, cropping and saving, which the thread pipeline (--threads) runs in separate threads.
+def read_photo(image_info):
+    """Decode a photo, and its reduced copy with --segment-scale. Returns them, or the error that stopped them"""
+    i, n_images, BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size, segment_scale, fused_warp, overwrite = image_info
     # progress info
-    print("Progress: {0}/{1}".format(i + 1, len(images_list)))
+    print("Progress: {0}/{1}".format(i + 1, n_images))
 
-    img, name = read_image(BASE_DIR, directory, image_name)
-    img = correct_image_rotation(img)
-    mask, blurred_regions = apply_thresholds(img, lower, upper, kernel_size)
-    contours = find_contours(blurred_regions, threshold_value)
     try:
-        conts, filtered_mask = filter_contours(img, mask, contours, min_area, num_patches)
-        rect, box = find_minimum_rotated_bounding_box(conts)
-        cropped_Rotated_mask, cropped_Rotated_img, height, width = crop_and_rotate_image(filtered_mask, img, rect, box, mult)
-        cropped_Rotated_mask, cropped_Rotated_img, height, width = flip_image(cropped_Rotated_mask, cropped_Rotated_img, height, width)
-        output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size, img, cropped_Rotated_img, cropped_Rotated_mask)
+        img, name = read_image(BASE_DIR, directory, image_name)
+        if img is None:
+            # not an image, or a damaged one: reported as a cropping error instead of stopping the run
+            raise ValueError(f"{image_name} could not be read as an image")
+        img = correct_image_rotation(img)
+        small = None
+        if segment_scale != 1:
+            small = read_reduced_image(BASE_DIR, directory, image_name, segment_scale)
+            # a photo that cannot be decoded small is reported as a cropping error
+            small = correct_image_rotation(small) if small is not None else None
     except Exception as e:
-        error_dir = BASE_DIR / "processing_errors" / "crop_rotate_generic" / name
-        error_dir.mkdir()
-
-        cv.imwrite(str(error_dir / f"{name}.png"), img)
+        return image_info, None, None, e
+    return image_info, img, small, None
+
+def crop_photo(loaded):
+    """Find the patches and crop the photo. Returns the crops for save_photo, or the error that stopped them"""
+    image_info, img, small, error = loaded
+    i, n_images, BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size, segment_scale, fused_warp, overwrite = image_info
+    if error is not None:
+        return image_info, img, None, error
+    try:
+        if segment_scale == 1:
+            mask, blurred_regions = apply_thresholds(img, lower, upper, kernel_size)
+            contours = find_contours(blurred_regions, threshold_value)
+            conts, filtered_mask = filter_contours(img, mask, contours, min_area, num_patches)
+            rect, box = find_minimum_rotated_bounding_box(conts)
+            crop_source = img
+        else:
+            # find the patches on a reduced decode, then mask and crop only the window around them at full resolution
+            conts = find_scaled_patches(small, img.shape, lower, upper, kernel_size, threshold_value, min_area,
+                                        num_patches, segment_scale)
+            conts = refine_patches(img, conts, lower, upper, kernel_size, threshold_value, min_area, num_patches,
+                                   segment_scale)
+            rect, box = find_minimum_rotated_bounding_box(conts)
+            crop_source, filtered_mask, offset = crop_window(img, conts, box, mult)
+            box = box - offset
+        if fused_warp:
+            cropped_Rotated_mask, cropped_Rotated_img, height, width = fused_crop_rotate_flip(filtered_mask, crop_source, rect, box, mult)
+        else:
+            cropped_Rotated_mask, cropped_Rotated_img, height, width = crop_and_rotate_image(filtered_mask, crop_source, rect, box, mult)
+            cropped_Rotated_mask, cropped_Rotated_img, height, width = flip_image(cropped_Rotated_mask, cropped_Rotated_img, height, width)
+    except Exception as e:
+        return image_info, img, None, e
+    return image_info, img, (cropped_Rotated_mask, cropped_Rotated_img, height, width), None
+
+def save_photo(cropped):
+    """Write the crops, or the photo to the error folder. Returns the image's file name and False if it failed"""
+    image_info, img, crops, error = cropped
+    i, n_images, BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size, segment_scale, fused_warp, overwrite = image_info
+    name = image_name.split('.')[0]
+    if error is None:
+        try:
+            cropped_Rotated_mask, cropped_Rotated_img, height, width = crops
+            output_and_log_processing_errors(BASE_DIR, name, height, width, cutoff_size, img, cropped_Rotated_img, cropped_Rotated_mask, overwrite)
+            return image_name, True
+        except Exception as e:
+            error = e
+
+    print(f"An unknown error occurred while cropping/rotating {name}")
+    log_file = BASE_DIR / "logs" / "processing_error_logs.txt"
+    with open(log_file, 'a') as f:
+        f.write(
+            '\n{0}. An unknown error occurred while cropping/rotating. Error message: {1} \n'.format(name, str(error)))
 
-        print(f"An unknown error occurred while cropping/rotating {name}")
-        log_file = BASE_DIR / "logs" / "processing_error_logs.txt"
+    # never raises, so the thread pipeline still returns this photo's result to be counted and recorded
+    try:
+        error_dir = BASE_DIR / "processing_errors" / "crop_rotate_generic" / name
+        error_dir.mkdir(exist_ok=overwrite)
+        if img is None:
+            # nothing was decoded, keep a copy of the file as it is
+            shutil.copy2(BASE_DIR / directory / image_name, error_dir / image_name)
+        else:
+            cv.imwrite(str(error_dir / f"{name}.png"), img)
+    except FileExistsError:
+        print(f"Error folder for {name} already exists")
         with open(log_file, 'a') as f:
-            f.write(
-                '\n{0}. An unknown error occurred while cropping/rotating. Error message: {1} \n'.format(name, str(e)))
-    return
+            f.write(f'\n{name} was processed as an error previously. Please check file.\n')
+    except Exception as e:
+        print(f"Could not write {name} to the error folder: {e}")
+        with open(log_file, 'a') as f:
+            f.write(f'\n{name} could not be written to the error folder. Error message: {e} \n')
+    return image_name, False
+
+# returns the image's file name and False if it could not be processed, for progress reporting and the manifest
+def process_image(image_info):
+    return save_photo(crop_photo(read_photo(image_info)))
 ########################################################################################################################
 
 
 if __name__ == '__main__':
     # a clunky way to record processing times
     start_time = datetime.datetime.now()
+    clock = stage_clock()
 
     #pre-empt error logging
     error_log_file = BASE_DIR / "logs" / "processing_error_logs.txt"
@@ -274,18 +549,77 @@ if __name__ == '__main__':
 
 
 ########################################################################################################################
+    # the settings that change the crops, so changing any of them crops every photo again
+    crop_parameters = {'lower': lower, 'upper': upper, 'kernel_size': kernel_size, 'threshold_value': threshold_value,
+                       'num_patches': num_patches, 'min_area': min_area, 'mult': mult, 'cutoff_size': cutoff_size,
+                       'segment_scale': segment_scale, 'fused_warp': fused_warp}
+    settings_hash = parameters_hash(crop_parameters)
+    # where a cropped photo's output goes, depending on how its cropping went
+    output_folders = ["fingerprints", "processing_errors/crop_rotate_size", "processing_errors/crop_rotate_generic"]
+
+    # skip photos the manifest says are unchanged since they were cropped, before decoding anything. Photos whose
+    # output folder has been deleted or moved (e.g. by fingerprint extraction) are cropped again
+    manifest = {} if reprocess else load_manifest(BASE_DIR)
+    # existing output is only adopted for projects cropped before there was a manifest
+    adopt_output = not reprocess and not manifest_path(BASE_DIR).exists()
+    manifest_writer = ManifestWriter(BASE_DIR)
+    signatures = {}
+    to_process = []
+    # new photos named like existing output. they are logged as duplicates when saved, and left out of the manifest so
+    # every run warns about them again
+    duplicates = set()
+    for image_name in images_list:
+        source = f"{Path(directory).as_posix()}/{image_name}"
+        signature = file_signature(BASE_DIR, source)
+        entry = manifest.get(source)
+        name = image_name.split('.')[0]
+        has_output = any((BASE_DIR / folder / name).exists() for folder in output_folders)
+        if entry is None and has_output and adopt_output:
+            # cropped before the project had a manifest: adopt the existing output as it is
+            manifest_writer.record(signature, '', name, True)
+        elif entry is not None and has_output and is_unchanged(BASE_DIR, entry, signature, settings_hash):
+            if signature['mtime_ns'] != entry['mtime_ns']:
+                # same contents (is_unchanged hashed them), but a new modification time to remember
+                manifest_writer.record(signature, entry['parameters_hash'], name, entry['processed'])
+        else:
+            if entry is None and has_output and not reprocess:
+                duplicates.add(image_name)
+            signatures[image_name] = signature
+            to_process.append(image_name)
+    n_skipped = len(images_list) - len(to_process)
+    print(f"{len(to_process)} new or changed photos to crop, {n_skipped} unchanged photos skipped")
+
     # parallel processing the above function to speed things along. i should probably wrap this in a function
-    # create a list of tuples with the image information
+    # create a list of tuples with the image information. photos cropped before are overwritten, not duplicates
     image_info_list = [
-        (i, BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size)
-        for i, image_name in enumerate(images_list)]
-    # create a multiprocessing pool with the number of available CPU cores
-    pool = multiprocessing.Pool()
-    # map the list of image information tuples to the process_image function
-    pool.map(process_image, image_info_list)
+        (i, len(to_process), BASE_DIR, directory, image_name, lower, upper, kernel_size, threshold_value, min_area, num_patches, mult, cutoff_size, segment_scale, fused_warp,
+         reprocess or f"{Path(directory).as_posix()}/{image_name}" in manifest)
+        for i, image_name in enumerate(to_process)]
+    # live progress for the Batch Processing page
+    progress = ProgressReporter(BASE_DIR, "crop_rotate", "Crop and rotate")
+    progress.start_stage("Cropping and rotating images", len(image_info_list))
+    if use_threads:
+        pool = None
+        results = run_thread_pipeline(image_info_list, [(read_photo, n_readers), (crop_photo, n_workers),
+                                                        (save_photo, n_writers)], queue_depth)
+    else:
+        # create a multiprocessing pool with n_workers processes
+        pool = multiprocessing.Pool(n_workers)
+        # map the list of image information tuples to the process_image function
+        results = pool.imap_unordered(process_image, image_info_list)
+    # count images as they finish
+    for image_name, processed in results:
+        progress.advance(errors=not processed)
+        if image_name in duplicates:
+            continue
+        signature = add_content_hash(BASE_DIR, signatures[image_name]) if hash_contents else signatures[image_name]
+        manifest_writer.record(signature, settings_hash, image_name.split('.')[0], processed)
     # close the pool and wait for the work to finish
-    pool.close()
-    pool.join()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    manifest_writer.close()
+    progress.finish()
 ########################################################################################################################
 
     # still a clunky way to record processing times, but effective
@@ -295,5 +629,10 @@ if __name__ == '__main__':
 
     timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
     with open(timing_log_file, 'a') as f:
-        f.write('\n Crop and rotate - {0} files processed in {1} minutes. {2} \n'.format(
-            str(len(images_list) + 1), str(processing_time), date.today()))
+        f.write('\n Crop and rotate - {0} files processed ({1} unchanged skipped) in {2} minutes. {3} \n'.format(
+            str(len(to_process)), str(n_skipped), str(processing_time), date.today()))
+
+    record_stage(BASE_DIR, "crop_rotate", clock, len(to_process), n_workers, progress.status['errors'],
+                 {'directory': directory, **crop_parameters}, skipped=n_skipped,
+                 executor="threads" if use_threads else "processes", readers=n_readers if use_threads else None,
+                 writers=n_writers if use_threads else None, queue_depth=queue_depth if use_threads else None)
@@ -2,20 +2,35 @@ import os
 import datetime
 from datetime import date
 import cv2 as cv
-import numpy as np
 import pandas as pd
 from pathlib import Path
 import multiprocessing
 import shutil
 import sys
 import psutil # number of logical cores
+from pipeline_options import split_arguments
+from thread_pipeline import run_thread_pipeline, per_thread, DEFAULT_QUEUE_DEPTH
+from descriptor_storage import save_descriptors, strongest_descriptors, pack_fingerprints
+from descriptor_index import descriptor_index_dir, update_descriptor_index
+from progress_status import ProgressReporter
+from pipeline_metrics import stage_clock, record_stage
 
 
 ########################################################################################################################
 ########################################## GUI-DEFINED PATHS AND VALUES ################################################
 BASE_DIR = Path(sys.argv[1])
 directory = sys.argv[2]
-detectors = sys.argv[3:]  # All remaining arguments are detectors
+detectors = [arg for arg in sys.argv[3:] if not arg.startswith("--")]  # All remaining arguments are detectors
+_, options = split_arguments(sys.argv[3:])
+# --threads extracts in a pipeline of threads in this process instead of a pool of worker processes: --readers=n
+# threads decode masks ahead of the extracting threads, with at most --queue-depth=n masks waiting between them
+use_threads = options.get("threads", False)
+n_readers = int(options.get("readers", 2))
+queue_depth = int(options.get("queue_depth", DEFAULT_QUEUE_DEPTH))
+# pass --pack to also append new fingerprints to the per-algorithm descriptor packs (see descriptor_storage.py)
+use_pack = options.get("pack", False)
+# pass --index to also add new fingerprints to the nearest-neighbour descriptor index (see descriptor_index.py)
+use_index = options.get("index", False)
 # Load user-set parameters for fingerprint extraction
 df = pd.read_csv(os.path.join(BASE_DIR, "data/user_parameters.csv"))
 # Convert to dictionary (keys = parameters, values = converted numbers)
@@ -49,15 +64,20 @@ images_list = os.listdir(BASE_DIR / directory)
 
 
 ########################################################################################################################
-# initialise only the chosen detectors - SURF may not be available on all devices
-if 'surf_fingerprint' in detectors:
-    surf = cv.xfeatures2d.SURF_create(hessian_threshold)
-if 'sift_fingerprint' in detectors:
-    sift = cv.SIFT_create(nfeatures=n_features)
-if 'orb_fingerprint' in detectors:
-    orb = cv.ORB_create(nfeatures=n_features)
-if 'akaze_fingerprint' in detectors:
-    akaze = cv.AKAZE_create(threshold = akaze_threshold)
+# initialise only the chosen detectors - SURF may not be available on all devices. threads do not share detectors,
+# each extracting thread creates its own
+def create_detectors():
+    created = {}
+    if 'surf_fingerprint' in detectors:
+        created['surf'] = cv.xfeatures2d.SURF_create(hessian_threshold)
+    if 'sift_fingerprint' in detectors:
+        created['sift'] = cv.SIFT_create(nfeatures=n_features)
+    if 'orb_fingerprint' in detectors:
+        created['orb'] = cv.ORB_create(nfeatures=n_features)
+    if 'akaze_fingerprint' in detectors:
+        created['akaze'] = cv.AKAZE_create(threshold = akaze_threshold)
+    return created
+process_detectors = create_detectors()
 ########################################################################################################################
 
 
@@ -65,23 +85,23 @@ if 'akaze_fingerprint' in detectors:
 # Define fingerprint-extraction and saving functions
 def gen_surf_features(img, name, type, surf):
     surf_kp, surf_desc = surf.detectAndCompute(img, None)
-    destination = BASE_DIR / directory / name
-    np.savetxt(destination / f"{name}_surf_{type}.txt", surf_desc)
+    save_descriptors(BASE_DIR / directory, name, "surf", surf_desc, type)
+    save_descriptors(BASE_DIR / directory, name, "surf", strongest_descriptors(surf_kp, surf_desc), f"{type}_top")
     return
 def gen_sift_features(img, name, type, sift):
     sift_kp, sift_desc = sift.detectAndCompute(img, None)
-    destination = BASE_DIR / directory / name
-    np.savetxt(destination / f"{name}_sift_{type}.txt", sift_desc)
+    save_descriptors(BASE_DIR / directory, name, "sift", sift_desc, type)
+    save_descriptors(BASE_DIR / directory, name, "sift", strongest_descriptors(sift_kp, sift_desc), f"{type}_top")
     return
 def gen_orb_features(img, name, type, orb):
     orb_kp, orb_desc = orb.detectAndCompute(img, None) # ADD ERROR EXCEPTION HERE
-    destination = BASE_DIR / directory / name
-    np.savetxt(destination / f"{name}_orb_{type}.txt", orb_desc)
+    save_descriptors(BASE_DIR / directory, name, "orb", orb_desc, type)
+    save_descriptors(BASE_DIR / directory, name, "orb", strongest_descriptors(orb_kp, orb_desc), f"{type}_top")
     return
 def gen_akaze_features(img, name, type, akaze):
     akaze_kp, akaze_desc = akaze.detectAndCompute(img, None) # ADD ERROR EXCEPTION HERE
-    destination = BASE_DIR / directory / name
-    np.savetxt(destination / f"{name}_akaze_{type}.txt", akaze_desc)
+    save_descriptors(BASE_DIR / directory, name, "akaze", akaze_desc, type)
+    save_descriptors(BASE_DIR / directory, name, "akaze", strongest_descriptors(akaze_kp, akaze_desc), f"{type}_top")
     return
 ########################################################################################################################
 
@@ -105,7 +125,9 @@ def relocate(image_name):
 
 ########################################################################################################################
 # the main workhorse of this script, generates and then saves the chosen fingerprint types, with informative error logging
-def process_image(image_name):
+# returns the number of errors, for progress reporting. Reading and extracting are separate steps for the thread pipeline
+def read_mask(image_name):
+    """The image's mask, or None if it could not be read (the image is then moved to the error folder)"""
     try:
         # define path to image
         image_path = BASE_DIR / directory / image_name / f"{image_name}_mask.png"
@@ -123,17 +145,25 @@ def process_image(image_name):
         error_log_file = BASE_DIR / "logs" / "fingerprinting_error_logs.txt"
         with open(error_log_file, 'a') as f:
             f.write(f'\n{err_message} \n')
-        return
+        return image_name, None
+    return image_name, mask1
+
+def extract_fingerprints(loaded, detector_objects):
+    """Extract and save the chosen fingerprints from a mask read by read_mask. Returns the number of errors"""
+    image_name, mask1 = loaded
+    if mask1 is None:
+        return 1
 
     # Dictionary mapping detector names to their corresponding functions
     detector_functions = {
-        'surf_fingerprint': lambda: gen_surf_features(mask1, image_name, "mask", surf),
-        'sift_fingerprint': lambda: gen_sift_features(mask1, image_name, "mask", sift),
-        'orb_fingerprint': lambda: gen_orb_features(mask1, image_name, "mask", orb),
-        'akaze_fingerprint': lambda: gen_akaze_features(mask1, image_name, "mask", akaze)
+        'surf_fingerprint': lambda: gen_surf_features(mask1, image_name, "mask", detector_objects['surf']),
+        'sift_fingerprint': lambda: gen_sift_features(mask1, image_name, "mask", detector_objects['sift']),
+        'orb_fingerprint': lambda: gen_orb_features(mask1, image_name, "mask", detector_objects['orb']),
+        'akaze_fingerprint': lambda: gen_akaze_features(mask1, image_name, "mask", detector_objects['akaze'])
     }
 
     # Process only the selected detectors
+    errors = 0
     for detector in detectors:
         try:
             print(f"Applying {detector} to {image_name} at {datetime.datetime.now()}")
@@ -147,14 +177,30 @@ def process_image(image_name):
             error_log_file = BASE_DIR / "logs" / "fingerprinting_error_logs.txt"
             with open(error_log_file, 'a') as f:
                 f.write(f'\n{err_message}. Please check file.\n')
+            errors += 1
+    return errors
+
+def process_image(image_name):
+    return extract_fingerprints(read_mask(image_name), process_detectors)
 ########################################################################################################################
 
 
 ########################################################################################################################
-# parallel processing the above function to speed things along.
-def gen_fingerprints(images_list):
-    pool = multiprocessing.Pool(psutil.cpu_count(logical=False)) # using logical cores can lead to hanging errors on Windows
-    pool.map(process_image, images_list)
+# parallel processing the above function to speed things along, counting images for the progress report as they finish
+# one per physical core unless --workers=n is given. using logical cores can lead to hanging errors on Windows
+n_workers = int(options.get("workers", psutil.cpu_count(logical=False)))
+def gen_fingerprints(images_list, progress):
+    progress.start_stage("Extracting fingerprints", len(images_list))
+    if use_threads:
+        thread_detectors = per_thread(create_detectors)
+        for errors in run_thread_pipeline(images_list, [
+                (read_mask, n_readers),
+                (lambda loaded: extract_fingerprints(loaded, thread_detectors()), n_workers)], queue_depth):
+            progress.advance(errors=errors)
+        return
+    pool = multiprocessing.Pool(n_workers)
+    for errors in pool.imap_unordered(process_image, images_list):
+        progress.advance(errors=errors)
     pool.close()
     pool.join()
 ########################################################################################################################
@@ -170,9 +216,50 @@ if __name__ == '__main__':
         f.write(
             f'\n{datetime.datetime.now()} - Extracting fingerprints from images \n')
 
+    # live progress for the Batch Processing page
+    progress = ProgressReporter(BASE_DIR, "fingerprinting", "Fingerprint extraction")
+
+    # settings that affect the fingerprints, for the metrics history
+    parameters = {'directory': directory, 'detectors': detectors, 'hessian_threshold': hessian_threshold,
+                  'akaze_threshold': akaze_threshold, 'n_features': n_features}
+
     # run the functions, do the things
-    gen_fingerprints(images_list)
+    clock = stage_clock()
+    gen_fingerprints(images_list, progress)
+    record_stage(BASE_DIR, "fingerprint_extraction", clock, len(images_list), n_workers, progress.status['errors'],
+                 parameters, executor="threads" if use_threads else "processes",
+                 readers=n_readers if use_threads else None, queue_depth=queue_depth if use_threads else None)
+
+    # append new or re-extracted fingerprints to the descriptor packs, if this project uses them. packs are only kept
+    # for the fingerprints folder, never for temp
+    pack_dir = BASE_DIR / "descriptor_packs"
+    if directory == "fingerprints" and (use_pack or pack_dir.exists()):
+        algorithms = [detector.split("_")[0] for detector in detectors]
+        progress.start_stage("Updating descriptor packs")
+        clock = stage_clock()
+        appended, unchanged, failed = pack_fingerprints(BASE_DIR / directory, pack_dir, images_list, algorithms)
+        record_stage(BASE_DIR, "descriptor_packs", clock, appended, errors=len(failed), parameters=parameters,
+                     unchanged=unchanged)
+        print(f"Descriptor packs: {appended} fingerprints appended, {unchanged} already packed")
+        with open(error_log_file, 'a') as f:
+            for name, algorithm, err in failed:
+                f.write(f'\nCould not add {name} to the {algorithm} descriptor pack: {err} \n')
+
+    # likewise keep the descriptor index up to date, if this project uses one
+    index_dir = descriptor_index_dir(BASE_DIR)
+    if directory == "fingerprints" and (use_index or index_dir.exists()):
+        algorithms = [detector.split("_")[0] for detector in detectors]
+        progress.start_stage("Updating the descriptor index")
+        clock = stage_clock()
+        added, unchanged, failed = update_descriptor_index(BASE_DIR / directory, index_dir, images_list, algorithms)
+        record_stage(BASE_DIR, "descriptor_index", clock, added, errors=len(failed), parameters=parameters,
+                     unchanged=unchanged)
+        print(f"Descriptor index: {added} fingerprints added, {unchanged} already indexed")
+        with open(error_log_file, 'a') as f:
+            for name, algorithm, err in failed:
+                f.write(f'\nCould not add {name} to the {algorithm} descriptor index: {err} \n')
 
+    progress.finish()
     # still a clunky way to record processing times, but effective
     processing_time = datetime.datetime.now() - start_time
     print("Time taken: ", processing_time)
@@ -0,0 +1,92 @@
+import sys
+import time
+from datetime import date
+from pathlib import Path
+import numpy as np
+import os
+from descriptor_storage import load_descriptors
+from comparison_engine import comparison_map
+from pipeline_options import split_arguments
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+BASE_DIR = Path(sys.argv[1])
+# All remaining arguments are types of comparison to benchmark, plus optional --name=value settings
+comparison_types, options = split_arguments(sys.argv[2:])
+# how many focal images to sample, and how many test images each is compared against
+n_focal = int(options.get("focal", 10))
+n_test = int(options.get("test", 100))
+# Define the target subdirectory (should only be fingerprints)
+directory = BASE_DIR / "fingerprints"
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Project_name"
+#comparison_types = ['orb_compare', 'sift_compare']
+#n_focal = 10
+#n_test = 100
+########################################################################################################################
+
+
+def sample_descriptors(algorithm, names, n):
+    """Descriptors of up to n randomly chosen images that have them for this algorithm"""
+    rng = np.random.default_rng(0)
+    sampled = []
+    for name in rng.permutation(names):
+        try:
+            sampled.append(np.array(load_descriptors(directory, name, algorithm)))
+        except Exception:
+            continue
+        if len(sampled) == n:
+            break
+    return sampled
+
+def benchmark(comp_type, names):
+    """Time the BFMatcher and vectorised matchers on the same pairs. Returns a dictionary of results"""
+    comp_info = comparison_map[comp_type]
+    focal_images = sample_descriptors(comp_info['suffix'], names, n_focal)
+    test_images = sample_descriptors(comp_info['suffix'], names, n_test)
+
+    start = time.perf_counter()
+    expected = np.full((len(focal_images), len(test_images)), np.nan)
+    for i, des1 in enumerate(focal_images):
+        for j, des2 in enumerate(test_images):
+            try:
+                expected[i, j] = comp_info['func'](des1, des2)
+            except ZeroDivisionError:
+                pass  # no cross-checked matches, NaN in both matchers
+    bfmatcher_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    vectorised = np.array([comp_info['kernel'](des1, test_images) for des1 in focal_images])
+    vectorised_time = time.perf_counter() - start
+
+    n_pairs = expected.size
+    difference = np.abs(expected - vectorised)
+    mismatches = (difference > 1e-4 * np.abs(expected)) | (np.isnan(expected) != np.isnan(vectorised))
+    return {
+        'pairs': n_pairs,
+        'bfmatcher_rate': n_pairs / bfmatcher_time,
+        'vectorised_rate': n_pairs / vectorised_time,
+        'speedup': bfmatcher_time / vectorised_time,
+        'max_difference': np.nanmax(difference) if n_pairs else 0.0,
+        'mismatches': int(mismatches.sum())
+    }
+
+
+if __name__ == '__main__':
+    images_list = sorted(os.listdir(str(directory)))
+    print(f"Benchmarking matchers on {n_focal} focal x {n_test} test images from {directory}")
+
+    timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
+    for comp_type in comparison_types:
+        results = benchmark(comp_type, images_list)
+        summary = (f"{comp_type}: {results['pairs']} pairs, BFMatcher {results['bfmatcher_rate']:.1f} pairs/s, "
+                   f"vectorised {results['vectorised_rate']:.1f} pairs/s ({results['speedup']:.1f}x), "
+                   f"max difference {results['max_difference']:.3g}, {results['mismatches']} mismatched pairs")
+        print(summary)
+        with open(timing_log_file, 'a') as f:
+            f.write(f'\n Matcher benchmark - {summary}. {date.today()} \n')
@@ -0,0 +1,181 @@
+import datetime
+import shutil
+import subprocess
+import sys
+import time
+from datetime import date
+from pathlib import Path
+import pandas as pd
+from synthetic_beetles import generate_dataset, true_match_recall
+from comparison_engine import comparison_map
+from pipeline_metrics import load_metrics
+from pipeline_options import split_arguments
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+# a scratch folder for the synthetic projects and the benchmark results
+BASE_DIR = Path(sys.argv[1])
+# All remaining arguments are types of comparison to run, plus optional --name=value settings, e.g.
+# --individuals=50,100,200 --workers=1,2,4 to benchmark three dataset sizes with each of three worker counts
+comparison_types, options = split_arguments(sys.argv[2:])
+comparison_types = comparison_types or ['orb_compare']
+sizes = [int(n) for n in str(options.get("individuals", "20,40")).split(",")]
+worker_counts = [int(n) for n in str(options.get("workers", "1,2")).split(",")]
+# how the crop and fingerprint stages run their workers: a pool of processes, a pipeline of threads (--threads), or both
+# to compare them, e.g. --executors=processes,threads
+executors = str(options.get("executors", "processes")).split(",")
+# synthetic dataset settings, as in generate_synthetic_dataset.py
+recaptures = int(options.get("recaptures", 1))
+photos_per_encounter = int(options.get("photos", 2))
+width = int(options.get("width", 1000))
+height = int(options.get("height", 1500))
+seed = int(options.get("seed", 0))
+# --keep keeps each run's project folder for inspection
+keep_runs = options.get("keep", False)
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Benchmarks"
+#comparison_types = ['orb_compare', 'sift_compare']
+#sizes = [50, 100]
+#worker_counts = [1, 2, 4]
+########################################################################################################################
+
+
+########################################################################################################################
+# End-to-end benchmark of the batch scripts on synthetic photos (see synthetic_beetles.py). For each dataset size a
+# synthetic project is generated once, then copied to a fresh folder for each worker count and run through all five
+# stages, as the Batch Processing page runs them. Each stage's throughput comes from the metrics it records itself
+# (pipeline_metrics.py), its process time (including start-up) is measured here. Comparisons skip the score store, so
+# every score is computed. The share of recaptured encounters with a true match in the filtered results is reported
+# alongside, so speed-ups can be checked against accuracy.
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+def pipeline_stages(run_dir, workers, executor="processes"):
+    """(metrics stage name, script, arguments) of each stage, in the order they run"""
+    detectors = [f"{comparison_map[comp_type]['suffix']}_fingerprint" for comp_type in comparison_types]
+    engine_options = [f"--workers={workers}", "--no-score-store"]
+    image_options = [f"--workers={workers}"] + (["--threads"] if executor == "threads" else [])
+    return [
+        ("crop_rotate", "batch_segment_crop_rotate_subprocess.py",
+         [run_dir, "unprocessed_photos", *image_options]),
+        ("fingerprint_extraction", "batch_store_values_subprocess.py",
+         [run_dir, "fingerprints", *detectors, *image_options]),
+        ("pairwise_list", "generating_pairwise_lists_subprocess.py",
+         [run_dir, "focal.csv", "test.csv", "False", "False", "before"]),
+        ("crossmatching", "parallel_crossmatching_subprocess.py",
+         [run_dir, f"pairwise_comparison_list_{date.today()}.csv", *comparison_types, *engine_options]),
+        ("self_comparisons", "within_individual_assessment_subprocess.py",
+         [run_dir, *comparison_types, *engine_options]),
+    ]
+
+def run_stage(script, arguments):
+    """Run one batch script to completion. Returns its process time in seconds"""
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, str(SCRIPT_DIR / script), *map(str, arguments)],
+                               cwd=SCRIPT_DIR, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:], completed.stderr[-2000:])
+        raise RuntimeError(f"{script} failed with exit code {completed.returncode}")
+    return time.perf_counter() - start
+
+def run_pipeline(dataset_dir, run_dir, workers, executor, n_individuals, n_images):
+    """All stages on a fresh copy of a synthetic project. Returns one row per stage"""
+    if run_dir.exists():
+        shutil.rmtree(run_dir)
+    shutil.copytree(dataset_dir, run_dir)
+
+    rows = []
+    for stage, script, arguments in pipeline_stages(run_dir, workers, executor):
+        process_seconds = run_stage(script, arguments)
+        record = load_metrics(run_dir).query("stage == @stage").iloc[-1]
+        # peak memory of the main process plus, at most, that of the largest worker process for each worker
+        peak_memory_mb = record['peak_rss_mb'] + workers * (record['peak_worker_rss_mb'] or 0)
+        rows.append({'individuals': n_individuals, 'images': n_images, 'executor': executor, 'workers': workers,
+                     'stage': stage, 'items': record['items'], 'wall_seconds': record['wall_seconds'],
+                     'process_seconds': process_seconds, 'items_per_second': record['items_per_second'],
+                     'cpu_seconds': record['cpu_seconds'], 'peak_rss_mb': record['peak_rss_mb'],
+                     'peak_memory_mb': peak_memory_mb, 'errors': record['errors']})
+
+    truth = pd.read_csv(run_dir / "data" / "synthetic_ground_truth.csv")
+    filtered = pd.read_csv(run_dir / "data" / f"filtered_comparison_results_{date.today()}.csv")
+    recall = true_match_recall(filtered, truth)
+    for row in rows:
+        row['true_match_recall'] = recall
+
+    if not keep_runs:
+        shutil.rmtree(run_dir)
+    return rows
+
+def add_scaling(results):
+    """
+    Speed-up and parallel efficiency of each run against the fewest workers run on the same stage and dataset, with
+    the same executor
+    """
+    keys = ['stage', 'individuals', 'executor']
+    group = results.groupby(keys)
+    baseline = results.loc[group['workers'].idxmin(), keys + ['workers', 'items_per_second']]
+    baseline = baseline.rename(columns={'workers': 'base_workers', 'items_per_second': 'base_items_per_second'})
+    results = results.merge(baseline, on=keys, how='left')
+    results['speedup'] = results['items_per_second'] / results['base_items_per_second']
+    results['efficiency'] = results['speedup'] / (results['workers'] / results['base_workers'])
+    return results.drop(columns=['base_workers', 'base_items_per_second'])
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    BASE_DIR.mkdir(parents=True, exist_ok=True)
+
+    rows = []
+    for n_individuals in sizes:
+        # one synthetic project per size, reused by every worker count
+        dataset_dir = BASE_DIR / f"synthetic_{n_individuals}_{width}x{height}_seed{seed}"
+        truth_file = dataset_dir / "data" / "synthetic_ground_truth.csv"
+        if truth_file.exists():
+            truth = pd.read_csv(truth_file)
+        else:
+            print(f"Generating {n_individuals} individuals...")
+            truth = generate_dataset(dataset_dir, n_individuals, recaptures, photos_per_encounter, width, height,
+                                     seed=seed)
+        for executor in executors:
+            for workers in worker_counts:
+                print(f"Running the pipeline on {len(truth)} images of {n_individuals} individuals with {workers} "
+                      f"workers ({executor})")
+                run_dir = BASE_DIR / f"run_{n_individuals}_{executor}_{workers}"
+                rows.extend(run_pipeline(dataset_dir, run_dir, workers, executor, n_individuals, len(truth)))
+
+    results = add_scaling(pd.DataFrame(rows))
+    results_file = BASE_DIR / f"benchmark_results_{datetime.datetime.now():%Y-%m-%d_%H%M%S}.csv"
+    results.to_csv(results_file, index=False)
+
+    # scaling curves as tables: throughput (items per second) by worker count, and by dataset size
+    stage_order = [stage for stage, _, _ in pipeline_stages(BASE_DIR, 1)]
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        for n_individuals in sizes:
+            table = results.query("individuals == @n_individuals").pivot(
+                index='stage', columns=['executor', 'workers'], values=['items_per_second', 'speedup'])
+            print(f"\n{n_individuals} individuals - throughput and speed-up by workers")
+            print(table.reindex(stage_order))
+        for workers in worker_counts:
+            table = results.query("workers == @workers").pivot(index='stage', columns=['executor', 'images'],
+                                                               values='items_per_second')
+            print(f"\n{workers} workers - throughput by number of images")
+            print(table.reindex(stage_order))
+        if len(executors) > 1:
+            image_stages = results[results['stage'].isin(['crop_rotate', 'fingerprint_extraction'])]
+            table = image_stages.pivot(index=['stage', 'individuals', 'workers'], columns='executor',
+                                       values=['items_per_second', 'peak_memory_mb'])
+            print(f"\nWorker processes and threads compared - throughput and peak memory (MB, at most)")
+            print(table)
+        recall = results.drop_duplicates(['individuals', 'executor', 'workers']).pivot(
+            index='individuals', columns=['executor', 'workers'], values='true_match_recall')
+        print(f"\nShare of recaptures with a true match in the filtered results")
+        print(recall)
+
+    processing_time = datetime.datetime.now() - start_time
+    print(f"\nResults saved to {results_file}")
+    print("Time taken: ", processing_time)
@@ -0,0 +1,100 @@
+import datetime
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+import cv2 as cv
+import numpy as np
+from synthetic_beetles import generate_dataset
+from pipeline_options import split_arguments
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+# a scratch folder for the synthetic project and the two sets of crops
+BASE_DIR = Path(sys.argv[1])
+# optional --name=value settings of the synthetic photos, as in generate_synthetic_dataset.py, e.g. --individuals=20
+_, options = split_arguments(sys.argv[2:])
+n_individuals = int(options.get("individuals", 8))
+width = int(options.get("width", 2000))
+height = int(options.get("height", 3000))
+seed = int(options.get("seed", 0))
+# --segment-scale=n checks the two paths on patches found on reduced photos instead
+segment_scale = int(options.get("segment_scale", 1))
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Fused_warp_check"
+#n_individuals = 8
+########################################################################################################################
+
+
+########################################################################################################################
+# Checks that batch_segment_crop_rotate_subprocess.py turns every photo the same way with --fused-warp as without it.
+# Both paths crop a synthetic project, then each fused crop is compared with the usual crop of the same photo. Crops
+# turned the same way differ by about one grey level on average, from the interpolation the fused warp saves, while a
+# different turn differs by well over ten. Photos cropped by only one path, to a different size or beyond the
+# tolerance are reported and fail the check.
+SCRIPT_DIR = Path(__file__).resolve().parent
+# largest mean difference (grey levels) between a fused crop and the usual crop of the same photo
+TOLERANCE = 5
+
+def crop_project(dataset_dir, run_dir, crop_options):
+    """Crop a fresh copy of a synthetic project. Returns its fingerprints folder"""
+    if run_dir.exists():
+        shutil.rmtree(run_dir)
+    shutil.copytree(dataset_dir, run_dir)
+    completed = subprocess.run([sys.executable, str(SCRIPT_DIR / "batch_segment_crop_rotate_subprocess.py"),
+                                str(run_dir), "unprocessed_photos", f"--segment-scale={segment_scale}", *crop_options],
+                               cwd=SCRIPT_DIR, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stdout[-2000:], completed.stderr[-2000:])
+        raise RuntimeError(f"Cropping {run_dir} failed with exit code {completed.returncode}")
+    return run_dir / "fingerprints"
+
+def crop_difference(crop, fused_crop):
+    """Mean absolute difference between two crops of a photo, None if they differ in size"""
+    if crop.shape != fused_crop.shape:
+        return None
+    return np.abs(crop.astype(np.float32) - fused_crop).mean()
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    BASE_DIR.mkdir(parents=True, exist_ok=True)
+
+    dataset_dir = BASE_DIR / f"synthetic_{n_individuals}_{width}x{height}_seed{seed}"
+    if not (dataset_dir / "data" / "synthetic_ground_truth.csv").exists():
+        print(f"Generating {n_individuals} individuals...")
+        generate_dataset(dataset_dir, n_individuals, width=width, height=height, seed=seed)
+    usual_dir = crop_project(dataset_dir, BASE_DIR / "check_usual", [])
+    fused_dir = crop_project(dataset_dir, BASE_DIR / "check_fused", ["--fused-warp"])
+
+    names = sorted(folder.name for folder in usual_dir.iterdir())
+    problems = [f"{name}: only cropped with --fused-warp" for name in
+                sorted({folder.name for folder in fused_dir.iterdir()} - set(names))]
+    differences = []
+    for name in names:
+        if not (fused_dir / name).exists():
+            problems.append(f"{name}: not cropped with --fused-warp")
+            continue
+        crop = cv.imread(str(usual_dir / name / f"{name}_img.png"))
+        fused_crop = cv.imread(str(fused_dir / name / f"{name}_img.png"))
+        difference = crop_difference(crop, fused_crop)
+        if difference is None:
+            problems.append(f"{name}: crops of different sizes, {crop.shape[:2]} and {fused_crop.shape[:2]}")
+        elif difference > TOLERANCE:
+            problems.append(f"{name}: turned differently, the crops differ by {difference:.1f} grey levels on average")
+        else:
+            differences.append(difference)
+
+    for problem in problems:
+        print(problem)
+    print(f"{len(differences)} of {len(names)} photos turned the same way with --fused-warp, differing by "
+          f"{np.mean(differences) if differences else float('nan'):.2f} grey levels on average")
+    print("Time taken: ", datetime.datetime.now() - start_time)
+    if problems:
+        sys.exit(f"--fused-warp differs from the usual crops for {len(problems)} photos")
@@ -0,0 +1,52 @@
+import math
+import numpy as np
+import pandas as pd
+
+
+########################################################################################################################
+# Cascade crossmatching. filter_lowest_n only keeps number_comparisons_considered candidates per focal name, so most
+# full-precision scores are never looked at. In cascade mode, stage one scores every pair on the strongest keypoints
+# only (descriptor type "mask_top", saved by batch_store_values_subprocess.py), each focal name keeps a shortlist of
+# its best candidates with a safety margin, and stage two runs the full match on the shortlist alone.
+# A sample of focal names is scored exhaustively to measure how many true top-n candidates the shortlists keep.
+CASCADE_TYPE = "mask_top"
+
+def shortlist_size(filtered_n, margin):
+    """
+    Candidates kept per focal name, e.g. a margin of 3 keeps 60 candidates when 20 are considered. Never fewer than
+    filtered_n, so filter_lowest_n always has enough scored candidates to choose from.
+    """
+    return max(filtered_n, math.ceil(filtered_n * margin))
+
+def per_focal_shortlist(focal_names, row_pair_ids, values, keep):
+    """
+    Boolean array over pair ids marking pairs among the keep lowest values of any focal name. values is indexed by
+    pair id, and focal_names and row_pair_ids describe the rows of the pairwise list. Pairs without a value (stage one
+    failed, e.g. fingerprints extracted before top keypoints were stored) are always on the shortlist.
+    """
+    ranks = pd.Series(values[row_pair_ids]).groupby(np.asarray(focal_names)).rank(method='first')
+    shortlist = np.isnan(values)
+    shortlist[row_pair_ids[ranks.to_numpy() <= keep]] = True
+    return shortlist
+
+def sample_focal_names(focal_names, fraction):
+    """A reproducible random sample of focal names, at least one if fraction is above zero."""
+    names = pd.unique(np.asarray(focal_names))
+    if fraction <= 0 or not len(names):
+        return names[:0]
+    rng = np.random.default_rng(0)
+    return rng.choice(names, max(1, round(fraction * len(names))), replace=False)
+
+def cascade_recall(focal_names, row_pair_ids, values, shortlist, n, sampled_rows):
+    """
+    Share of the n best pairs by full score of each sampled focal name (as filter_lowest_n picks them) that made the
+    cascade shortlist. sampled_rows marks the pairwise list rows of focal names that were scored exhaustively.
+    Returns NaN if none of the sampled pairs has a full score.
+    """
+    rows = np.flatnonzero(sampled_rows)
+    ranks = pd.Series(values[row_pair_ids[rows]]).groupby(np.asarray(focal_names)[rows]).rank(method='first')
+    best = rows[ranks.to_numpy() <= n]
+    if not len(best):
+        return np.nan
+    return shortlist[row_pair_ids[best]].mean()
+########################################################################################################################
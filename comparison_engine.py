@@ -0,0 +1,363 @@
+import math
+import time
+import cv2 as cv
+import numpy as np
+import pandas as pd
+from descriptor_storage import DescriptorCache
+from matching_kernels import l2_cross_check_scores, hamming_cross_check_scores
+
+
+########################################################################################################################
+# Shared matching code for parallel_crossmatching_subprocess.py and within_individual_assessment_subprocess.py
+def pairwise_surf(x, y):
+    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
+    matches_surf = bf.match(x, y)
+    dist = [m.distance for m in matches_surf]
+    values = sum(dist) / len(dist)
+    return values
+
+def pairwise_sift(x, y):
+    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
+    matches_sift = bf.match(x, y)
+    dist = [m.distance for m in matches_sift]
+    values = sum(dist) / len(dist)
+    return values
+
+def pairwise_orb(x, y):
+    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
+    matches_orb = bf.match(x, y)
+    dist = [m.distance for m in matches_orb]
+    values = sum(dist) / len(dist)
+    return values
+
+def pairwise_akaze(x, y):
+    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
+    matches_akaze = bf.match(x, y)
+    dist = [m.distance for m in matches_akaze]
+    values = sum(dist) / len(dist)
+    return values
+########################################################################################################################
+
+
+########################################################################################################################
+# Dictionary mapping comparison types to their functions and descriptor files. 'kernel' is the vectorised equivalent
+# of 'func' from matching_kernels.py, used with the "vectorised" matcher
+comparison_map = {
+    'surf_compare': {
+        'func': pairwise_surf,
+        'kernel': l2_cross_check_scores,
+        'suffix': 'surf',
+        'dtype': 'float32',
+        'norm': cv.NORM_L2
+    },
+    'sift_compare': {
+        'func': pairwise_sift,
+        'kernel': l2_cross_check_scores,
+        'suffix': 'sift',
+        'dtype': 'float32',
+        'norm': cv.NORM_L2
+    },
+    'orb_compare': {
+        'func': pairwise_orb,
+        'kernel': hamming_cross_check_scores,
+        'suffix': 'orb',
+        'dtype': 'uint8',
+        'norm': cv.NORM_HAMMING
+    },
+    'akaze_compare': {
+        'func': pairwise_akaze,
+        'kernel': hamming_cross_check_scores,
+        'suffix': 'akaze',
+        'dtype': 'uint8',
+        'norm': cv.NORM_HAMMING
+    }
+}
+
+def comparison_columns(comparison_types):
+    """Output column names for the chosen comparison types, e.g. ['orb_values', 'sift_values']"""
+    return [f"{comparison_map[comp_type]['suffix']}_values" for comp_type in comparison_types]
+########################################################################################################################
+
+
+########################################################################################################################
+# Per-process worker state. init_worker runs once in every pool worker, so each worker has its own descriptor cache
+worker_settings = {}
+descriptor_cache = None
+
+# which matching backend compare() uses: "bfmatcher" (cv.BFMatcher per pair) or "vectorised" (matching_kernels.py)
+MATCHERS = ['bfmatcher', 'vectorised']
+
+def init_worker(fingerprint_dir, comparison_types, error_log_file, cache_bytes, pack_dir=None, matcher='bfmatcher'):
+    global descriptor_cache
+    worker_settings.update({
+        'fingerprint_dir': fingerprint_dir,
+        'comparison_types': comparison_types,
+        'error_log_file': error_log_file,
+        'pack_dir': pack_dir,
+        'matcher': matcher
+    })
+    descriptor_cache = DescriptorCache(cache_bytes)
+
+def compare(a, test_images, comparison_types, type="mask"):
+    """
+    Compares one focal image against a bundle of test images, loading the focal descriptors once per algorithm.
+    type picks the stored descriptors, e.g. "mask" for the full set or "mask_top" for the strongest keypoints only.
+    Returns a dictionary of value column -> float64 array aligned with test_images, with NaN for failed comparisons.
+    """
+    print(f"Comparing {a} vs {len(test_images)} test images")
+    fingerprint_dir = worker_settings['fingerprint_dir']
+    pack_dir = worker_settings['pack_dir']
+    error_log_file = worker_settings['error_log_file']
+
+    results = {}
+
+    # Process only the selected comparison types
+    for comp_type in comparison_types:
+        comp_info = comparison_map[comp_type]
+        values = np.full(len(test_images), np.nan)
+        results[f"{comp_info['suffix']}_values"] = values
+
+        try:
+            des1 = descriptor_cache.get(fingerprint_dir, a, comp_info['suffix'], type, pack_dir)
+        except Exception as e:
+            # without focal descriptors, none of this bundle's comparisons can run for this algorithm
+            with open(error_log_file, 'a') as f:
+                f.write(f'\nAn error occurred while comparing {a} vs {len(test_images)} test images with {comp_info["suffix"]}: {str(e)} \n')
+            continue
+
+        if worker_settings['matcher'] == 'vectorised' and 'kernel' in comp_info:
+            compare_vectorised(a, des1, test_images, comp_info, values, type)
+            continue
+
+        # stream the candidates against the focal descriptors
+        for i, b in enumerate(test_images):
+            try:
+                des2 = descriptor_cache.get(fingerprint_dir, b, comp_info['suffix'], type, pack_dir)
+                values[i] = comp_info['func'](des1, des2)
+
+            except Exception as e:
+                with open(error_log_file, 'a') as f:
+                    f.write(f'\nAn error occurred while comparing {a} vs {b} with {comp_info["suffix"]}: {str(e)} \n')
+
+    return results
+
+def compare_vectorised(a, des1, test_images, comp_info, values, type="mask"):
+    """Scores every test image whose descriptors load with one kernel call, logging failures as compare() does."""
+    fingerprint_dir = worker_settings['fingerprint_dir']
+    pack_dir = worker_settings['pack_dir']
+    error_log_file = worker_settings['error_log_file']
+    loaded = []
+    positions = []
+    for i, b in enumerate(test_images):
+        try:
+            loaded.append(descriptor_cache.get(fingerprint_dir, b, comp_info['suffix'], type, pack_dir))
+            positions.append(i)
+        except Exception as e:
+            with open(error_log_file, 'a') as f:
+                f.write(f'\nAn error occurred while comparing {a} vs {b} with {comp_info["suffix"]}: {str(e)} \n')
+    if not loaded:
+        return
+
+    values[positions] = comp_info['kernel'](des1, loaded)
+    for i in np.array(positions)[np.isnan(values[positions])]:
+        with open(error_log_file, 'a') as f:
+            f.write(f'\nAn error occurred while comparing {a} vs {test_images[i]} with {comp_info["suffix"]}: '
+                    f'no cross-checked matches \n')
+
+def compare_wrapper(task):
+    """
+    Runs one task of (comparison types, [(focal image, [test images], [pair ids]), ...], descriptor type). Comparison
+    types of None means every type the worker was set up with. Returns a compact result batch of
+    (pair ids as int64 array, {value column: float64 array}, task stats), where task stats are the descriptor cache
+    counts for this task plus its pairs and the wall-clock and CPU seconds the worker spent on it.
+    """
+    comparison_types, bundles, type = task
+    if comparison_types is None:
+        comparison_types = worker_settings['comparison_types']
+    start_time = time.perf_counter()
+    start_cpu = time.process_time()
+    cache_before = descriptor_cache.stats()
+    pair_ids = []
+    batch = {column: [] for column in comparison_columns(comparison_types)}
+
+    for focal_image, test_images, bundle_ids in bundles:
+        results = compare(focal_image, test_images, comparison_types, type)
+        pair_ids.append(np.asarray(bundle_ids, dtype=np.int64))
+        for column, values in results.items():
+            batch[column].append(values)
+
+    cache_after = descriptor_cache.stats()
+    cache_stats = {key: cache_after[key] - cache_before[key] for key in cache_after}
+    cache_stats.update({'pairs': sum(len(test_images) for _, test_images, _ in bundles),
+                        'seconds': time.perf_counter() - start_time, 'cpu_seconds': time.process_time() - start_cpu})
+    if not pair_ids:
+        return np.empty(0, dtype=np.int64), {column: np.empty(0) for column in batch}, cache_stats
+    return np.concatenate(pair_ids), {column: np.concatenate(values) for column, values in batch.items()}, cache_stats
+########################################################################################################################
+
+
+########################################################################################################################
+# Scheduling work and assembling results in the parent process
+def schedule_focal_bundles(pairs, task_size, comparison_types=None, type="mask"):
+    """
+    Groups a frame of unique (focal_image, test_image) pairs into (focal image, [test images], [pair ids]) bundles,
+    where pair ids are the frame's index labels, and packs neighbouring bundles into tasks of roughly task_size pairs.
+    Bundles are ordered by focal image, so photos of the same focal name (which share the same candidate list) tend to
+    land in the same task and reuse the worker's descriptor cache. Bundles larger than task_size are split across tasks.
+    Each task is (comparison_types, bundles, type); comparison types of None runs every type the workers were set up
+    with, and type is the descriptor type to compare.
+    """
+    tasks = []
+    current_task = []
+    current_size = 0
+    ordered = pairs[['focal_image', 'test_image']].sort_values('focal_image', kind='stable')
+    for focal_image, group in ordered.groupby('focal_image', sort=False):
+        test_images = group['test_image'].tolist()
+        ids = group.index.tolist()
+        for start in range(0, len(test_images), task_size):
+            bundle = (focal_image, test_images[start:start + task_size], ids[start:start + task_size])
+            if current_task and current_size + len(bundle[1]) > task_size:
+                tasks.append((comparison_types, current_task, type))
+                current_task = []
+                current_size = 0
+            current_task.append(bundle)
+            current_size += len(bundle[1])
+    if current_task:
+        tasks.append((comparison_types, current_task, type))
+    return tasks
+
+def symmetric_pairs(pairs):
+    """
+    Collapses (a, b) and (b, a) into one unordered pair. The cross-checked mean match distance is symmetric, so each
+    unordered pair only needs scoring once. Returns (canonical pairs frame with a fresh RangeIndex, canonical pair id for
+    every row of pairs). Each canonical pair keeps the orientation in which it first appears.
+    """
+    focal = pairs['focal_image'].to_numpy(dtype=object)
+    test = pairs['test_image'].to_numpy(dtype=object)
+    swap = focal > test
+    unordered = pd.DataFrame({'a': np.where(swap, test, focal), 'b': np.where(swap, focal, test)})
+    canonical_ids = unordered.groupby(['a', 'b'], sort=False).ngroup().to_numpy()
+    canonical = pairs.loc[~unordered.duplicated().to_numpy(), ['focal_image', 'test_image']].reset_index(drop=True)
+    return canonical, canonical_ids
+
+def schedule_missing_results(pairs, done, comparison_types, task_size, type="mask"):
+    """
+    Schedules only the (pair, algorithm) results that are not done yet, where done maps value column -> boolean array
+    indexed by pair id. Pairs missing the same set of algorithms are bundled together.
+    """
+    columns = comparison_columns(comparison_types)
+    pair_ids = pairs.index.to_numpy()
+    missing = np.column_stack([~done[column][pair_ids] for column in columns])
+    tasks = []
+    patterns, pattern_ids = np.unique(missing, axis=0, return_inverse=True)
+    for p, pattern in enumerate(patterns):
+        if pattern.any():
+            pattern_types = [comp_type for comp_type, is_missing in zip(comparison_types, pattern) if is_missing]
+            tasks += schedule_focal_bundles(pairs[pattern_ids.ravel() == p], task_size, pattern_types, type)
+    return tasks
+
+# Task sizing. Tasks are handed to workers one at a time as they become free (imap_unordered), so they should be
+# small enough to keep every worker busy until the end of the run, yet long enough that handing them out costs little
+TASKS_PER_WORKER = 10
+# seconds a task should take at most (bounds the tail of a run) and at least (bounds scheduling overhead)
+MAX_TASK_SECONDS = 30
+MIN_TASK_SECONDS = 1
+# pairs per task at most, to keep result batches and worker memory small
+MAX_TASK_PAIRS = 100000
+# pairs per pilot task, run once per worker to measure the cost of a pair before sizing the rest
+PILOT_TASK_PAIRS = 10
+
+def adaptive_task_size(n_pairs, n_workers, pair_seconds=None):
+    """
+    Pairs per task for n_pairs pairs on n_workers workers: about TASKS_PER_WORKER tasks per worker, kept between
+    MIN_TASK_SECONDS and MAX_TASK_SECONDS of work each when the seconds per pair have been measured.
+    """
+    size = math.ceil(n_pairs / (n_workers * TASKS_PER_WORKER))
+    if pair_seconds:
+        size = min(size, MAX_TASK_SECONDS / pair_seconds)
+        size = max(size, MIN_TASK_SECONDS / pair_seconds)
+    return int(min(max(size, 1), MAX_TASK_PAIRS))
+
+def measured_pair_seconds(task_stats):
+    """Mean worker seconds per pair over tasks returned by compare_wrapper, or None if no pairs were timed."""
+    pairs = sum(stats['pairs'] for stats in task_stats)
+    return sum(stats['seconds'] for stats in task_stats) / pairs if pairs else None
+
+def run_missing_results(pool, n_workers, pairs, done, comparison_types, handle_batch, type="mask"):
+    """
+    Computes the (pair, algorithm) results not marked in done (see schedule_missing_results) on a pool set up with
+    init_worker. One small pilot task per worker measures the cost of a pair, then the remaining results are split into
+    tasks of adaptive_task_size pairs. Every result batch is passed to handle_batch as it arrives. Returns the stats of
+    every task (see compare_wrapper).
+    """
+    columns = comparison_columns(comparison_types)
+    pair_ids = pairs.index.to_numpy()
+    missing = ~np.column_stack([done[column][pair_ids] for column in columns]).all(axis=1)
+    done = {column: done[column].copy() for column in columns}
+    task_stats = []
+
+    def run(tasks):
+        for batch in pool.imap_unordered(compare_wrapper, tasks):
+            batch_ids, values, stats = batch
+            for column in values:
+                done[column][batch_ids] = True
+            handle_batch(batch)
+            task_stats.append(stats)
+
+    pilot_pairs = pairs[missing].iloc[:n_workers * PILOT_TASK_PAIRS]
+    run(schedule_missing_results(pilot_pairs, done, comparison_types, PILOT_TASK_PAIRS, type))
+    task_size = adaptive_task_size(int(missing.sum()) - len(pilot_pairs), n_workers, measured_pair_seconds(task_stats))
+    run(schedule_missing_results(pairs, done, comparison_types, task_size, type))
+    return task_stats
+
+def summarise_worker_utilisation(task_stats, n_workers, wall_seconds):
+    """
+    Share of the pool's available worker time (n_workers x wall_seconds) spent on tasks, and the share of that busy
+    time spent computing on the CPU rather than waiting (e.g. on disk).
+    """
+    busy = sum(stats.get('seconds', 0) for stats in task_stats)
+    cpu = sum(stats.get('cpu_seconds', 0) for stats in task_stats)
+    available = n_workers * wall_seconds
+    return {
+        'tasks': sum(1 for stats in task_stats if stats.get('pairs')),
+        'busy_seconds': busy,
+        'utilisation': busy / available if available else 0.0,
+        'cpu_share': cpu / busy if busy else 0.0
+    }
+
+def count_missing_results(pairs, done, comparison_types):
+    """Number of (pair, algorithm) results of pairs not marked in done, i.e. what run_missing_results will compute."""
+    pair_ids = pairs.index.to_numpy()
+    return sum(int((~done[column][pair_ids]).sum()) for column in comparison_columns(comparison_types))
+
+def batch_counts(batch):
+    """(results, failed results) in a result batch returned by compare_wrapper, for progress reporting."""
+    _, values, _ = batch
+    return (sum(len(column_values) for column_values in values.values()),
+            sum(int(np.isnan(column_values).sum()) for column_values in values.values()))
+
+def record_result_batch(scores, batch):
+    """Copy one result batch returned by compare_wrapper into the score arrays. Returns the task's stats."""
+    pair_ids, values, cache_stats = batch
+    for column, column_values in values.items():
+        scores[column][pair_ids] = column_values
+    return cache_stats
+
+def collect_result_batches(batches, n_pairs, columns):
+    """
+    Assembles result batches returned by compare_wrapper into one float64 array per value column, indexed by pair id.
+    Pairs that were never scored, or whose comparison failed, are left as NaN. Returns (scores, cache stats per task).
+    """
+    scores = {column: np.full(n_pairs, np.nan) for column in columns}
+    task_cache_stats = [record_result_batch(scores, batch) for batch in batches]
+    return scores, task_cache_stats
+
+def format_missing_values(values):
+    """Convert a float score array for CSV output, writing failed comparisons as 'NA' as the pipeline always has."""
+    missing = np.isnan(values)
+    if not missing.any():
+        return values
+    formatted = values.astype(object)
+    formatted[missing] = "NA"
+    return formatted
+########################################################################################################################
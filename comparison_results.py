@@ -0,0 +1,238 @@
+import csv
+import heapq
+import json
+import zlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from comparison_engine import format_missing_values
+
+
+########################################################################################################################
+# Streaming crossmatching results to disk. While a run is in progress every completed batch is appended to a "result
+# stream" (one row per focal image, test image and algorithm), so a crash loses at most the batches still in flight.
+# The final comparison_results and filtered_comparison_results files are then written and filtered chunk by chunk.
+STREAM_COLUMNS = ['focal_image', 'test_image', 'algorithm', 'value']
+
+def result_stream_path(BASE_DIR, pairwise_list_name):
+    """Result stream for a pairwise list, e.g. data/comparison_stream_pairwise_comparison_list_2025-01-01.csv"""
+    return Path(BASE_DIR) / "data" / f"comparison_stream_{Path(pairwise_list_name).stem}.csv"
+
+def start_result_stream(stream_file):
+    """Create an empty result stream, replacing any previous one."""
+    pd.DataFrame(columns=STREAM_COLUMNS).to_csv(stream_file, index=False)
+
+def repair_result_stream(stream_file):
+    """Drop a partly written last line left behind if a run was killed in the middle of appending a batch."""
+    with open(stream_file, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+def load_result_stream(stream_file, pairs, scores, chunk_size=100000):
+    """
+    Fill the score arrays with results already recorded in a result stream, for resuming a run. Only the algorithms
+    in scores and pairs present in pairs (a frame of unique focal_image/test_image pairs indexed by pair id) are used.
+    Returns a dictionary of value column -> boolean array marking the pairs that are already done.
+    """
+    done = {column: np.zeros(len(scores[column]), dtype=bool) for column in scores}
+    pair_index = pd.MultiIndex.from_frame(pairs[['focal_image', 'test_image']])
+    pair_ids = pairs.index.to_numpy()
+    repair_result_stream(stream_file)
+
+    # values were written with full precision, so read them back exactly
+    for chunk in pd.read_csv(stream_file, dtype={'focal_image': str, 'test_image': str, 'algorithm': str},
+                             float_precision='round_trip', chunksize=chunk_size):
+        # results may have been streamed for either orientation of a pair. pairs no longer in the list are ignored
+        positions = pair_index.get_indexer(pd.MultiIndex.from_frame(chunk[['focal_image', 'test_image']]))
+        reversed_positions = pair_index.get_indexer(pd.MultiIndex.from_frame(chunk[['test_image', 'focal_image']]))
+        positions = np.where(positions >= 0, positions, reversed_positions)
+        chunk = chunk[positions >= 0].assign(pair_id=pair_ids[positions[positions >= 0]])
+        for algorithm, rows in chunk.groupby('algorithm'):
+            column = f"{algorithm}_values"
+            if column not in scores:
+                continue
+            ids = rows['pair_id'].to_numpy()
+            scores[column][ids] = rows['value'].to_numpy(dtype=float)
+            done[column][ids] = True
+    return done
+
+def append_result_batch(stream_file, pairs, batch):
+    """
+    Append one result batch from comparison_engine.compare_wrapper to the result stream and flush it to disk.
+    Failed comparisons are written with an empty value, so they are recorded as done.
+    """
+    pair_ids, values, _ = batch
+    if len(pair_ids) == 0:
+        return
+    batch_pairs = pairs.loc[pair_ids]
+    rows = pd.concat([
+        pd.DataFrame({
+            'focal_image': batch_pairs['focal_image'].to_numpy(),
+            'test_image': batch_pairs['test_image'].to_numpy(),
+            'algorithm': column.removesuffix('_values'),
+            'value': column_values
+        })
+        for column, column_values in values.items()
+    ])
+    with open(stream_file, 'a', newline='') as f:
+        rows.to_csv(f, header=False, index=False)
+        f.flush()
+
+def append_reused_results(stream_file, pairs, scores, reused_ids):
+    """Copy results reused from elsewhere (another stream, the score store) into the result stream."""
+    for column, ids in reused_ids.items():
+        append_result_batch(stream_file, pairs, (ids, {column: scores[column][ids]}, None))
+########################################################################################################################
+
+
+########################################################################################################################
+def write_comparison_results(output_file, df, row_pair_ids, scores, columns, chunk_size=100000, mode='w'):
+    """
+    Write the pairwise list with its score columns and an empty flag column, chunk by chunk, so the full results table
+    is never built in memory. row_pair_ids maps each row of df to its position in the score arrays. mode='a' appends
+    to a file that was already started (e.g. a shard file's description line).
+    """
+    for start in range(0, len(df), chunk_size):
+        chunk = df.iloc[start:start + chunk_size].copy()
+        for column in columns:
+            chunk[column] = format_missing_values(scores[column][row_pair_ids[start:start + chunk_size]])
+        chunk['flag'] = ''
+        chunk.to_csv(output_file, mode=mode if start == 0 else 'a', header=(start == 0), index=False)
+    if len(df) == 0:
+        pd.DataFrame(columns=list(df.columns) + columns + ['flag']).to_csv(output_file, mode=mode, index=False)
+
+
+def lowest_n_per_focal(df, n, col):
+    # Get the smallest n values for each focal_name group
+    return (df.groupby('focal_name', as_index=False)
+            .apply(lambda group: group.nsmallest(n, col))
+            .reset_index(drop=True))
+
+def filter_lowest_n(df, n):
+    # Identify columns ending with '_values'
+    value_columns = [col for col in df.columns if col.endswith('_values')]
+
+    # Convert value columns to numeric in place
+    df[value_columns] = df[value_columns].apply(pd.to_numeric, errors='coerce')
+
+    # List to hold results for each column
+    result_list = [lowest_n_per_focal(df, n, col) for col in value_columns]
+
+    # Combine results and ensure uniqueness on specific columns
+    result = pd.concat(result_list).drop_duplicates(subset=['focal_image', 'test_image'])
+
+    return result
+
+def filter_lowest_n_streaming(results_file, n, chunk_size=100000):
+    """
+    Same output as filter_lowest_n on the whole results file, but reads it chunk by chunk and only keeps the running
+    n best rows per focal_name for each value column. Rows carried over from earlier chunks come first, so ties are
+    broken by file order exactly as they are when filtering the whole table at once.
+    """
+    header = pd.read_csv(results_file, nrows=0).columns
+    value_columns = [col for col in header if col.endswith('_values')]
+    # read everything else as text, so values are written back exactly as they appear in the results file
+    dtypes = {col: (float if col in value_columns else str) for col in header}
+
+    best = {col: None for col in value_columns}
+    for chunk in pd.read_csv(results_file, dtype=dtypes, float_precision='round_trip', chunksize=chunk_size):
+        for col in value_columns:
+            candidates = chunk if best[col] is None else pd.concat([best[col], chunk], ignore_index=True)
+            best[col] = lowest_n_per_focal(candidates, n, col)
+
+    result_list = [best[col] for col in value_columns if best[col] is not None]
+    if not result_list:
+        return pd.DataFrame(columns=header)
+    return pd.concat(result_list).drop_duplicates(subset=['focal_image', 'test_image'])
+########################################################################################################################
+
+
+########################################################################################################################
+# Sharded crossmatching, for splitting one pairwise list across several machines (or processes). Shard i of n handles
+# the rows of the focal names whose CRC-32 falls in its partition, so every focal name's candidates - and with them
+# its cascade shortlists - stay on one shard. Each shard writes a partial results file, which starts with a
+# "# {...}" line describing the run, followed by its rows of comparison_results with their row in the pairwise list.
+# merge_crossmatching_shards.py then interleaves the shards back into the results a single run would have written.
+SHARD_ROW_COLUMN = 'pairwise_row'
+
+def shard_rows(focal_names, shard_index, shard_count):
+    """
+    Boolean mask of the rows belonging to shard shard_index (counted from 1) of shard_count. The partition is the same
+    on every machine, unlike Python's salted hash().
+    """
+    names = pd.Series(pd.unique(np.asarray(focal_names)))
+    owners = names.map(lambda name: zlib.crc32(str(name).encode('utf-8')) % shard_count)
+    return pd.Series(np.asarray(focal_names)).map(dict(zip(names, owners))).to_numpy() == shard_index - 1
+
+def shard_path(BASE_DIR, pairwise_list_name, shard_index, shard_count):
+    """Partial results of one shard, e.g. data/comparison_shard_pairwise_comparison_list_2025-01-01_2of4.csv"""
+    return (Path(BASE_DIR) / "data" /
+            f"comparison_shard_{Path(pairwise_list_name).stem}_{shard_index}of{shard_count}.csv")
+
+def write_shard_results(shard_file, description, df, row_pair_ids, scores, columns, chunk_size=100000):
+    """
+    Write a shard's partial results: a description line (a dictionary, written as JSON), then the shard's rows of df
+    with their scores as in comparison_results, each with its row number in the full pairwise list first.
+    """
+    with open(shard_file, 'w') as f:
+        f.write(f"# {json.dumps(description)}\n")
+    write_comparison_results(shard_file, df.rename_axis(SHARD_ROW_COLUMN).reset_index(), row_pair_ids, scores,
+                             columns, chunk_size, mode='a')
+
+def read_shard_description(shard_file):
+    """The description dictionary written at the top of a shard file."""
+    with open(shard_file) as f:
+        line = f.readline()
+    if not line.startswith("# "):
+        raise ValueError(f"{shard_file} is not a crossmatching shard file")
+    return json.loads(line[2:])
+
+def check_shard_set(descriptions):
+    """
+    Raise a ValueError unless the shard descriptions are one complete set: the same pairwise list, comparison types
+    and options, every shard index of the shard count exactly once, and rows adding up to the whole list.
+    """
+    first = descriptions[0]
+    for description in descriptions[1:]:
+        for key in ('pairwise_list', 'shard_count', 'total_rows', 'comparison_types', 'columns', 'options',
+                    'number_comparisons_considered', 'detector_parameters'):
+            if description[key] != first[key]:
+                raise ValueError(f"Shards differ in {key}: {first[key]} and {description[key]}")
+    indexes = sorted(description['shard_index'] for description in descriptions)
+    if indexes != list(range(1, first['shard_count'] + 1)):
+        missing = sorted(set(range(1, first['shard_count'] + 1)) - set(indexes))
+        raise ValueError(f"Expected each of {first['shard_count']} shards once, missing shards: "
+                         f"{', '.join(str(i) for i in missing) or 'none (duplicate shards given)'}")
+    n_rows = sum(description['rows'] for description in descriptions)
+    if n_rows != first['total_rows']:
+        raise ValueError(f"Shards hold {n_rows} rows, but the pairwise list has {first['total_rows']}")
+
+def merge_shard_results(shard_files, output_file):
+    """
+    Merge a complete set of shard files into one comparison_results file, identical to a single run's. Shard rows are
+    already in pairwise list order, so the files are interleaved line by line without loading them into memory.
+    Returns the shard descriptions.
+    """
+    descriptions = [read_shard_description(shard_file) for shard_file in shard_files]
+    check_shard_set(descriptions)
+
+    files = [open(shard_file, newline='') for shard_file in shard_files]
+    try:
+        readers = []
+        for f in files:
+            f.readline()  # description
+            reader = csv.reader(f)
+            header = next(reader)
+            readers.append(reader)
+        # rows are written back as pandas wrote them: minimal quoting, one "\n" per line
+        with open(output_file, 'w', newline='') as out:
+            writer = csv.writer(out, lineterminator='\n')
+            writer.writerow(header[1:])
+            for row in heapq.merge(*readers, key=lambda row: int(row[0])):
+                writer.writerow(row[1:])
+    finally:
+        for f in files:
+            f.close()
+    return descriptions
+########################################################################################################################
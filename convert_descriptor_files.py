@@ -0,0 +1,58 @@
+import datetime
+from datetime import date
+from pathlib import Path
+import sys
+from descriptor_storage import convert_text_descriptors, pack_fingerprints, DESCRIPTOR_DTYPES
+
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+BASE_DIR = Path(sys.argv[1])
+# pass --remove-text to delete the old .txt descriptor files once they have been converted
+remove_text = "--remove-text" in sys.argv[2:]
+# pass --pack to also build the per-algorithm descriptor packs used by the comparison scripts
+build_pack = "--pack" in sys.argv[2:]
+# Define the target subdirectory (should only be fingerprints)
+directory = BASE_DIR / "fingerprints"
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Project_name"
+#remove_text = False
+#build_pack = False
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    # One-off migration of fingerprints saved as text by older versions of the pipeline to the binary .npy format
+    start_time = datetime.datetime.now()
+    print(f"Converting text descriptor files in {directory} - this may take some time!")
+
+    converted, failed = convert_text_descriptors(directory, remove_text=remove_text)
+
+    error_log_file = BASE_DIR / "logs" / "fingerprinting_error_logs.txt"
+    with open(error_log_file, 'a') as f:
+        f.write(f'\n{datetime.datetime.now()} - Converting text descriptor files to binary format \n')
+        for path, err in failed:
+            f.write(f'\nCould not convert {path}: {err} \n')
+
+    if build_pack:
+        print("Building descriptor packs...")
+        names = sorted(item.name for item in directory.iterdir() if item.is_dir())
+        appended, unchanged, pack_failed = pack_fingerprints(directory, BASE_DIR / "descriptor_packs", names, DESCRIPTOR_DTYPES)
+        print(f"Descriptor packs: {appended} fingerprints appended, {unchanged} already packed")
+        with open(error_log_file, 'a') as f:
+            for name, algorithm, err in pack_failed:
+                f.write(f'\nCould not add {name} to the {algorithm} descriptor pack: {err} \n')
+
+    processing_time = datetime.datetime.now() - start_time
+    print(f"Converted {converted} descriptor files, {len(failed)} failed. Time taken: ", processing_time)
+
+    timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
+    with open(timing_log_file, 'a') as f:
+        f.write(f'\nDescriptor conversion - {converted} files converted in {processing_time}. {date.today()} \n')
+
+    print("Done...")
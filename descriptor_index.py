@@ -0,0 +1,319 @@
+import csv
+import os
+import numpy as np
+from pathlib import Path
+from descriptor_storage import DESCRIPTOR_DTYPES, load_descriptors
+
+
+########################################################################################################################
+# Approximate nearest-neighbour retrieval over the whole fingerprint database. Instead of matching a focal image
+# against every image in an explicit pair list, each focal descriptor is hashed into a few locality-sensitive hash (LSH)
+# buckets, compared exactly only with the database descriptors sharing one of its buckets, and votes for the image that
+# owns its nearest neighbour. Binary descriptors (ORB, AKAZE) are hashed by sampling bits, float descriptors (SIFT, SURF)
+# by the signs of random projections. The index lives in BASE_DIR/descriptor_index and is updated in place as new
+# fingerprints are extracted: new descriptors are appended and hashed, and the sorted bucket tables are merged.
+
+# number of hash tables, and bits per bucket key for each algorithm
+N_TABLES = 8
+KEY_BITS = {
+    'surf': 14,
+    'sift': 14,
+    'orb': 16,
+    'akaze': 16
+}
+# candidates taken from any one bucket, so a few very common descriptors can't swamp a query. larger buckets are
+# sampled evenly
+MAX_BUCKET = 100
+# number of set bits in every byte value, for Hamming distances
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def descriptor_index_dir(BASE_DIR):
+    return Path(BASE_DIR) / "descriptor_index"
+########################################################################################################################
+
+
+########################################################################################################################
+class DescriptorIndex:
+    """
+    LSH index for one algorithm. Files, all prefixed {algorithm}_{type}:
+      _hash.npz          hashing settings, fixed when the index is created
+      _descriptors.dat   every indexed descriptor row, append-only
+      _keys.dat          each row's bucket key in every table, append-only
+      _table_keys.npy    per table, all bucket keys in sorted order (memory-mapped when querying)
+      _table_rows.npy    per table, the descriptor row for each sorted key
+      _images.csv        name, first row, rows, cols. Written last, so rows of an interrupted update are never used
+    """
+    def __init__(self, index_dir, algorithm, type="mask"):
+        self.index_dir = Path(index_dir)
+        self.algorithm = algorithm
+        self.dtype = np.dtype(DESCRIPTOR_DTYPES[algorithm])
+        self.binary = self.dtype == np.uint8
+        self.key_bits = KEY_BITS[algorithm]
+        prefix = f"{algorithm}_{type}"
+        self.hash_path = self.index_dir / f"{prefix}_hash.npz"
+        self.data_path = self.index_dir / f"{prefix}_descriptors.dat"
+        self.keys_path = self.index_dir / f"{prefix}_keys.dat"
+        self.table_keys_path = self.index_dir / f"{prefix}_table_keys.npy"
+        self.table_rows_path = self.index_dir / f"{prefix}_table_rows.npy"
+        self.images_path = self.index_dir / f"{prefix}_images.csv"
+        self._images = None
+        self._hash_settings = None
+        self._owners = None
+        self._tables = None
+        self._data = None
+
+    def exists(self):
+        return self.images_path.exists()
+
+    @property
+    def images(self):
+        """name -> (first row, rows, cols). Later entries supersede earlier ones for re-extracted fingerprints."""
+        if self._images is None:
+            self._images = {}
+            if self.images_path.exists():
+                with open(self.images_path, newline='') as f:
+                    for row in csv.DictReader(f):
+                        self._images[row["name"]] = (int(row["first_row"]), int(row["rows"]), int(row["cols"]))
+        return self._images
+
+    def __contains__(self, name):
+        return name in self.images
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def n_rows(self):
+        """Descriptor rows referenced by the image list. Anything beyond this was left by an interrupted update."""
+        return max((first + rows for first, rows, _ in self.images.values()), default=0)
+
+    @property
+    def hash_settings(self):
+        if self._hash_settings is None and self.hash_path.exists():
+            with np.load(self.hash_path) as settings:
+                self._hash_settings = {key: settings[key] for key in settings.files}
+        return self._hash_settings
+
+    def _create_hash_settings(self, descriptors):
+        # fixed seed, so rebuilding an index from the same fingerprints gives the same buckets
+        rng = np.random.default_rng(0)
+        cols = descriptors.shape[1]
+        if self.binary:
+            settings = {'bits': np.stack([rng.choice(cols * 8, self.key_bits, replace=False) for _ in range(N_TABLES)])}
+        else:
+            # project around the mean descriptor, otherwise the all-positive SIFT/SURF values fall in a few buckets
+            settings = {'planes': rng.standard_normal((N_TABLES * self.key_bits, cols)).astype(np.float32),
+                        'center': descriptors.mean(axis=0).astype(np.float32)}
+        settings['cols'] = np.array(cols)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        np.savez(self.hash_path, **settings)
+        self._hash_settings = settings
+
+    def hash(self, descriptors):
+        """Bucket key of every descriptor in every table, as a (descriptors, tables) uint32 array."""
+        settings = self.hash_settings
+        if self.binary:
+            bits = np.unpackbits(descriptors, axis=1)[:, settings['bits']]
+        else:
+            projections = (descriptors - settings['center']) @ settings['planes'].T
+            bits = (projections > 0).reshape(len(descriptors), N_TABLES, self.key_bits)
+        weights = np.left_shift(np.uint32(1), np.arange(self.key_bits, dtype=np.uint32))
+        return (bits.astype(np.uint32) * weights).sum(axis=2, dtype=np.uint32)
+
+    def load(self, name):
+        """Return a read-only view of one indexed image's descriptors."""
+        first, rows, cols = self.images[name]
+        return self._descriptor_data()[first:first + rows]
+
+    def _descriptor_data(self):
+        if self._data is None or len(self._data) < self.n_rows:
+            cols = int(self.hash_settings['cols'])
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='r').reshape(-1, cols)
+        return self._data
+
+    def _load_tables(self):
+        if self._tables is None:
+            self._tables = (np.load(self.table_keys_path, mmap_mode='r'), np.load(self.table_rows_path, mmap_mode='r'))
+        return self._tables
+
+    def _image_owners(self):
+        """
+        (image names, name -> image number, owning image number for every descriptor row, or -1 for superseded rows)
+        """
+        if self._owners is None:
+            names = np.array(list(self.images), dtype=object)
+            numbers = {name: i for i, name in enumerate(names)}
+            owners = np.full(self.n_rows, -1, dtype=np.int64)
+            for i, (first, rows, _) in enumerate(self.images.values()):
+                owners[first:first + rows] = i
+            self._owners = (names, numbers, owners)
+        return self._owners
+
+    def add(self, entries):
+        """
+        Append [(name, descriptors), ...] to the index. Names already indexed are superseded by the new descriptors.
+        The new descriptors are hashed and merged into the sorted bucket tables; existing rows are never rehashed.
+        """
+        entries = [(name, np.ascontiguousarray(descriptors, dtype=self.dtype)) for name, descriptors in entries]
+        entries = [(name, descriptors) for name, descriptors in entries if descriptors.ndim == 2 and len(descriptors)]
+        if not entries:
+            return
+        new_descriptors = np.concatenate([descriptors for _, descriptors in entries])
+        if self.hash_settings is None:
+            self._create_hash_settings(new_descriptors)
+
+        # drop anything left behind by an interrupted update before appending
+        first_row = self.n_rows
+        row_bytes = new_descriptors.shape[1] * self.dtype.itemsize
+        for path, nbytes in ((self.data_path, first_row * row_bytes), (self.keys_path, first_row * N_TABLES * 4)):
+            with open(path, 'ab') as f:
+                f.truncate(nbytes)
+
+        new_keys = self.hash(new_descriptors)
+        with open(self.data_path, 'ab') as f:
+            f.write(new_descriptors.tobytes())
+        with open(self.keys_path, 'ab') as f:
+            f.write(new_keys.tobytes())
+        self._merge_tables(new_keys, np.arange(first_row, first_row + len(new_descriptors), dtype=np.int64), first_row)
+
+        new_index = not self.images_path.exists()
+        with open(self.images_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_index:
+                writer.writerow(["name", "first_row", "rows", "cols"])
+            for name, descriptors in entries:
+                writer.writerow([name, first_row, descriptors.shape[0], descriptors.shape[1]])
+                self.images[name] = (first_row, descriptors.shape[0], descriptors.shape[1])
+                first_row += len(descriptors)
+        self._owners = None
+        self._data = None
+
+    def _merge_tables(self, new_keys, new_rows, first_row):
+        if self.table_keys_path.exists():
+            table_keys, table_rows = (np.load(self.table_keys_path), np.load(self.table_rows_path))
+            # rows from an interrupted update are dropped. every table holds the same rows, so the shape is kept
+            kept = table_rows < first_row
+            if not kept.all():
+                table_keys = table_keys[kept].reshape(N_TABLES, -1)
+                table_rows = table_rows[kept].reshape(N_TABLES, -1)
+        else:
+            table_keys = np.empty((N_TABLES, 0), dtype=np.uint32)
+            table_rows = np.empty((N_TABLES, 0), dtype=np.int64)
+
+        merged_keys = np.empty((N_TABLES, table_keys.shape[1] + len(new_keys)), dtype=np.uint32)
+        merged_rows = np.empty(merged_keys.shape, dtype=np.int64)
+        for t in range(N_TABLES):
+            order = np.argsort(new_keys[:, t], kind='stable')
+            positions = np.searchsorted(table_keys[t], new_keys[order, t], side='right')
+            merged_keys[t] = np.insert(table_keys[t], positions, new_keys[order, t])
+            merged_rows[t] = np.insert(table_rows[t], positions, new_rows[order])
+
+        # write to temporary files first, so a query never sees half-written tables
+        self._tables = None
+        for path, array in ((self.table_keys_path, merged_keys), (self.table_rows_path, merged_rows)):
+            temp_path = path.with_suffix(".tmp.npy")
+            np.save(temp_path, array)
+            os.replace(temp_path, path)
+
+    def _distances(self, a, b):
+        if self.binary:
+            return POPCOUNT[np.bitwise_xor(a, b)].sum(axis=1, dtype=np.int32)
+        return np.square(a - b).sum(axis=1)
+
+    def query(self, descriptors, top_n=50, exclude=(), batch_size=128):
+        """
+        Rank indexed images by how many of the given descriptors have their approximate nearest neighbour in them.
+        Images named in exclude (e.g. other photos of the focal individual) are skipped.
+        Returns a list of (image name, votes), best first, of at most top_n images.
+        """
+        descriptors = np.ascontiguousarray(descriptors, dtype=self.dtype)
+        names, numbers, owners = self._image_owners()
+        if not len(names):
+            return []
+        excluded = np.array([numbers[name] for name in exclude if name in numbers], dtype=np.int64)
+        table_keys, table_rows = self._load_tables()
+        data = self._descriptor_data()
+        votes = np.zeros(len(names), dtype=np.int64)
+
+        for start in range(0, len(descriptors), batch_size):
+            block = descriptors[start:start + batch_size]
+            keys = self.hash(block)
+            query_parts = []
+            row_parts = []
+            for t in range(N_TABLES):
+                lo = np.searchsorted(table_keys[t], keys[:, t], side='left')
+                sizes = np.searchsorted(table_keys[t], keys[:, t], side='right') - lo
+                counts = np.minimum(sizes, MAX_BUCKET)
+                # positions of every matching bucket, flattened. a bucket over MAX_BUCKET is sampled evenly along its
+                # length, rather than cut to its first rows, which would only ever hold the earliest indexed images
+                steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+                offsets = (2 * steps + 1) * np.repeat(sizes, counts) // (2 * np.repeat(counts, counts))
+                query_parts.append(np.repeat(np.arange(len(block)), counts))
+                row_parts.append(np.asarray(table_rows[t][np.repeat(lo, counts) + offsets]))
+            queries = np.concatenate(query_parts)
+            rows = np.concatenate(row_parts)
+            keep = rows < len(owners)
+            keep[keep] = owners[rows[keep]] >= 0
+            if len(excluded):
+                keep[keep] = ~np.isin(owners[rows[keep]], excluded)
+
+            # the same candidate usually turns up in several tables
+            candidates = np.unique(queries[keep] * len(owners) + rows[keep])
+            if not len(candidates):
+                continue
+            queries, rows = np.divmod(candidates, len(owners))
+            distances = self._distances(block[queries], data[rows])
+
+            # each descriptor votes for the image owning its nearest candidate
+            order = np.lexsort((distances, queries))
+            queries, rows = queries[order], rows[order]
+            nearest = np.ones(len(queries), dtype=bool)
+            nearest[1:] = queries[1:] != queries[:-1]
+            votes += np.bincount(owners[rows[nearest]], minlength=len(names))
+
+        ranked = np.argsort(-votes, kind='stable')
+        ranked = ranked[votes[ranked] > 0][:top_n]
+        return [(names[i], int(votes[i])) for i in ranked]
+
+
+# indexes opened by this process, so each pool worker maps an index only once
+_open_indexes = {}
+
+def open_index(index_dir, algorithm, type="mask"):
+    key = (str(index_dir), algorithm, type)
+    if key not in _open_indexes:
+        _open_indexes[key] = DescriptorIndex(index_dir, algorithm, type)
+    return _open_indexes[key]
+
+def update_descriptor_index(fingerprint_dir, index_dir, names, algorithms, type="mask", batch_images=500):
+    """
+    Add the given images' descriptor files to each algorithm's index. Images already indexed with identical
+    descriptors are skipped, so re-running over a whole folder only adds new or re-extracted fingerprints.
+    Returns a tuple of (number added, number unchanged, list of (name, algorithm, error message)).
+    """
+    added = 0
+    unchanged = 0
+    failed = []
+    for algorithm in algorithms:
+        index = DescriptorIndex(index_dir, algorithm, type)
+        batch = []
+        for name in names:
+            try:
+                descriptors = load_descriptors(fingerprint_dir, name, algorithm, type, mmap=False)
+                if name in index and np.array_equal(index.load(name), descriptors):
+                    unchanged += 1
+                    continue
+                batch.append((name, descriptors))
+            except FileNotFoundError:
+                continue  # this algorithm was never extracted for this image
+            except Exception as e:
+                failed.append((name, algorithm, str(e)))
+            # add in batches, so the bucket tables are merged a few times rather than once per image
+            if len(batch) >= batch_images:
+                index.add(batch)
+                added += len(batch)
+                batch = []
+        index.add(batch)
+        added += len(batch)
+    return added, unchanged, failed
+########################################################################################################################
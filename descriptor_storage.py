@@ -0,0 +1,227 @@
+import csv
+from collections import OrderedDict
+import numpy as np
+from pathlib import Path
+
+
+########################################################################################################################
+# Descriptor dtypes for each fingerprint algorithm. Binary descriptors (ORB, AKAZE) are packed bits stored as bytes,
+# float descriptors (SIFT, SURF) are 32-bit floats. Storing them natively keeps the dtype and allows mmap loading.
+DESCRIPTOR_DTYPES = {
+    'surf': np.float32,
+    'sift': np.float32,
+    'orb': np.uint8,
+    'akaze': np.uint8
+}
+# the strongest keypoints are also stored on their own (type "mask_top"), for the first stage of cascade crossmatching
+TOP_KEYPOINTS = 100
+########################################################################################################################
+
+
+########################################################################################################################
+def descriptor_path(fingerprint_dir, name, algorithm, type="mask", extension="npy"):
+    """Path of the descriptor file for one image and one algorithm, e.g. fingerprints/NAME/NAME_orb_mask.npy"""
+    return Path(fingerprint_dir) / name / f"{name}_{algorithm}_{type}.{extension}"
+
+def save_descriptors(fingerprint_dir, name, algorithm, descriptors, type="mask"):
+    """Save a descriptor matrix in binary .npy format, keeping the algorithm's native dtype."""
+    if descriptors is None or len(descriptors) == 0:
+        raise ValueError(f"No {algorithm} keypoints were detected in {name}")
+    descriptors = np.ascontiguousarray(descriptors, dtype=DESCRIPTOR_DTYPES[algorithm])
+    np.save(descriptor_path(fingerprint_dir, name, algorithm, type), descriptors)
+
+def strongest_descriptors(keypoints, descriptors, n=TOP_KEYPOINTS):
+    """Descriptor rows of the n keypoints with the strongest detector response, strongest first."""
+    responses = np.array([keypoint.response for keypoint in keypoints])
+    return descriptors[np.argsort(-responses, kind='stable')[:n]]
+
+def load_descriptors(fingerprint_dir, name, algorithm, type="mask", mmap=True, pack_dir=None):
+    """
+    Load a descriptor matrix for one image. If pack_dir is given and holds a pack for this algorithm containing the
+    image, the descriptors are sliced from the memory-mapped pack. Otherwise binary .npy files are memory-mapped by
+    default; legacy .txt files written by older versions of the pipeline are still read (slowly) so that unconverted
+    projects keep working.
+    """
+    if pack_dir is not None:
+        pack = open_pack(pack_dir, algorithm, type)
+        if name in pack:
+            return pack.load(name)
+
+    npy_path = descriptor_path(fingerprint_dir, name, algorithm, type)
+    if npy_path.exists():
+        return np.load(npy_path, mmap_mode='r' if mmap else None)
+
+    txt_path = descriptor_path(fingerprint_dir, name, algorithm, type, extension="txt")
+    return np.loadtxt(str(txt_path), ndmin=2).astype(DESCRIPTOR_DTYPES[algorithm])
+########################################################################################################################
+
+
+########################################################################################################################
+# one-off migration of text descriptor files to the binary format. see convert_descriptor_files.py
+def convert_text_descriptors(fingerprint_dir, remove_text=False):
+    """
+    Convert every {name}_{algorithm}_{type}.txt descriptor file under fingerprint_dir to .npy.
+    Returns a tuple of (number converted, list of (path, error message) for files that could not be converted).
+    """
+    converted = 0
+    failed = []
+    for txt_path in sorted(Path(fingerprint_dir).glob("*/*.txt")):
+        parts = txt_path.stem.split("_")
+        # file names are {name}_{algorithm}_{type}, where name itself contains underscores
+        if len(parts) < 3 or parts[-2] not in DESCRIPTOR_DTYPES:
+            continue
+        algorithm = parts[-2]
+        try:
+            descriptors = np.loadtxt(str(txt_path), ndmin=2).astype(DESCRIPTOR_DTYPES[algorithm])
+            np.save(txt_path.with_suffix(".npy"), descriptors)
+            if remove_text:
+                txt_path.unlink()
+            converted += 1
+        except Exception as e:
+            failed.append((txt_path, str(e)))
+    return converted, failed
+########################################################################################################################
+
+
+########################################################################################################################
+# Optional "pack" mode: one append-only binary file per algorithm holding every image's descriptors, plus a small index
+# of name -> (byte offset, rows, cols). Comparisons memory-map the pack once per worker instead of opening one small
+# file per image per pair. Packs live in BASE_DIR/descriptor_packs so they don't show up as fingerprint folders.
+class DescriptorPack:
+    def __init__(self, pack_dir, algorithm, type="mask"):
+        self.algorithm = algorithm
+        self.dtype = np.dtype(DESCRIPTOR_DTYPES[algorithm])
+        self.pack_path = Path(pack_dir) / f"{algorithm}_{type}.pack"
+        self.index_path = Path(pack_dir) / f"{algorithm}_{type}_index.csv"
+        self._index = None
+        self._buffer = None
+
+    def exists(self):
+        return self.index_path.exists() and self.pack_path.exists()
+
+    @property
+    def index(self):
+        """name -> (offset, rows, cols). Later entries supersede earlier ones for re-extracted fingerprints."""
+        if self._index is None:
+            self._index = {}
+            if self.index_path.exists():
+                with open(self.index_path, newline='') as f:
+                    for row in csv.DictReader(f):
+                        self._index[row["name"]] = (int(row["offset"]), int(row["rows"]), int(row["cols"]))
+        return self._index
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self, name):
+        """Return a read-only view of one image's descriptors, mapping the pack file on first use."""
+        offset, rows, cols = self.index[name]
+        if self._buffer is None or offset + rows * cols * self.dtype.itemsize > len(self._buffer):
+            self._buffer = np.memmap(self.pack_path, dtype=np.uint8, mode='r')
+        nbytes = rows * cols * self.dtype.itemsize
+        return self._buffer[offset:offset + nbytes].view(self.dtype).reshape(rows, cols)
+
+    def append(self, name, descriptors):
+        """Append one image's descriptors to the end of the pack without rewriting existing data."""
+        descriptors = np.ascontiguousarray(descriptors, dtype=self.dtype)
+        if descriptors.ndim != 2 or len(descriptors) == 0:
+            raise ValueError(f"Cannot pack empty {self.algorithm} descriptors for {name}")
+        self.pack_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.pack_path, 'ab') as f:
+            offset = f.tell()
+            f.write(descriptors.tobytes())
+        # the index row is written after the data, so an interrupted append only leaves unreferenced bytes behind
+        new_index = not self.index_path.exists()
+        with open(self.index_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if new_index:
+                writer.writerow(["name", "offset", "rows", "cols"])
+            writer.writerow([name, offset, descriptors.shape[0], descriptors.shape[1]])
+        self.index[name] = (offset, descriptors.shape[0], descriptors.shape[1])
+
+
+# packs opened by this process, so each pool worker maps a pack only once
+_open_packs = {}
+
+def open_pack(pack_dir, algorithm, type="mask"):
+    key = (str(pack_dir), algorithm, type)
+    if key not in _open_packs:
+        _open_packs[key] = DescriptorPack(pack_dir, algorithm, type)
+    return _open_packs[key]
+
+def pack_fingerprints(fingerprint_dir, pack_dir, names, algorithms, type="mask"):
+    """
+    Append the per-image descriptor files of the given images to each algorithm's pack. Images already packed with
+    identical descriptors are skipped, so re-running over a whole folder only adds new or re-extracted fingerprints.
+    Returns a tuple of (number appended, number unchanged, list of (name, algorithm, error message)).
+    """
+    appended = 0
+    unchanged = 0
+    failed = []
+    for algorithm in algorithms:
+        pack = DescriptorPack(pack_dir, algorithm, type)
+        for name in names:
+            try:
+                descriptors = load_descriptors(fingerprint_dir, name, algorithm, type)
+                if name in pack and np.array_equal(pack.load(name), descriptors):
+                    unchanged += 1
+                    continue
+                pack.append(name, descriptors)
+                appended += 1
+            except FileNotFoundError:
+                continue  # this algorithm was never extracted for this image
+            except Exception as e:
+                failed.append((name, algorithm, str(e)))
+    return appended, unchanged, failed
+########################################################################################################################
+
+
+########################################################################################################################
+# Per-process LRU cache of decoded descriptors. In a comparison run the same focal image takes part in thousands of
+# pairs, so each pool worker keeps recently used descriptor matrices in memory up to a fixed budget.
+class DescriptorCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, fingerprint_dir, name, algorithm, type="mask", pack_dir=None):
+        """Return the descriptors for (name, algorithm), loading and caching them on a miss."""
+        key = (name, algorithm, type)
+        if key in self._entries:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        self.misses += 1
+        # copy out of the memory map so repeated use doesn't touch the file again
+        descriptors = np.array(load_descriptors(fingerprint_dir, name, algorithm, type, pack_dir=pack_dir))
+        if descriptors.nbytes <= self.max_bytes:
+            self._entries[key] = descriptors
+            self.current_bytes += descriptors.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+                self.evictions += 1
+        return descriptors
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def summarise_cache_stats(task_stats):
+    """Sum the cache counts reported by each task and add the overall hit rate."""
+    totals = {'hits': 0, 'misses': 0, 'evictions': 0}
+    for stats in task_stats:
+        for key in totals:
+            totals[key] += stats[key]
+    lookups = totals['hits'] + totals['misses']
+    totals['hit_rate'] = totals['hits'] / lookups if lookups else 0.0
+    return totals
+########################################################################################################################
@@ -0,0 +1,40 @@
+import datetime
+import sys
+from pathlib import Path
+from synthetic_beetles import generate_dataset
+from pipeline_options import split_arguments
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+# the project folder to fill with synthetic photos, created if it does not exist. Its user_parameters.csv, if it has
+# one, sets the patch colours (HSV thresholds) and the number of patches
+BASE_DIR = Path(sys.argv[1])
+# optional --name=value settings, e.g. --individuals=200 --recaptures=2
+_, options = split_arguments(sys.argv[2:])
+n_individuals = int(options.get("individuals", 50))
+# captures after the first, per individual
+recaptures = int(options.get("recaptures", 1))
+photos_per_encounter = int(options.get("photos", 2))
+width = int(options.get("width", 1000))
+height = int(options.get("height", 1500))
+# length of the field season in days, encounter dates are spread over it
+season_days = int(options.get("days", 60))
+seed = int(options.get("seed", 0))
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Synthetic_project"
+#n_individuals = 50
+########################################################################################################################
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    truth = generate_dataset(BASE_DIR, n_individuals, recaptures, photos_per_encounter, width, height, season_days,
+                             seed)
+    print(f"{len(truth)} photos of {truth['encounter'].nunique()} encounters of {n_individuals} individuals written "
+          f"to {BASE_DIR / 'unprocessed_photos'} in {datetime.datetime.now() - start_time}")
+    print(f"Encounter lists: data/focal.csv and data/test.csv. Ground truth: data/synthetic_ground_truth.csv")
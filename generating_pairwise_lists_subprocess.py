@@ -5,6 +5,8 @@ import csv
 import datetime
 from datetime import date
 import sys
+from progress_status import ProgressReporter
+from pipeline_metrics import stage_clock, record_stage
 
 
 ########################################################################################################################
@@ -43,6 +45,7 @@ def get_list_focal_examples(images_list):
     for i in range(0,len(list_focal)):
         matching = [s for s in images_list if s.split("_")[0] == list_focal[i].split("_")[0] and s.split("_")[1] == list_focal[i].split("_")[1]]
         list_focal_examples.append(matching)
+        progress.advance()
 
     return list_focal, list_focal_examples
 
@@ -84,6 +87,7 @@ def get_list_test(focal_df, query_df, size_offset, filter_by_sex, filter_by_size
             refined = query_df
 
         list_test.append(refined.iloc[:, 0])
+        progress.advance()
 
     return list_test
 
@@ -98,6 +102,7 @@ def get_list_test_examples(list_test, images_list):
             temp.append(matching)
         flat_list = [item for sublist in temp for item in sublist]
         list_test_examples.append(flat_list)
+        progress.advance()
 
         for i in range(len(list_test_examples)):
             if not list_test_examples[i]:
@@ -106,8 +111,11 @@ def get_list_test_examples(list_test, images_list):
     return list_test_examples
 
 def generate_lists(images_list, focal_df, query_df, size_offset, filter_by_sex, filter_by_size, date_filter):
+    progress.start_stage("Finding photos of focal individuals", len(focal_df))
     list_focal, list_focal_examples = get_list_focal_examples(images_list)
+    progress.start_stage("Filtering candidate individuals", len(focal_df))
     list_test = get_list_test(focal_df, query_df, size_offset, filter_by_sex, filter_by_size, date_filter)
+    progress.start_stage("Finding photos of candidate individuals", len(list_test))
     list_test_examples = get_list_test_examples(list_test, images_list)
 
     return list_focal_examples, list_test_examples
@@ -121,12 +129,18 @@ def product_of_matches(nested_list_1, nested_list_2, i):
 
 if __name__ == '__main__':
     start_time = datetime.datetime.now()
+    clock = stage_clock()
     print("Generating pairwise list - this may take some time!")
+    # live progress for the Batch Processing page
+    progress = ProgressReporter(BASE_DIR, "pairwise_list", "Generate pairwise list")
     list_focal_examples, list_test_examples = generate_lists(images_list, focal_df, query_df, size_offset, filter_by_sex, filter_by_size, date_filter)
 
     pairs = [['focal_image', 'test_image']]
+    progress.start_stage("Pairing photos", len(list_focal_examples))
     for i in range(len(list_focal_examples)):
         product_of_matches(list_focal_examples, list_test_examples, i)
+        progress.advance()
+    progress.start_stage("Writing the pairwise list")
 
     # Convert pairs list to DataFrame
     df_pairs = pd.DataFrame(pairs[1:], columns=['focal_image', 'test_image'])
@@ -145,6 +159,7 @@ if __name__ == '__main__':
     # Save the updated DataFrame
     output_file = BASE_DIR / "data" / f"pairwise_comparison_list_{date.today()}.csv"
     df_pairs.to_csv(output_file, index=False)
+    progress.finish()
 
     processing_time = datetime.datetime.now() - start_time
     # print the time taken to process all images
@@ -152,4 +167,9 @@ if __name__ == '__main__':
 
     timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
     with open(timing_log_file, 'a') as f:
-        f.write(f'\n Generating pairwise comparisons - {str(len(pairs) - 1)} matches processed in {str(processing_time)} minutes. {date.today()} \n')
\ No newline at end of file
+        f.write(f'\n Generating pairwise comparisons - {str(len(pairs) - 1)} matches processed in {str(processing_time)} minutes. {date.today()} \n')
+
+    record_stage(BASE_DIR, "pairwise_list", clock, len(df_pairs),
+                 parameters={'focal_file': focal_file, 'test_file': test_file, 'filter_by_sex': filter_by_sex,
+                             'filter_by_size': filter_by_size, 'date_filter': date_filter, 'size_offset': size_offset},
+                 focal_individuals=len(focal_df), images=len(images_list))
\ No newline at end of file
@@ -0,0 +1,184 @@
+import cv2 as cv
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from descriptor_storage import DESCRIPTOR_DTYPES, descriptor_path, load_descriptors
+
+
+########################################################################################################################
+# Cheap global signatures for coarse-to-fine crossmatching. A visual vocabulary is trained once per project and
+# algorithm by k-means over a sample of stored descriptors. Each image's signature is then its tf-idf weighted
+# bag-of-visual-words histogram, normalised to unit length, so the similarity of two images is a single dot product.
+# Only the most similar candidates of each focal image go on to full descriptor matching.
+# Vocabularies and signatures live in BASE_DIR/descriptor_signatures.
+
+# number of visual words, and how many descriptors of how many images are sampled to train them
+VOCABULARY_WORDS = 256
+TRAINING_DESCRIPTORS_PER_IMAGE = 100
+TRAINING_IMAGES = 1000
+
+def signature_dir(BASE_DIR):
+    return Path(BASE_DIR) / "descriptor_signatures"
+
+def descriptor_features(descriptors, algorithm):
+    """Descriptors as float32 rows. Binary descriptors are unpacked to 0/1 bits, so L2 distance is Hamming distance."""
+    if DESCRIPTOR_DTYPES[algorithm] == np.uint8:
+        return np.unpackbits(np.asarray(descriptors, dtype=np.uint8), axis=1).astype(np.float32)
+    return np.asarray(descriptors, dtype=np.float32)
+
+def assign_words(features, words):
+    """Index of the nearest visual word for every descriptor, using squared distances from one matrix product."""
+    distances = (words ** 2).sum(axis=1) - 2 * features @ words.T
+    return distances.argmin(axis=1)
+
+def descriptor_mtime(fingerprint_dir, name, algorithm, type="mask"):
+    """Modification time of an image's descriptor file, or None if it has none."""
+    for extension in ("npy", "txt"):
+        path = descriptor_path(fingerprint_dir, name, algorithm, type, extension)
+        if path.exists():
+            return path.stat().st_mtime
+    return None
+########################################################################################################################
+
+
+########################################################################################################################
+class SignatureStore:
+    """
+    Vocabulary and signatures for one algorithm. Files are tagged with the detector-parameter hash from
+    score_store.detector_parameter_hash, so fingerprints extracted with other settings get their own vocabulary.
+    Signatures are cached with the modification time of each image's descriptor file and recomputed when it changes.
+    """
+    def __init__(self, signature_dir, algorithm, params_hash, type="mask"):
+        self.signature_dir = Path(signature_dir)
+        self.algorithm = algorithm
+        self.type = type
+        self.vocabulary_path = self.signature_dir / f"{algorithm}_{type}_{params_hash}_vocabulary.npz"
+        self.signatures_path = self.signature_dir / f"{algorithm}_{type}_{params_hash}_signatures.npz"
+        self.words = None
+        self.idf = None
+
+    def _features(self, fingerprint_dir, name, pack_dir):
+        descriptors = load_descriptors(fingerprint_dir, name, self.algorithm, self.type, pack_dir=pack_dir)
+        return descriptor_features(descriptors, self.algorithm)
+
+    def load_or_train(self, fingerprint_dir, names, pack_dir=None):
+        """Load the project's vocabulary, training it from the given images the first time."""
+        if self.vocabulary_path.exists():
+            with np.load(self.vocabulary_path) as vocabulary:
+                self.words = vocabulary['words']
+                self.idf = vocabulary['idf']
+        else:
+            self.train(fingerprint_dir, names, pack_dir)
+
+    def train(self, fingerprint_dir, names, pack_dir=None):
+        """Train the vocabulary by k-means over a random sample of descriptors from the given images."""
+        rng = np.random.default_rng(0)
+        names = sorted(names)
+        if len(names) > TRAINING_IMAGES:
+            names = [names[i] for i in sorted(rng.choice(len(names), TRAINING_IMAGES, replace=False))]
+        samples = []
+        for name in names:
+            try:
+                features = self._features(fingerprint_dir, name, pack_dir)
+            except Exception:
+                continue  # images without usable descriptors are left out of training
+            if len(features) > TRAINING_DESCRIPTORS_PER_IMAGE:
+                features = features[rng.choice(len(features), TRAINING_DESCRIPTORS_PER_IMAGE, replace=False)]
+            samples.append(features)
+        if not samples:
+            raise ValueError(f"No {self.algorithm} descriptors available to train a visual vocabulary")
+
+        cv.setRNGSeed(0)
+        training = np.concatenate(samples)
+        criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 20, 0.01)
+        _, _, self.words = cv.kmeans(training, min(VOCABULARY_WORDS, len(training)), None, criteria, 1,
+                                     cv.KMEANS_PP_CENTERS)
+
+        # inverse document frequency over the sampled images, so words common to every pattern count for little
+        document_frequency = np.zeros(len(self.words))
+        for features in samples:
+            document_frequency[np.unique(assign_words(features, self.words))] += 1
+        self.idf = np.log((1 + len(samples)) / (1 + document_frequency)).astype(np.float32)
+
+        self.signature_dir.mkdir(parents=True, exist_ok=True)
+        np.savez(self.vocabulary_path, words=self.words, idf=self.idf)
+
+    def signature(self, features):
+        """Unit-length tf-idf bag-of-words vector for one image's descriptors."""
+        histogram = np.bincount(assign_words(features, self.words), minlength=len(self.words)) * self.idf
+        norm = np.linalg.norm(histogram)
+        return (histogram / norm if norm > 0 else histogram).astype(np.float32)
+
+    def signatures(self, fingerprint_dir, names, pack_dir=None):
+        """
+        Signatures of the given images as a (names, words) array, with NaN rows for images without descriptors.
+        Cached signatures are reused while the image's descriptor file is unchanged; new ones are added to the cache.
+        """
+        cached = {}
+        if self.signatures_path.exists():
+            with np.load(self.signatures_path, allow_pickle=False) as cache:
+                cached = {name: (mtime, vector) for name, mtime, vector in
+                          zip(cache['names'], cache['mtimes'], cache['vectors'])}
+
+        result = np.full((len(names), len(self.words)), np.nan, dtype=np.float32)
+        updated = False
+        for i, name in enumerate(names):
+            mtime = descriptor_mtime(fingerprint_dir, name, self.algorithm, self.type)
+            if mtime is None:
+                continue
+            if name in cached and cached[name][0] == mtime:
+                result[i] = cached[name][1]
+                continue
+            try:
+                result[i] = self.signature(self._features(fingerprint_dir, name, pack_dir))
+            except Exception:
+                continue  # left as NaN, the pair then goes to full matching and its error is logged there
+            cached[name] = (mtime, result[i])
+            updated = True
+
+        if updated:
+            cached_names = list(cached)
+            np.savez(self.signatures_path, names=np.array(cached_names, dtype=str),
+                     mtimes=np.array([cached[name][0] for name in cached_names]),
+                     vectors=np.stack([cached[name][1] for name in cached_names]))
+        return result
+########################################################################################################################
+
+
+########################################################################################################################
+def top_k_candidates(pairs, names, signatures, k, chunk_size=100000):
+    """
+    Boolean mask over a frame of focal_image/test_image pairs, keeping the k test images whose signatures are most
+    similar to each focal image's. Pairs where either image has no signature are always kept, so they are never
+    dropped silently. signatures is aligned with names, as returned by SignatureStore.signatures.
+    """
+    positions = pd.Series(np.arange(len(names)), index=names)
+    focal = positions.reindex(pairs['focal_image']).to_numpy()
+    test = positions.reindex(pairs['test_image']).to_numpy()
+    missing = np.isnan(focal) | np.isnan(test)
+    focal = np.where(missing, 0, focal).astype(np.int64)
+    test = np.where(missing, 0, test).astype(np.int64)
+
+    # cosine similarity, chunk by chunk to bound memory for long pair lists
+    similarity = np.empty(len(pairs))
+    for start in range(0, len(pairs), chunk_size):
+        end = start + chunk_size
+        similarity[start:end] = np.einsum('ij,ij->i', signatures[focal[start:end]], signatures[test[start:end]])
+    similarity[missing] = np.nan
+
+    ranks = pd.Series(similarity).groupby(pairs['focal_image'].to_numpy()).rank(method='first', ascending=False)
+    return (ranks.to_numpy() <= k) | np.isnan(similarity)
+
+def prefilter_pairwise_list(df, signature_store, fingerprint_dir, k, pack_dir=None):
+    """
+    Keep only the rows of a pairwise list whose test image is among the k most similar to its focal image, training
+    the vocabulary on the list's images if the project has none yet. Returns the filtered list with a fresh index.
+    """
+    pairs = df.loc[~df.duplicated(['focal_image', 'test_image']), ['focal_image', 'test_image']]
+    names = pd.unique(pairs[['focal_image', 'test_image']].to_numpy().ravel())
+    signature_store.load_or_train(fingerprint_dir, names, pack_dir)
+    signatures = signature_store.signatures(fingerprint_dir, names, pack_dir)
+    kept_pairs = pd.MultiIndex.from_frame(pairs[top_k_candidates(pairs, names, signatures, k)])
+    kept_rows = pd.MultiIndex.from_frame(df[['focal_image', 'test_image']]).isin(kept_pairs)
+    return df[kept_rows].reset_index(drop=True)
+########################################################################################################################
@@ -0,0 +1,125 @@
+import numpy as np
+
+
+########################################################################################################################
+# Vectorised alternatives to the per-pair cv.BFMatcher functions in comparison_engine.py. Each kernel scores one focal
+# descriptor matrix against a whole list of test matrices at once and returns the same value as the matching pairwise_*
+# function: the mean distance of cross-checked (mutual nearest neighbour) matches, in focal descriptor order.
+# Pairs without a single cross-checked match get NaN, where the BFMatcher functions raise a division by zero.
+
+# distance-matrix entries computed per block of test images (about 128 MB in float64)
+BLOCK_ELEMENTS = 2 ** 24
+# number of set bits in every byte value, for numpy versions without np.bitwise_count
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def test_blocks(test_sizes, focal_size, block_elements=BLOCK_ELEMENTS):
+    """Split test images into blocks whose stacked descriptors, against the focal descriptors, fit the block budget."""
+    block = []
+    block_rows = 0
+    for i, rows in enumerate(test_sizes):
+        if block and (block_rows + rows) * focal_size > block_elements:
+            yield block
+            block = []
+            block_rows = 0
+        block.append(i)
+        block_rows += rows
+    if block:
+        yield block
+
+def cross_check_mean(distances, matched_distance):
+    """
+    Mean distance of the mutual nearest neighbours in a (focal, test) distance matrix. Ties go to the lowest index, as
+    in BFMatcher. matched_distance(focal rows, test rows) gives the exact reported distance of the matched pairs.
+    """
+    forward = distances.argmin(axis=1)
+    reverse = distances.argmin(axis=0)
+    matched = np.flatnonzero(reverse[forward] == np.arange(len(forward)))
+    if not len(matched):
+        return np.nan
+    # BFMatcher reports float32 distances, which pairwise_* then add up one by one in double precision
+    matched_distances = matched_distance(matched, forward[matched]).astype(np.float32)
+    return np.cumsum(matched_distances, dtype=np.float64)[-1] / len(matched)
+########################################################################################################################
+
+
+########################################################################################################################
+def l2_cross_check_scores(focal, tests):
+    """
+    Scores for pairwise_sift/pairwise_surf. The squared L2 distances of a whole block of test images come from one
+    matrix product using precomputed norms, |x|^2 + |y|^2 - 2 x.y. The product is taken in float64, which is exact for
+    SIFT (whole-number descriptor values), so nearest neighbours and ties come out as in BFMatcher. The matched
+    distances are then recomputed directly. Returns a float64 array aligned with tests.
+    """
+    focal = np.asarray(focal, dtype=np.float64)
+    focal_norms = np.square(focal).sum(axis=1)
+    scores = np.full(len(tests), np.nan)
+
+    for block in test_blocks([len(test) for test in tests], len(focal)):
+        stacked = np.concatenate([np.asarray(tests[i], dtype=np.float64) for i in block])
+        squared = focal_norms[:, None] + np.square(stacked).sum(axis=1)[None, :] - 2 * (focal @ stacked.T)
+
+        start = 0
+        for i in block:
+            end = start + len(tests[i])
+            test = stacked[start:end]
+            scores[i] = cross_check_mean(
+                squared[:, start:end],
+                lambda focal_rows, test_rows: np.sqrt(np.square(focal[focal_rows] - test[test_rows]).sum(axis=1)))
+            start = end
+    return scores
+########################################################################################################################
+
+
+########################################################################################################################
+def packed_words(descriptors):
+    """Binary descriptor rows viewed as uint64 words, zero-padded to whole words (e.g. AKAZE's 61 bytes to 64)."""
+    descriptors = np.ascontiguousarray(descriptors, dtype=np.uint8)
+    padding = -descriptors.shape[1] % 8
+    if padding:
+        descriptors = np.ascontiguousarray(np.pad(descriptors, ((0, 0), (0, padding))))
+    return descriptors.view(np.uint64)
+
+def popcount(words):
+    """Number of set bits in every uint64 word."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    return POPCOUNT[words.view(np.uint8)].reshape(*words.shape, 8).sum(axis=-1, dtype=np.uint8)
+
+def hamming_distances(focal_words, test_words, rows=64):
+    """
+    (focal, test) matrix of Hamming distances from XOR and popcount, one 64-bit word column at a time. Focal rows are
+    processed a few at a time so the temporary arrays stay in cache.
+    """
+    distances = np.empty((len(focal_words), len(test_words)), dtype=np.uint16)
+    test_columns = np.ascontiguousarray(test_words.T)
+    xor = np.empty((rows, len(test_words)), dtype=np.uint64)
+    for start in range(0, len(focal_words), rows):
+        block = distances[start:start + rows]
+        block[:] = 0
+        n = len(block)
+        for k in range(focal_words.shape[1]):
+            np.bitwise_xor(focal_words[start:start + n, k, None], test_columns[k][None, :], out=xor[:n])
+            block += popcount(xor[:n])
+    return distances
+
+def hamming_cross_check_scores(focal, tests):
+    """
+    Scores for pairwise_orb/pairwise_akaze. Hamming distances to a whole block of test images are computed at once
+    on descriptors packed into 64-bit words. Distances are whole numbers, so ties are common; like BFMatcher they go to
+    the lowest index in both directions. Returns a float64 array aligned with tests.
+    """
+    focal_words = packed_words(focal)
+    scores = np.full(len(tests), np.nan)
+
+    for block in test_blocks([len(test) for test in tests], len(focal)):
+        distances = hamming_distances(focal_words, np.concatenate([packed_words(tests[i]) for i in block]))
+
+        start = 0
+        for i in block:
+            end = start + len(tests[i])
+            pair_distances = distances[:, start:end]
+            scores[i] = cross_check_mean(pair_distances,
+                                         lambda focal_rows, test_rows: pair_distances[focal_rows, test_rows])
+            start = end
+    return scores
+########################################################################################################################
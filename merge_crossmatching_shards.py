@@ -0,0 +1,72 @@
+import datetime
+import sys
+from datetime import date
+from pathlib import Path
+import pandas as pd
+import os
+from comparison_results import merge_shard_results, filter_lowest_n_streaming
+from pipeline_options import split_arguments
+from pipeline_metrics import stage_clock, record_stage
+
+########################################################################################################################
+########################################## GUI-DEFINED PATHS AND VALUES ################################################
+BASE_DIR = Path(sys.argv[1])
+# the pairwise list that was crossmatched in shards (parallel_crossmatching_subprocess.py with --shard-count)
+df_path = sys.argv[2]
+# --shard-count=n picks which set of shards to merge, if the list was sharded more than one way
+_, options = split_arguments(sys.argv[3:])
+shard_count = options.get("shard_count")
+########################################################################################################################
+
+
+########################################################################################################################
+########################################### MANUALLY DEFINE PATHS AND VALUES ###########################################
+# Define base project directory
+#BASE_DIR = Path.home() / "Documents/Project_name"
+#df_path = "pairwise_comparison_list_2025-01-01.csv"
+########################################################################################################################
+
+# Load user-set parameters
+df = pd.read_csv(os.path.join(BASE_DIR, "data/user_parameters.csv"))
+# Convert to dictionary (keys = parameters, values = converted numbers)
+params = {row["Parameter"]: float(row["Value"]) for _, row in df.iterrows()}
+filtered_n = int(params["number_comparisons_considered"])
+
+
+if __name__ == '__main__':
+    start_time = datetime.datetime.now()
+    clock = stage_clock()
+
+    shard_pattern = f"comparison_shard_{Path(df_path).stem}_*of{shard_count or '*'}.csv"
+    shard_files = sorted((BASE_DIR / "data").glob(shard_pattern))
+    if not shard_files:
+        raise FileNotFoundError(f"No shard results found for {df_path} in {BASE_DIR / 'data'}")
+    shard_counts = sorted({shard_file.stem.rpartition("of")[2] for shard_file in shard_files})
+    if len(shard_counts) > 1:
+        raise ValueError(f"{df_path} was sharded into {' and '.join(shard_counts)} shards, "
+                         f"choose a set with --shard-count")
+    print(f"Merging {len(shard_files)} shards: {', '.join(shard_file.name for shard_file in shard_files)}")
+
+    # the same comparison_results file a single run would have written, rows in pairwise list order
+    output_file = BASE_DIR / 'data' / f'comparison_results_{date.today()}.csv'
+    descriptions = merge_shard_results(shard_files, output_file)
+    if descriptions[0]['number_comparisons_considered'] != filtered_n:
+        print(f"Note: the shards were run with number_comparisons_considered = "
+              f"{descriptions[0]['number_comparisons_considered']}, the results are filtered to {filtered_n}")
+
+    # Keep the N best matches per focal name for each algorithm, reading the results back chunk by chunk
+    filtered_df = filter_lowest_n_streaming(output_file, filtered_n)
+    filtered_output_file = BASE_DIR / 'data' / f'filtered_comparison_results_{date.today()}.csv'
+    filtered_df.to_csv(filtered_output_file, index=False)
+
+    processing_time = datetime.datetime.now() - start_time
+    print("Time taken: ", processing_time)
+
+    timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
+    with open(timing_log_file, 'a') as f:
+        f.write(f'\n Shard merge - {len(shard_files)} shards of {df_path} merged '
+                f'({descriptions[0]["total_rows"]} rows) in {processing_time} minutes. {date.today()} \n')
+
+    record_stage(BASE_DIR, "shard_merge", clock, descriptions[0]['total_rows'],
+                 parameters={'pairwise_list': df_path, 'number_comparisons_considered': filtered_n},
+                 shards=len(shard_files))
@@ -1,4 +1,3 @@
-import cv2 as cv
 import datetime
 import sys
 import csv
@@ -7,15 +6,73 @@ import numpy as np
 from pathlib import Path
 import pandas as pd
 import multiprocessing
+from descriptor_storage import summarise_cache_stats
+from comparison_engine import (MATCHERS, init_worker, run_missing_results, summarise_worker_utilisation,
+                               count_missing_results, batch_counts, record_result_batch, symmetric_pairs,
+                               comparison_columns, comparison_map)
+from comparison_results import (result_stream_path, start_result_stream, load_result_stream, append_result_batch,
+                                append_reused_results, write_comparison_results, filter_lowest_n_streaming,
+                                shard_rows, shard_path, write_shard_results)
+from score_store import ScoreStore, score_store_path, detector_parameter_hash, load_stored_scores, save_result_batch
+from image_signatures import SignatureStore, signature_dir, prefilter_pairwise_list
+from comparison_cascade import (CASCADE_TYPE, shortlist_size, per_focal_shortlist, sample_focal_names,
+                                cascade_recall)
+from pipeline_options import split_arguments
+from progress_status import ProgressReporter
+from pipeline_metrics import stage_clock, record_stage
 import os
 
 ########################################################################################################################
 ########################################## GUI-DEFINED PATHS AND VALUES ################################################
 BASE_DIR = Path(sys.argv[1])
 df_path = sys.argv[2]
-comparison_types = sys.argv[3:]  # All remaining arguments are types of comparison to run
+# All remaining arguments are types of comparison to run, plus optional --name=value engine settings
+comparison_types, options = split_arguments(sys.argv[3:])
+# memory budget (MB) for each worker's cache of decoded descriptors
+cache_mb = float(options.get("cache_mb", 256))
+# number of worker processes, one per core unless --workers is given
+n_workers = int(options.get("workers", multiprocessing.cpu_count()))
+# --matcher=vectorised scores pairs in blocks with numpy (see matching_kernels.py) instead of one cv.BFMatcher per pair
+matcher = options.get("matcher", "bfmatcher")
+if matcher not in MATCHERS:
+    raise ValueError(f"Unknown matcher {matcher}, expected one of: {', '.join(MATCHERS)}")
+# --resume picks up from this pairwise list's result stream, recomputing only the missing pair/algorithm results.
+# --resume=other_list.csv reuses the results streamed for a different pairwise list instead
+resume = options.get("resume", False)
+# scores are looked up in, and saved to, the project's persistent score store unless --no-score-store is given
+use_score_store = not options.get("no_score_store", False)
+# --prefilter-k=K only sends each focal image's K most similar candidates (by bag-of-words signature, see
+# image_signatures.py) to full matching. --prefilter-algorithm picks the signature's descriptors (default: first type)
+prefilter_k = int(options.get("prefilter_k", 0))
+prefilter_algorithm = options.get("prefilter_algorithm")
+if prefilter_k and not prefilter_algorithm:
+    if not comparison_types:
+        raise ValueError("--prefilter-k needs a comparison type or --prefilter-algorithm")
+    prefilter_algorithm = comparison_map[comparison_types[0]]['suffix']
+# --cascade scores all pairs on their strongest keypoints first, then fully matches only each focal name's best
+# number_comparisons_considered x cascade_margin candidates (see comparison_cascade.py). Pairs left out are written
+# as NA. --cascade-recall is the share of focal names also scored exhaustively, to report the cascade's recall
+cascade = options.get("cascade", False)
+cascade_margin = float(options.get("cascade_margin", 3))
+cascade_recall_fraction = float(options.get("cascade_recall", 0.05))
+# --rank-by=orb_compare scores every pair with one (cheap) comparison type, and the other types only on its best
+# number_comparisons_considered x cascade_margin candidates per focal name. Their other values are written as NA
+rank_by = options.get("rank_by")
+if rank_by and rank_by not in comparison_types:
+    raise ValueError(f"--rank-by must be one of the chosen comparison types: {', '.join(comparison_types)}")
+# --shard-index=i --shard-count=n only compares shard i (counted from 1) of n, a fixed share of the focal names, and
+# writes a partial results file instead of the final results. merge_crossmatching_shards.py combines the shards
+sharded = "shard_count" in options
+shard_count = int(options.get("shard_count", 1))
+shard_index = int(options.get("shard_index", 1))
+if not 1 <= shard_index <= shard_count:
+    raise ValueError(f"--shard-index must be between 1 and --shard-count ({shard_count}), got {shard_index}")
 # Define the target subdirectory (should only be fingerprints)
 directory = "fingerprints"
+# Optional consolidated descriptor packs (see descriptor_storage.py). Used whenever the project has built them
+pack_dir = BASE_DIR / "descriptor_packs"
+if not pack_dir.exists():
+    pack_dir = None
 
 # Load user-set parameters for fingerprint extraction
 df = pd.read_csv(os.path.join(BASE_DIR, "data/user_parameters.csv"))
@@ -24,126 +81,31 @@ params = {row["Parameter"]: float(row["Value"]) for _, row in df.iterrows()}
 
 # variable defining how much uncertainty in individual size i will accept for comparisons.
 filtered_n = int(params["number_comparisons_considered"])
+# detector settings for each algorithm, so stored scores are only reused for fingerprints extracted the same way
+params_hashes = {}
+for comp_type in comparison_types:
+    suffix = comparison_map[comp_type]['suffix']
+    params_hashes[f"{suffix}_values"] = detector_parameter_hash(params, suffix)
 ########################################################################################################################
 
 
-########################################################################################################################
-def pairwise_surf(x, y):
-    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
-    matches_surf = bf.match(x, y)
-    dist = [m.distance for m in matches_surf]
-    values = sum(dist) / len(dist)
-    return values
-
-def pairwise_sift(x, y):
-    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
-    matches_sift = bf.match(x, y)
-    dist = [m.distance for m in matches_sift]
-    values = sum(dist) / len(dist)
-    return values
-
-def pairwise_orb(x, y):
-    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
-    matches_orb = bf.match(x, y)
-    dist = [m.distance for m in matches_orb]
-    values = sum(dist) / len(dist)
-    return values
-
-def pairwise_akaze(x, y):
-    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
-    matches_akaze = bf.match(x, y)
-    dist = [m.distance for m in matches_akaze]
-    values = sum(dist) / len(dist)
-    return values
-########################################################################################################################
-
-def compare(a, b, results_dict):
-    print(f"Comparing {a} vs {b}")
-
-    # Dictionary mapping comparison types to their functions and descriptor files
-    comparison_map = {
-        'surf_compare': {
-            'func': pairwise_surf,
-            'suffix': 'surf',
-            'dtype': 'float32',
-            'norm': cv.NORM_L2
-        },
-        'sift_compare': {
-            'func': pairwise_sift,
-            'suffix': 'sift',
-            'dtype': 'float32',
-            'norm': cv.NORM_L2
-        },
-        'orb_compare': {
-            'func': pairwise_orb,
-            'suffix': 'orb',
-            'dtype': 'uint8',
-            'norm': cv.NORM_HAMMING
-        },
-        'akaze_compare': {
-            'func': pairwise_akaze,
-            'suffix': 'akaze',
-            'dtype': 'uint8',
-            'norm': cv.NORM_HAMMING
-        }
-    }
-
-    results = {}
-
-    # Process only the selected comparison types
-    for comp_type in comparison_types:
-        try:
-            comp_info = comparison_map[comp_type]
-
-            des1_path = BASE_DIR / directory / a / f"{a}_{comp_info['suffix']}_mask.txt"
-            des2_path = BASE_DIR / directory / b / f"{b}_{comp_info['suffix']}_mask.txt"
-            des1 = np.loadtxt(str(des1_path)).astype(comp_info['dtype'])
-            des2 = np.loadtxt(str(des2_path)).astype(comp_info['dtype'])
-
-            value = comp_info['func'](des1, des2)
-            results[f"{comp_info['suffix']}_values"] = value
-
-        except Exception as e:
-            results[f"{comp_info['suffix']}_values"] = "NA"
-            error_log_file = BASE_DIR / "logs" / "crossm-atching_error_logs.txt"
-            with open(error_log_file, 'a') as f:
-                f.write(f'\nAn error occurred while comparing {a} vs {b} with {comp_info["suffix"]}: {str(e)} \n')
-
-    results_dict[(a, b)] = results
-
-def compare_wrapper(chunk, results_dict):
-    for row in chunk.itertuples(index=False):
-        compare(row.focal_image, row.test_image, results_dict)
-
-
-def filter_lowest_n(df, n):
-    # Identify columns ending with '_values'
-    value_columns = [col for col in df.columns if col.endswith('_values')]
-
-    # Convert value columns to numeric in place
-    df[value_columns] = df[value_columns].apply(pd.to_numeric, errors='coerce')
-
-    # List to hold results for each column
-    result_list = []
-
-    for col in value_columns:
-        # Get the smallest n values for each focal_name group
-        sliced = (df.groupby('focal_name', as_index=False)
-                  .apply(lambda group: group.nsmallest(n, col))
-                  .reset_index(drop=True))
-        result_list.append(sliced)
-
-    # Combine results and ensure uniqueness on specific columns
-    result = pd.concat(result_list).drop_duplicates(subset=['focal_image', 'test_image'])
-
-    return result
-
 if __name__ == '__main__':
     # Read in the dataframe, ensuring sex columns are read as strings
     pairwise_list_file = BASE_DIR / "data" / df_path
     df = pd.read_csv(str(pairwise_list_file), dtype={'focal_sex': str, 'test_sex': str})
     print(df.head())
 
+    # Coarse-to-fine: cheap signature similarity decides which candidates are worth full descriptor matching
+    n_prefiltered = 0
+    if prefilter_k:
+        signature_store = SignatureStore(signature_dir(BASE_DIR), prefilter_algorithm,
+                                         detector_parameter_hash(params, prefilter_algorithm))
+        n_listed = len(df)
+        df = prefilter_pairwise_list(df, signature_store, BASE_DIR / directory, prefilter_k, pack_dir)
+        n_prefiltered = n_listed - len(df)
+        print(f"Signature prefilter kept the {prefilter_k} most similar candidates per focal image, "
+              f"skipping {n_prefiltered} of {n_listed} rows")
+
     # Get the number of rows
     N = len(df)
 
@@ -155,61 +117,229 @@ if __name__ == '__main__':
         f.write(f'\n{datetime.datetime.now()} - Performing pairwise comparisons for: {", ".join(comparison_types)} \n')
 
     start_time = datetime.datetime.now()
-
-    # Define the chunk size - subsets of data to work on to avoid RAM issues
+    run_clock = stage_clock()
+    # settings that affect the results or speed of the run, for the metrics history
+    parameters = {'comparison_types': comparison_types, 'detector_parameters': params_hashes,
+                  'number_comparisons_considered': filtered_n,
+                  'options': {key: value for key, value in options.items() if key not in ("shard_index", "resume")}}
+    # live progress for the Batch Processing page (shards running side by side each report their own)
+    shard_label = f" (shard {shard_index} of {shard_count})" if sharded else ""
+    progress = ProgressReporter(BASE_DIR, f"crossmatching_{shard_index}of{shard_count}" if sharded else "crossmatching",
+                                f"Pairwise comparisons{shard_label}")
+    progress.start_stage("Preparing pairs")
+
+    # Score each unique (focal, test) pair once - rows repeated in the pairwise list share their pair's scores
+    row_pair_ids = df.groupby(['focal_image', 'test_image'], sort=False).ngroup().to_numpy()
+    ordered_pairs = df.loc[~df.duplicated(['focal_image', 'test_image']), ['focal_image', 'test_image']]
+    # Scores are symmetric, so (a, b) and (b, a) - e.g. from overlapping focal and test lists - are only scored once
+    pairs, canonical_ids = symmetric_pairs(ordered_pairs)
+    row_pair_ids = canonical_ids[row_pair_ids]
+    n_pairs = len(pairs)
+    columns = comparison_columns(comparison_types)
+
+    # focal names compared exhaustively to measure the cascade's recall, drawn from the whole list so that every
+    # shard checks the focal names a single run would
+    sampled_names = sample_focal_names(df['focal_name'], cascade_recall_fraction if cascade else 0)
+    total_rows = len(df)
+    if sharded:
+        # keep this shard's rows only. Pair ids stay those of the whole list, so pairs keep their orientation
+        in_shard = shard_rows(df['focal_name'], shard_index, shard_count)
+        df = df[in_shard]
+        row_pair_ids = row_pair_ids[in_shard]
+        ordered_pairs = df.loc[~df.duplicated(['focal_image', 'test_image']), ['focal_image', 'test_image']]
+        pairs = pairs.loc[np.unique(row_pair_ids)]
+        print(f"Shard {shard_index} of {shard_count}: comparing {len(df)} of {total_rows} rows")
+    n_symmetric = (len(ordered_pairs) - len(pairs)) * len(columns)
+    print(f"{len(ordered_pairs) - len(pairs)} reversed pairs share the scores of their mirror pair, "
+          f"saving {n_symmetric} comparisons")
+
+    # rows written and filtered at a time when exporting the results. Worker tasks are sized separately, from the
+    # number of pairs, workers and the measured cost of a pair (see comparison_engine.adaptive_task_size)
     chunk_size = 100000
 
-    # Split the dataframe into chunks
-    chunks = [df[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
-
-    # Set up the multiprocessing pool
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-        manager = multiprocessing.Manager()
-        results_dict = manager.dict()
-
-        # Map the compare_wrapper function to each chunk of the dataframe
-        results = [pool.apply_async(compare_wrapper, args=(chunk, results_dict)) for chunk in chunks]
-
-        # Wait for all processes to finish
-        for result in results:
-            result.get()
+    # Completed batches are streamed to disk as they arrive, so an interrupted run keeps everything finished so far
+    # (shards running side by side each keep their own stream)
+    stream_name = f"{Path(df_path).stem}_{shard_index}of{shard_count}" if sharded else df_path
+    stream_file = result_stream_path(BASE_DIR, stream_name)
+    scores = {column: np.full(n_pairs, np.nan) for column in columns}
+    done = {column: np.zeros(n_pairs, dtype=bool) for column in columns}
+    task_cache_stats = []
+
+    if resume:
+        # reuse everything already computed for this pairwise list, and for another one with --resume=other_list.csv.
+        # this list's own stream is extended rather than restarted, so reusing another list never loses finished work
+        resume_file = stream_file if resume is True else result_stream_path(BASE_DIR, resume)
+        if resume_file != stream_file and resume_file.exists():
+            done = load_result_stream(resume_file, pairs, scores)
+        reused = done
+        if stream_file.exists():
+            # loaded last, so this list's own results take precedence
+            own_done = load_result_stream(stream_file, pairs, scores)
+            reused = {column: done[column] & ~own_done[column] for column in columns}
+            done = {column: done[column] | own_done[column] for column in columns}
+        else:
+            start_result_stream(stream_file)
+        # copy results reused from the other list over, so this list's stream is complete on its own
+        append_reused_results(stream_file, pairs, scores, {column: np.flatnonzero(reused[column]) for column in columns})
+    else:
+        start_result_stream(stream_file)
+    n_resumed = sum(int(done[column].sum()) for column in columns)
+
+    # scores computed by earlier runs of either comparison script, for the same images and detector settings
+    n_stored = 0
+    if use_score_store:
+        store = ScoreStore(score_store_path(BASE_DIR))
+        stored_ids = load_stored_scores(store, pairs, scores, done, params_hashes, BASE_DIR / directory)
+        append_reused_results(stream_file, pairs, scores, stored_ids)
+        n_stored = sum(len(ids) for ids in stored_ids.values())
+    print(f"{n_resumed} results resumed, {n_stored} reused from the score store, "
+          f"{len(pairs) * len(columns) - n_resumed - n_stored} still to compute")
+
+    # Set up the multiprocessing pool. Each worker returns compact batches of pair ids and score arrays, which are
+    # assembled here as they complete rather than written pair-by-pair through a shared manager dictionary
+    worker_args = (BASE_DIR / directory, comparison_types, log_file, int(cache_mb * 1024 ** 2), pack_dir, matcher)
+    pool_start = datetime.datetime.now()
+    with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=worker_args) as pool:
+        def save_batch(batch):
+            # save every batch as it arrives
+            append_result_batch(stream_file, pairs, batch)
+            if use_score_store:
+                save_result_batch(store, pairs, batch, params_hashes)
+            record_result_batch(scores, batch)
+
+        computed = {'results': 0, 'failed': 0}
+
+        def compute(stage, metrics_stage, done, comparison_types, handle_batch=save_batch, type="mask"):
+            # Missing results are grouped into per-focal-image bundles, so each worker loads a focal image's
+            # descriptors once, and tasks are handed out one at a time as workers become free
+            progress.start_stage(stage, count_missing_results(pairs, done, comparison_types))
+            clock = stage_clock()
+            counts = {'results': 0, 'failed': 0}
+
+            def handle_and_report(batch):
+                handle_batch(batch)
+                results, failed = batch_counts(batch)
+                counts['results'] += results
+                counts['failed'] += failed
+                progress.advance(results, failed)
+
+            task_stats = run_missing_results(pool, n_workers, pairs, done, comparison_types, handle_and_report, type)
+            task_cache_stats.extend(task_stats)
+            record_stage(BASE_DIR, metrics_stage, clock, counts['results'], n_workers, counts['failed'], parameters,
+                         worker_cpu_seconds=sum(stats['cpu_seconds'] for stats in task_stats),
+                         comparison_types=comparison_types, descriptor_type=type)
+            for key in computed:
+                computed[key] += counts[key]
+
+        # results left out of full matching: those already done, and those ruled out by the cascades below
+        skip = {column: done[column].copy() for column in columns}
+        keep = shortlist_size(filtered_n, cascade_margin)
+
+        n_rank_skipped = 0
+        if rank_by:
+            # the ranking algorithm scores every pair first, the other algorithms only each focal name's best candidates
+            rank_column = comparison_columns([rank_by])[0]
+            compute(f"Ranking candidates with {rank_by}", "crossmatching_ranking", done, [rank_by])
+            rank_shortlist = per_focal_shortlist(df['focal_name'], row_pair_ids, scores[rank_column], keep)
+            skip[rank_column][:] = True
+            for column in columns:
+                ruled_out = ~rank_shortlist & ~skip[column]
+                skip[column] |= ruled_out
+                n_rank_skipped += int(ruled_out.sum())
+            print(f"Ranking by {rank_by}: other algorithms compare {keep} candidates per focal name, "
+                  f"skipping {n_rank_skipped} comparisons")
+
+        n_cascade_skipped = 0
+        shortlists = {}
+        if cascade:
+            # stage one: score the remaining results on the strongest keypoints only
+            coarse = {column: np.full(n_pairs, np.nan) for column in columns}
+            compute("Cascade stage one (strongest keypoints)", "crossmatching_cascade", skip, comparison_types,
+                    lambda batch: record_result_batch(coarse, batch), CASCADE_TYPE)
+
+            # only shortlisted pairs, and every pair of the focal names sampled for recall, go on to full matching
+            sampled_rows = df['focal_name'].isin(sampled_names).to_numpy()
+            for column in columns:
+                if skip[column].all():
+                    continue
+                shortlists[column] = per_focal_shortlist(df['focal_name'], row_pair_ids, coarse[column], keep)
+                skipped = ~shortlists[column] & ~skip[column]
+                skipped[row_pair_ids[sampled_rows]] = False
+                skip[column] |= skipped
+                n_cascade_skipped += int(skipped.sum())
+            print(f"Cascade kept {keep} candidates per focal name, skipping {n_cascade_skipped} full comparisons")
+
+        compute("Comparing fingerprints", "crossmatching_comparisons", skip, comparison_types)
 
     pool.close()
     pool.join()
-
-
-    # Create a new dataframe with the results
-    results_list = []
-    for (focal, test), values in results_dict.items():
-        row = {
-            'focal_image': focal,
-            'test_image': test,
-            **values  # Unpack all values
-        }
-        results_list.append(row)
-
-    results_df = pd.DataFrame(results_list)
-
-    # Merge results back to the original dataframe
-    final_df = pd.merge(df, results_df, on=['focal_image', 'test_image'], how='left')
-    final_df['flag'] = ''
-
-    # Export the new dataframe as a CSV
-    output_file = BASE_DIR / 'data' / f'comparison_results_{date.today()}.csv'
-    final_df.to_csv(output_file, index=False) # R may load sex columns poorly
-
-
-    # Group by 'focal_name' and apply the filtering function
-    filtered_df = filter_lowest_n(final_df, filtered_n)
-
-    # Export the filtered DataFrame to a CSV
-    filtered_output_file = BASE_DIR / 'data' / f'filtered_comparison_results_{date.today()}.csv'
-    filtered_df.to_csv(filtered_output_file, index=False)
-
+    utilisation = summarise_worker_utilisation(task_cache_stats, n_workers,
+                                               (datetime.datetime.now() - pool_start).total_seconds())
+    print(f"Worker utilisation: {utilisation['utilisation']:.1%} of {n_workers} workers' time busy over "
+          f"{utilisation['tasks']} tasks ({utilisation['cpu_share']:.1%} of busy time on the CPU)")
+    if use_score_store:
+        store.close()
+
+    cascade_summary = ''
+    if cascade:
+        # how many of the sampled focal names' true top candidates the cascade shortlists kept
+        recall = {column: cascade_recall(df['focal_name'], row_pair_ids, scores[column], shortlist, filtered_n,
+                                         sampled_rows) for column, shortlist in shortlists.items()}
+        cascade_summary = ", ".join(f"{column.removesuffix('_values')} {value:.1%}" for column, value in recall.items())
+        print(f"Cascade recall of the {filtered_n} best candidates per focal name "
+              f"({len(sampled_names)} focal names checked): {cascade_summary}")
+
+    cache_summary = summarise_cache_stats(task_cache_stats)
+    print(f"Descriptor cache: {cache_summary['hits']} hits, {cache_summary['misses']} misses "
+          f"({cache_summary['hit_rate']:.1%} hit rate), {cache_summary['evictions']} evictions")
+
+    progress.start_stage("Writing results")
+    if sharded:
+        # a partial results file, describing the run so the merge can check that all shards belong together
+        shard_file = shard_path(BASE_DIR, df_path, shard_index, shard_count)
+        # only the settings that change the scores, so shards run with different --workers or --matcher still merge
+        run_options = {'prefilter_k': prefilter_k, 'prefilter_algorithm': prefilter_algorithm if prefilter_k else None,
+                       'cascade': cascade, 'rank_by': rank_by,
+                       'cascade_margin': cascade_margin if cascade or rank_by else None,
+                       'cascade_recall': cascade_recall_fraction if cascade else None}
+        description = {'pairwise_list': df_path, 'shard_index': shard_index, 'shard_count': shard_count,
+                       'rows': len(df), 'total_rows': total_rows, 'comparison_types': comparison_types,
+                       'columns': columns, 'options': run_options, 'number_comparisons_considered': filtered_n,
+                       'detector_parameters': params_hashes, 'date': str(date.today())}
+        write_shard_results(shard_file, description, df, row_pair_ids, scores, columns, chunk_size)
+        print(f"Shard results written to {shard_file}. Merge all {shard_count} shards with "
+              f"merge_crossmatching_shards.py")
+    else:
+        # Export the results alongside the original dataframe, in chunks. R may load sex columns poorly
+        output_file = BASE_DIR / 'data' / f'comparison_results_{date.today()}.csv'
+        write_comparison_results(output_file, df, row_pair_ids, scores, columns, chunk_size)
+
+        # Keep the N best matches per focal name for each algorithm, reading the results back chunk by chunk
+        filtered_df = filter_lowest_n_streaming(output_file, filtered_n, chunk_size)
+
+        # Export the filtered DataFrame to a CSV
+        filtered_output_file = BASE_DIR / 'data' / f'filtered_comparison_results_{date.today()}.csv'
+        filtered_df.to_csv(filtered_output_file, index=False)
+
+    progress.finish()
     processing_time = datetime.datetime.now() - start_time
     print("Time taken: ", processing_time)
 
     timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
     with open(timing_log_file, 'a') as f:
         f.write(
-            f'\n Pairwise comparisons - {len(df)} matches processed for {", ".join(comparison_types)} in {processing_time} minutes. {date.today()} \n')
+            f'\n Pairwise comparisons{shard_label} - {len(df)} matches processed for {", ".join(comparison_types)} in {processing_time} minutes. '
+            f'{n_prefiltered} rows skipped by the signature prefilter, {n_symmetric} comparisons saved by symmetry, '
+            f'{n_resumed} results resumed and {n_stored} reused from the score store. '
+            f'{n_rank_skipped} comparisons skipped by ranking with {rank_by}, '
+            f'{n_cascade_skipped} full comparisons skipped by the cascade (recall: {cascade_summary or "not used"}). '
+            f'Descriptor cache: {cache_summary["hits"]} hits, {cache_summary["misses"]} misses. '
+            f'{n_workers} workers, {utilisation["utilisation"]:.1%} utilisation over {utilisation["tasks"]} tasks. '
+            f'{date.today()} \n')
+
+    # the whole run, including preparing the pairs and writing the results
+    record_stage(BASE_DIR, "crossmatching", run_clock, computed['results'], n_workers, computed['failed'], parameters,
+                 rows=len(df), pairs=len(pairs), prefiltered_rows=n_prefiltered, symmetric_savings=n_symmetric,
+                 resumed=n_resumed, stored=n_stored, rank_skipped=n_rank_skipped, cascade_skipped=n_cascade_skipped,
+                 cascade_recall=cascade_summary or None, utilisation=utilisation['utilisation'],
+                 cache_hit_rate=cache_summary['hit_rate'])
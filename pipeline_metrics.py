@@ -0,0 +1,129 @@
+import datetime
+import hashlib
+import json
+import os
+import platform
+import sys
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import psutil
+try:
+    import resource  # peak memory of finished worker processes, not available on Windows
+except ImportError:
+    resource = None
+
+
+########################################################################################################################
+# Machine-readable performance history. Alongside their sentence in processing_times.txt, the batch scripts append one
+# JSON record per stage to BASE_DIR/logs/metrics.jsonl: items processed, wall and CPU time, peak memory, workers,
+# throughput and errors, with a hash of the settings used and a description of the machine and code. load_metrics
+# turns the history into a DataFrame, e.g. to compare throughput across releases and hardware.
+
+def metrics_path(BASE_DIR):
+    return Path(BASE_DIR) / "logs" / "metrics.jsonl"
+
+def parameters_hash(parameters):
+    """Short hash of a dictionary of settings, so runs with the same settings can be grouped."""
+    encoded = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()[:16]
+
+def cpu_seconds():
+    """CPU time of this process plus its finished child processes (e.g. pool workers, once the pool is joined)."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def peak_rss_mb():
+    """Peak resident memory (MB) of this process and of its largest finished child process, so far."""
+    if resource is None:
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2, None
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    unit = 1 if platform.system() == "Darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 ** 2
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1024 ** 2
+    return own, children
+
+def code_version():
+    """Git commit of the pipeline code, or None when it is not run from a git checkout."""
+    git_dir = Path(__file__).resolve().parent / ".git"
+    try:
+        head = (git_dir / "HEAD").read_text().strip()
+        if head.startswith("ref: "):
+            ref_file = git_dir / head[5:]
+            if ref_file.exists():
+                return ref_file.read_text().strip()[:12]
+            for line in (git_dir / "packed-refs").read_text().splitlines():
+                if line.endswith(" " + head[5:]):
+                    return line[:12]
+            return None
+        return head[:12]
+    except OSError:
+        return None
+
+def stage_clock():
+    """Wall-clock and CPU time at the start of a stage, to pass to record_stage."""
+    return {'wall': time.perf_counter(), 'cpu': cpu_seconds(), 'started': datetime.datetime.now()}
+
+def record_stage(BASE_DIR, stage, clock, items, workers=1, errors=0, parameters=None, worker_cpu_seconds=0,
+                 **details):
+    """
+    Append one metrics record for a finished stage. items is the count the throughput is measured in (images,
+    comparisons, ...); parameters are the settings that affect the stage's results or speed, stored with their hash.
+    CPU time of pool workers only counts once the pool has been joined, so stages that end while the pool is still
+    running pass the workers' CPU time (as reported with their tasks) as worker_cpu_seconds. Any further details
+    (e.g. rows=...) are stored as they are. Returns the record.
+    """
+    wall_seconds = time.perf_counter() - clock['wall']
+    own_rss, children_rss = peak_rss_mb()
+    parameters = parameters or {}
+    record = {
+        'stage': stage,
+        'started': clock['started'].isoformat(timespec='seconds'),
+        'parameters_hash': parameters_hash(parameters),
+        'items': int(items),
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds() - clock['cpu'] + worker_cpu_seconds,
+        'peak_rss_mb': own_rss,
+        'peak_worker_rss_mb': children_rss,
+        'workers': int(workers),
+        'items_per_second': items / wall_seconds if wall_seconds > 0 else None,
+        'errors': int(errors),
+        'host': platform.node(),
+        'cpu_count': os.cpu_count(),
+        'processor': platform.processor() or platform.machine(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'opencv': sys.modules['cv2'].__version__ if 'cv2' in sys.modules else None,
+        'numpy': np.__version__,
+        'code_version': code_version(),
+        'parameters': parameters,
+        **details
+    }
+    path = metrics_path(BASE_DIR)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + "\n")
+    return record
+
+def load_metrics(BASE_DIR):
+    """
+    The project's metrics history as a DataFrame, one row per stage run, oldest first. Settings are expanded into
+    parameters.<name> columns. Lines that cannot be read (e.g. cut short by a crash) are skipped.
+    """
+    path = metrics_path(BASE_DIR)
+    records = []
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    if not records:
+        return pd.DataFrame(columns=['stage', 'started', 'parameters_hash', 'items', 'wall_seconds', 'cpu_seconds',
+                                     'peak_rss_mb', 'workers', 'items_per_second', 'errors'])
+    metrics = pd.json_normalize(records, max_level=1)
+    metrics['started'] = pd.to_datetime(metrics['started'])
+    return metrics.sort_values('started', kind='stable').reset_index(drop=True)
+########################################################################################################################
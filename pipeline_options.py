@@ -0,0 +1,18 @@
+########################################################################################################################
+# The batch scripts take their main inputs (project folder, detectors, comparison types) as plain positional arguments.
+# Optional engine settings are passed alongside them as --name=value, e.g. --cache-mb=512 or --pack.
+def split_arguments(arguments):
+    """
+    Split trailing command-line arguments into plain values and a dictionary of --name=value options. Option names
+    use underscores in the dictionary (--cache-mb becomes cache_mb) and options given without a value are set to True.
+    """
+    values = []
+    options = {}
+    for arg in arguments:
+        if arg.startswith("--"):
+            key, has_value, value = arg[2:].partition("=")
+            options[key.replace("-", "_")] = value if has_value else True
+        else:
+            values.append(arg)
+    return values, options
+########################################################################################################################
@@ -3,6 +3,7 @@ import multiprocessing
 from pathlib import Path
 import subprocess
 import sys
+from progress_status import read_progress, format_duration
 
 def check_surf_available():
     """Check if SURF feature detector is available"""
@@ -38,6 +39,10 @@ def process_starting_page_ui():
 
     return ui.nav_panel(
         "Batch Processing",
+        ui.card(
+            ui.h3("Progress"),
+            ui.output_ui("batch_progress")
+        ),
         ui.card(
             ui.h3("Crop and rotate"),
             ui.div(
@@ -239,6 +244,49 @@ def process_starting_page_server(input, output, session, BASE_DIR):
         ui.update_action_button("start_pairwise_comparisons_process", disabled=False)
         ui.update_action_button("start_self_comparisons_process", disabled=False)
 
+    @render.ui
+    def batch_progress():
+        """Live status of each batch process, read from the small status files they keep (see progress_status.py)"""
+        # polling a handful of tiny files every few seconds costs next to nothing
+        reactive.invalidate_later(3)
+        statuses = read_progress(BASE_DIR)
+        if not statuses:
+            return ui.p("No batch processes have been run yet.")
+
+        rows = []
+        for status in statuses:
+            if status['total']:
+                percent = 100 * status['done'] / status['total']
+                done = f"{status['done']} / {status['total']} ({percent:.0f}%)"
+                bar = ui.tags.div(
+                    ui.tags.div(class_="progress-bar", style=f"width: {percent:.1f}%;"),
+                    class_="progress", style="min-width: 120px;"
+                )
+            else:
+                done = str(status['done']) if status['done'] else ""
+                bar = ""
+            running = status['state'] == 'running'
+            rows.append(ui.tags.tr(
+                ui.tags.td(status['label']),
+                ui.tags.td(status['state'].capitalize()),
+                ui.tags.td(status['stage']),
+                ui.tags.td(bar),
+                ui.tags.td(done),
+                ui.tags.td(f"{status['rate']:.1f}/s" if running and status['rate'] else ""),
+                ui.tags.td(format_duration(status['eta_seconds']) if running else ""),
+                ui.tags.td(str(status['errors'])),
+                ui.tags.td(status['updated'].replace("T", " "))
+            ))
+
+        return ui.tags.table(
+            ui.tags.thead(
+                ui.tags.tr(*[ui.tags.th(heading, style="font-weight: bold;") for heading in
+                             ["Process", "State", "Stage", "", "Done", "Speed", "Time left", "Errors", "Last update"]])
+            ),
+            ui.tags.tbody(*rows),
+            class_="table table-sm"
+        )
+
     @reactive.Effect
     @reactive.event(input.start_batch_crop_rotate_process)
     def _():
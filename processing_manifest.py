@@ -0,0 +1,76 @@
+import csv
+import datetime
+import hashlib
+from pathlib import Path
+
+
+########################################################################################################################
+# A record of which photos the crop stage has already processed, so reruns only decode new or changed photos. Each
+# processed photo gets a row in BASE_DIR/data/processing_manifest.csv with its path within the project, size,
+# modification time, optionally a hash of its contents, and a hash of the settings it was cropped with. Rows are
+# appended as photos finish, so an interrupted run keeps what it did; the latest row for a photo wins.
+MANIFEST_COLUMNS = ['source', 'size', 'mtime_ns', 'sha1', 'parameters_hash', 'name', 'processed', 'recorded']
+
+def manifest_path(BASE_DIR):
+    return Path(BASE_DIR) / "data" / "processing_manifest.csv"
+
+def load_manifest(BASE_DIR):
+    """The latest manifest row of each source photo, as a dictionary keyed by source"""
+    path = manifest_path(BASE_DIR)
+    if not path.exists():
+        return {}
+    with open(path, newline='') as f:
+        return {row['source']: row for row in csv.DictReader(f)}
+
+def content_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def file_signature(BASE_DIR, source):
+    """
+    Size and modification time of a photo, given by its path within the project. Its content hash is left empty, as
+    reading the whole photo is only worth it when needed (see add_content_hash)
+    """
+    stat = (Path(BASE_DIR) / source).stat()
+    return {'source': source, 'size': str(stat.st_size), 'mtime_ns': str(stat.st_mtime_ns), 'sha1': ''}
+
+def add_content_hash(BASE_DIR, signature):
+    """Fill in a signature's content hash, unless it already has one. Returns the signature"""
+    if not signature['sha1']:
+        signature['sha1'] = content_hash(Path(BASE_DIR) / signature['source'])
+    return signature
+
+def is_unchanged(BASE_DIR, entry, signature, parameters_hash):
+    """
+    Whether a photo with this manifest entry can be skipped: cropped with the same settings, and the same size and
+    modification time. With a stored content hash, a photo whose modification time changed (e.g. it was copied) but
+    whose contents did not is also unchanged; only then is the photo hashed, and the hash kept in signature. Entries
+    adopted from older projects have no settings hash and match any.
+    """
+    if entry['parameters_hash'] not in ('', parameters_hash) or entry['size'] != signature['size']:
+        return False
+    if entry['mtime_ns'] == signature['mtime_ns']:
+        return True
+    return entry['sha1'] != '' and entry['sha1'] == add_content_hash(BASE_DIR, signature)['sha1']
+
+class ManifestWriter:
+    """Appends manifest rows as photos finish, writing the header if the manifest is new"""
+    def __init__(self, BASE_DIR):
+        path = manifest_path(BASE_DIR)
+        new = not path.exists()
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.DictWriter(self.file, MANIFEST_COLUMNS, lineterminator='\n')
+        if new:
+            self.writer.writeheader()
+
+    def record(self, signature, parameters_hash, name, processed):
+        self.writer.writerow({**signature, 'parameters_hash': parameters_hash, 'name': name,
+                              'processed': processed, 'recorded': datetime.datetime.now().isoformat(timespec='seconds')})
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+########################################################################################################################
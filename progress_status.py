@@ -0,0 +1,99 @@
+import datetime
+import json
+import os
+import time
+from pathlib import Path
+import psutil
+
+
+########################################################################################################################
+# Live progress of the batch scripts. Each running script keeps a small JSON status file in BASE_DIR/logs/progress
+# (items done out of the total for its current stage, items per second, time remaining and errors so far), which the
+# Batch Processing page polls. Files are replaced atomically and at most once every UPDATE_SECONDS, so reading them is
+# always safe and writing them costs next to nothing.
+UPDATE_SECONDS = 1
+
+def progress_dir(BASE_DIR):
+    return Path(BASE_DIR) / "logs" / "progress"
+
+class ProgressReporter:
+    """
+    Status file of one batch script run, e.g. ProgressReporter(BASE_DIR, "crossmatching", "Pairwise comparisons").
+    Each new run of a job replaces the previous run's status.
+    """
+    def __init__(self, BASE_DIR, job, label):
+        self.path = progress_dir(BASE_DIR) / f"{job}.json"
+        self.status = {
+            'job': job,
+            'label': label,
+            'pid': os.getpid(),
+            'state': 'running',
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'stage': '',
+            'done': 0,
+            'total': 0,
+            'errors': 0,
+            'rate': 0.0,
+            'eta_seconds': None
+        }
+        self.stage_start = time.monotonic()
+        self.last_write = 0.0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.write()
+
+    def start_stage(self, stage, total=0):
+        """Begin a new stage of total items (0 if unknown). Errors keep counting across stages."""
+        self.status.update({'stage': stage, 'done': 0, 'total': int(total), 'rate': 0.0, 'eta_seconds': None})
+        self.stage_start = time.monotonic()
+        self.write()
+
+    def advance(self, items=1, errors=0):
+        """Record items finished (errors among them are counted separately), writing the file if it is due."""
+        self.status['done'] += int(items)
+        self.status['errors'] += int(errors)
+        elapsed = time.monotonic() - self.stage_start
+        if elapsed > 0:
+            self.status['rate'] = self.status['done'] / elapsed
+        if self.status['rate'] > 0 and self.status['total']:
+            self.status['eta_seconds'] = max(self.status['total'] - self.status['done'], 0) / self.status['rate']
+        if time.monotonic() - self.last_write >= UPDATE_SECONDS:
+            self.write()
+
+    def finish(self, state='finished'):
+        """Mark the run as finished (or e.g. 'failed')."""
+        self.status.update({'state': state, 'eta_seconds': None})
+        if state == 'finished':
+            self.status['stage'] = 'Done'
+        self.write()
+
+    def write(self):
+        self.status['updated'] = datetime.datetime.now().isoformat(timespec='seconds')
+        temp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temp_path, 'w') as f:
+            json.dump(self.status, f)
+        os.replace(temp_path, self.path)
+        self.last_write = time.monotonic()
+
+def read_progress(BASE_DIR):
+    """
+    Statuses of all jobs that have reported progress, most recently started first. Runs still marked as running whose
+    process has gone (e.g. it was killed) are reported as 'stopped'.
+    """
+    statuses = []
+    for path in progress_dir(BASE_DIR).glob("*.json"):
+        try:
+            with open(path) as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue  # being replaced right now, picked up at the next poll
+        if status['state'] == 'running' and not psutil.pid_exists(status['pid']):
+            status['state'] = 'stopped'
+        statuses.append(status)
+    return sorted(statuses, key=lambda status: status['started'], reverse=True)
+
+def format_duration(seconds):
+    """e.g. 3725 seconds as '1:02:05'"""
+    if seconds is None:
+        return "-"
+    return str(datetime.timedelta(seconds=round(seconds)))
+########################################################################################################################
@@ -0,0 +1,159 @@
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from descriptor_storage import descriptor_path
+
+
+########################################################################################################################
+# A persistent, project-wide store of pairwise scores shared by crossmatching, within-individual QC and reruns with
+# different pairwise lists. Scores are keyed by (unordered image pair, algorithm, detector-parameter hash), so
+# fingerprints extracted with different detector settings are never mixed up. The store also remembers the version
+# (size and modification time) of each image's descriptor file its scores were computed from, and drops an image's
+# scores once its fingerprints are extracted again. Only the parent process uses the store.
+
+# detector settings in user_parameters.csv that change each algorithm's descriptors
+DETECTOR_PARAMETERS = {
+    'surf': ['hessian_threshold'],
+    'sift': ['n_features'],
+    'orb': ['n_features'],
+    'akaze': ['akaze_threshold']
+}
+
+def detector_parameter_hash(params, algorithm):
+    """Short hash of the detector settings used for an algorithm, e.g. for ORB the value of n_features."""
+    settings = ";".join(f"{name}={float(params[name])}" for name in DETECTOR_PARAMETERS[algorithm])
+    return hashlib.sha1(f"{algorithm};{settings}".encode()).hexdigest()[:16]
+
+def unordered_images(images_a, images_b):
+    """Store keys put the two images in sorted order, so (a, b) and (b, a) share one stored score."""
+    images_a = np.asarray(images_a, dtype=object)
+    images_b = np.asarray(images_b, dtype=object)
+    swap = images_a > images_b
+    return np.where(swap, images_b, images_a), np.where(swap, images_a, images_b)
+
+def score_store_path(BASE_DIR):
+    return Path(BASE_DIR) / "data" / "score_store.sqlite"
+
+def descriptor_version(fingerprint_dir, name, algorithm, type="mask"):
+    """Size and modification time of an image's descriptor file, e.g. "51200:1718000000000000000", or "" if none."""
+    for extension in ("npy", "txt"):
+        path = descriptor_path(fingerprint_dir, name, algorithm, type, extension)
+        if path.exists():
+            stat = path.stat()
+            return f"{stat.st_size}:{stat.st_mtime_ns}"
+    return ""
+########################################################################################################################
+
+
+########################################################################################################################
+class ScoreStore:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        # write-ahead logging lets a crossmatching run and a QC run share the store at the same time
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS scores (
+                image_a TEXT NOT NULL,
+                image_b TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (image_a, image_b, algorithm, params_hash)
+            ) WITHOUT ROWID""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS descriptor_versions (
+                image TEXT NOT NULL,
+                algorithm TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                version TEXT NOT NULL,
+                PRIMARY KEY (image, algorithm, params_hash)
+            ) WITHOUT ROWID""")
+        self.connection.execute("CREATE TEMP TABLE wanted (pair_id INTEGER, image_a TEXT, image_b TEXT)")
+        self.connection.execute("CREATE TEMP TABLE changed (image TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+    def lookup(self, pair_ids, images_a, images_b, algorithm, params_hash):
+        """Return (pair ids, values) for the requested pairs that already have a stored score."""
+        images_a, images_b = unordered_images(images_a, images_b)
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM wanted")
+        cursor.executemany("INSERT INTO wanted VALUES (?, ?, ?)", zip(map(int, pair_ids), images_a, images_b))
+        rows = cursor.execute("""
+            SELECT wanted.pair_id, scores.value FROM wanted
+            JOIN scores ON scores.image_a = wanted.image_a AND scores.image_b = wanted.image_b
+            WHERE scores.algorithm = ? AND scores.params_hash = ?""", (algorithm, params_hash)).fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        found = np.array(rows)
+        return found[:, 0].astype(np.int64), found[:, 1].astype(float)
+
+    def refresh_versions(self, images, versions, algorithm, params_hash):
+        """
+        Record the current descriptor file version of each image, dropping the stored scores of images whose version
+        differs from the one their scores were computed from (or is unknown, in stores from before versions were
+        kept). Returns the number of images whose scores were dropped.
+        """
+        stored = dict(self.connection.execute(
+            "SELECT image, version FROM descriptor_versions WHERE algorithm = ? AND params_hash = ?",
+            (algorithm, params_hash)).fetchall())
+        changed = [(image, version) for image, version in zip(images, versions) if stored.get(image) != version]
+        if not changed:
+            return 0
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM changed")
+        cursor.executemany("INSERT OR IGNORE INTO changed VALUES (?)", [(image,) for image, _ in changed])
+        cursor.execute("""
+            DELETE FROM scores WHERE algorithm = ? AND params_hash = ?
+            AND (image_a IN (SELECT image FROM changed) OR image_b IN (SELECT image FROM changed))""",
+                       (algorithm, params_hash))
+        cursor.executemany("INSERT OR REPLACE INTO descriptor_versions VALUES (?, ?, ?, ?)",
+                           [(image, algorithm, params_hash, version) for image, version in changed])
+        self.connection.commit()
+        return len(changed)
+
+    def add(self, images_a, images_b, algorithm, params_hash, values):
+        """Store new scores. Failed comparisons (NaN) are not stored, so they are retried next time."""
+        images_a, images_b = unordered_images(images_a, images_b)
+        rows = [(a, b, algorithm, params_hash, float(value))
+                for a, b, value in zip(images_a, images_b, values) if not np.isnan(value)]
+        self.connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+########################################################################################################################
+
+
+########################################################################################################################
+# helpers for the comparison scripts, which keep scores as {value column: float array indexed by pair id}
+def load_stored_scores(store, pairs, scores, done, params_hashes, fingerprint_dir):
+    """
+    Fill in scores for pairs that are not done yet from the store and mark them as done. pairs is a frame of unique
+    focal_image/test_image pairs indexed by pair id and params_hashes maps value column -> detector-parameter hash.
+    Stored scores of images whose descriptor files in fingerprint_dir changed since are dropped first.
+    Returns a dictionary of value column -> pair ids filled from the store.
+    """
+    filled = {}
+    images = pd.unique(pairs[['focal_image', 'test_image']].to_numpy().ravel())
+    for column, params_hash in params_hashes.items():
+        algorithm = column.removesuffix('_values')
+        versions = [descriptor_version(fingerprint_dir, image, algorithm) for image in images]
+        store.refresh_versions(images, versions, algorithm, params_hash)
+        todo = pairs[~done[column][pairs.index.to_numpy()]]
+        ids, values = store.lookup(todo.index.to_numpy(), todo['focal_image'], todo['test_image'],
+                                   algorithm, params_hash)
+        scores[column][ids] = values
+        done[column][ids] = True
+        filled[column] = ids
+    return filled
+
+def save_result_batch(store, pairs, batch, params_hashes):
+    """Write one result batch from comparison_engine.compare_wrapper to the store."""
+    pair_ids, values, _ = batch
+    batch_pairs = pairs.loc[pair_ids]
+    for column, column_values in values.items():
+        store.add(batch_pairs['focal_image'], batch_pairs['test_image'], column.removesuffix('_values'),
+                  params_hashes[column], column_values)
+########################################################################################################################
@@ -0,0 +1,187 @@
+import csv
+import datetime
+import cv2 as cv
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+
+########################################################################################################################
+# Synthetic "beetle" photos for benchmarking and testing the pipeline without field photos. Every individual has a fixed
+# pattern of coloured elytral patches, irregular blobs with darker speckles inside, in colours drawn from the project's
+# HSV thresholds so the crop script segments them as it would real patches. Each encounter (a capture on one date)
+# gets its own name, as in the field, and each photo of it shows the individual at a new position, angle, scale and
+# exposure, with sensor noise. The true identity behind every encounter is written to
+# data/synthetic_ground_truth.csv.
+
+# the parameters project_folder_setup.py writes, with HSV thresholds for orange-yellow patches
+DEFAULT_PARAMETERS = [
+    ("hue_low", 10.0), ("saturation_low", 75.0), ("value_low", 75.0),
+    ("hue_high", 45.0), ("saturation_high", 255.0), ("value_high", 255.0),
+    ("kernel_size", 11.0), ("threshold_value", 50.0), ("num_patches", 4.0), ("min_area", 7500.0), ("mult", 1.1),
+    ("hessian_threshold", 500.0), ("n_features", 1000.0), ("akaze_threshold", 0.001), ("cutoff_size", 10000000.0),
+    ("size_offset", 100.0), ("number_comparisons_considered", 20)
+]
+PROJECT_FOLDERS = ['unprocessed_photos', 'processing_errors/crop_rotate_generic', 'processing_errors/crop_rotate_size',
+                   'processing_errors/fingerprinting', 'fingerprints', 'logs', 'temp', 'data']
+# first day of the synthetic field season, encounter dates are days after it
+SEASON_START = datetime.date(2025, 5, 1)
+
+def load_or_create_parameters(BASE_DIR):
+    """The project's user parameters as a dictionary, writing the defaults first if the project has none."""
+    csv_path = Path(BASE_DIR) / "data" / "user_parameters.csv"
+    if not csv_path.exists():
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["Parameter", "Value"])
+            writer.writerows(DEFAULT_PARAMETERS)
+    df = pd.read_csv(csv_path)
+    return {row["Parameter"]: float(row["Value"]) for _, row in df.iterrows()}
+########################################################################################################################
+
+
+########################################################################################################################
+def random_pattern(rng, params):
+    """
+    One individual's patches in body coordinates (x across, y along the body, both within -1..1): an irregular outline
+    and speckle positions for each patch, plus the patch colour (HSV) and the individual's sex and size.
+    """
+    patches = []
+    n_patches = int(params["num_patches"])
+    for i in range(n_patches):
+        # patches sit in pairs on the two elytra, spread along the body
+        side = -1 if i % 2 == 0 else 1
+        row = (i // 2 + 0.5) / max(1, (n_patches + 1) // 2)
+        centre = np.array([side * rng.uniform(0.3, 0.5), -0.7 + 1.4 * row + rng.uniform(-0.1, 0.1)])
+        # a smooth random outline: radii from a few low-frequency harmonics
+        angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+        radii = np.ones_like(angles)
+        for harmonic in range(2, 5):
+            radii += rng.uniform(0, 0.25 / harmonic * 2) * np.cos(harmonic * angles + rng.uniform(0, 2 * np.pi))
+        size = rng.uniform(0.2, 0.28)
+        outline = centre + size * radii[:, None] * np.column_stack([np.cos(angles), np.sin(angles)])
+        # darker speckles inside the patch, the detail the fingerprints pick up
+        n_speckles = rng.integers(6, 14)
+        speckle_angles = rng.uniform(0, 2 * np.pi, n_speckles)
+        speckle_radii = size * np.sqrt(rng.uniform(0, 0.55, n_speckles))
+        speckles = centre + speckle_radii[:, None] * np.column_stack([np.cos(speckle_angles), np.sin(speckle_angles)])
+        patches.append({'outline': outline, 'speckles': speckles,
+                        'speckle_sizes': rng.uniform(0.015, 0.04, n_speckles)})
+
+    # a colour comfortably inside the HSV thresholds, bright enough to clear the grey-scale threshold
+    hue = rng.uniform(params["hue_low"] + 3, params["hue_high"] - 3)
+    saturation = rng.uniform(max(params["saturation_low"] + 40, 150), params["saturation_high"] - 5)
+    value = rng.uniform(max(params["value_low"] + 40, 170), params["value_high"] - 10)
+    return {'patches': patches, 'hsv': (hue, saturation, value),
+            'sex': rng.choice(['m', 'f']), 'size': round(rng.uniform(8, 14), 1)}
+
+def hsv_to_bgr(hue, saturation, value):
+    pixel = np.uint8([[[np.clip(hue, 0, 179), np.clip(saturation, 0, 255), np.clip(value, 0, 255)]]])
+    return tuple(int(c) for c in cv.cvtColor(pixel, cv.COLOR_HSV2BGR)[0, 0])
+
+def render_photo(pattern, rng, width, height):
+    """
+    A BGR photo of an individual on a blue-grey background, placed at a random position, angle and scale, with random
+    exposure and sensor noise. Colours outside the patches stay outside the HSV thresholds.
+    """
+    background = np.array(hsv_to_bgr(rng.uniform(100, 115), rng.uniform(30, 60), rng.uniform(100, 140)), np.float32)
+    img = np.empty((height, width, 3), np.float32)
+    img[:] = background
+
+    # body frame: body half-length in pixels, rotation and centre
+    half_length = rng.uniform(0.3, 0.36) * min(width, height) * 1.3
+    half_width = half_length * 0.62
+    angle = rng.uniform(0, 2 * np.pi)
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    margin = half_length * 1.05
+    centre = np.array([rng.uniform(margin, max(margin, width - margin)), rng.uniform(margin, max(margin, height - margin))])
+
+    def to_image(points):
+        return (points * [half_width, half_length]) @ rotation.T + centre
+
+    body = np.column_stack([np.cos(np.linspace(0, 2 * np.pi, 96)), np.sin(np.linspace(0, 2 * np.pi, 96))])
+    cv.fillPoly(img, [np.int32(to_image(body * 1.02))], hsv_to_bgr(20, 120, 35), lineType=cv.LINE_AA)
+    # the seam between the elytra
+    cv.line(img, tuple(np.int32(to_image(np.array([0, -1.0])))), tuple(np.int32(to_image(np.array([0, 1.0])))),
+            hsv_to_bgr(20, 100, 20), max(1, int(half_width * 0.03)), cv.LINE_AA)
+
+    hue, saturation, value = pattern['hsv']
+    patch_colour = hsv_to_bgr(hue, saturation, value)
+    speckle_colour = hsv_to_bgr(hue, saturation, value * 0.35)
+    for patch in pattern['patches']:
+        cv.fillPoly(img, [np.int32(to_image(patch['outline']))], patch_colour, lineType=cv.LINE_AA)
+        for position, speckle_size in zip(patch['speckles'], patch['speckle_sizes']):
+            radius = max(1, int(speckle_size * half_width))
+            cv.circle(img, tuple(np.int32(to_image(position))), radius, speckle_colour, -1, cv.LINE_AA)
+
+    # exposure, slight defocus and sensor noise
+    img *= rng.uniform(0.9, 1.1)
+    img = cv.GaussianBlur(img, (0, 0), rng.uniform(0.6, 1.2))
+    img += rng.normal(0, 3, img.shape).astype(np.float32)
+    return np.clip(img, 0, 255).astype(np.uint8)
+########################################################################################################################
+
+
+########################################################################################################################
+def generate_dataset(BASE_DIR, n_individuals, recaptures=1, photos_per_encounter=2, width=1000, height=1500,
+                     season_days=60, seed=0, image_format="jpg"):
+    """
+    Write a synthetic project: photos in unprocessed_photos, focal and test lists of every encounter in data (focal.csv,
+    test.csv, both with the focal, datef, sex and size columns of focal_df_template.csv) and the ground truth in
+    data/synthetic_ground_truth.csv. Each individual is caught 1 + recaptures times (on different days, if the season
+    allows). Returns the ground truth as a DataFrame, one row per photo.
+    """
+    BASE_DIR = Path(BASE_DIR)
+    for folder in PROJECT_FOLDERS:
+        (BASE_DIR / folder).mkdir(parents=True, exist_ok=True)
+    params = load_or_create_parameters(BASE_DIR)
+    rng = np.random.default_rng(seed)
+
+    encounters = []
+    for individual in range(n_individuals):
+        pattern = random_pattern(rng, params)
+        n_encounters = 1 + recaptures
+        days = np.sort(rng.choice(season_days, n_encounters, replace=n_encounters > season_days))
+        for day in days:
+            encounters.append((int(day), individual, pattern))
+
+    rows = []
+    # encounter codes follow capture order, so they say nothing about identity
+    encounters.sort(key=lambda encounter: (encounter[0], rng.random()))
+    for code, (day, individual, pattern) in enumerate(encounters):
+        encounter = f"{(SEASON_START + datetime.timedelta(days=day)).strftime('%m-%d')}_S{code:05d}"
+        # field measurements of size vary a little between captures
+        size = round(pattern['size'] + rng.normal(0, 0.2), 1)
+        for photo in range(1, photos_per_encounter + 1):
+            image = f"{encounter}_{photo}"
+            cv.imwrite(str(BASE_DIR / "unprocessed_photos" / f"{image}.{image_format}"),
+                       render_photo(pattern, rng, width, height))
+            rows.append({'image': image, 'encounter': encounter, 'individual': f"I{individual:05d}", 'datef': day,
+                         'sex': pattern['sex'], 'size': size})
+
+    truth = pd.DataFrame(rows)
+    truth.to_csv(BASE_DIR / "data" / "synthetic_ground_truth.csv", index=False)
+    encounter_list = (truth.drop_duplicates('encounter')
+                      .rename(columns={'encounter': 'focal'})[['focal', 'datef', 'sex', 'size']])
+    encounter_list.to_csv(BASE_DIR / "data" / "focal.csv", index=False)
+    encounter_list.to_csv(BASE_DIR / "data" / "test.csv", index=False)
+    return truth
+
+def true_match_recall(filtered_results, truth):
+    """
+    Share of focal encounters with an earlier encounter of the same individual among their candidates whose filtered
+    results (e.g. filtered_comparison_results) include at least one photo of that individual. NaN if there are none.
+    """
+    individual = truth.drop_duplicates('encounter').set_index('encounter')['individual']
+    results = filtered_results.assign(focal_individual=filtered_results['focal_name'].map(individual),
+                                      test_individual=filtered_results['test_name'].map(individual))
+    found = (results['focal_individual'] == results['test_individual']).groupby(results['focal_name']).any()
+
+    # focal encounters that had a true match available: an earlier encounter of the same individual
+    first_day = truth.groupby('individual')['datef'].min()
+    encounters = truth.drop_duplicates('encounter')
+    recaptured = encounters[encounters['datef'] > encounters['individual'].map(first_day)]['encounter']
+    if not len(recaptured):
+        return np.nan
+    return found.reindex(recaptured, fill_value=False).mean()
+########################################################################################################################
@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+########################################################################################################################
+# A bounded pipeline of thread pools, an alternative to multiprocessing.Pool for the image batch scripts. Most of their
+# time goes to OpenCV calls and file I/O, which release the GIL, so threads can run them in parallel without starting
+# worker processes, re-importing the script in each of them or pickling images between them. Items flow through a
+# list of stages (e.g. read, crop, write), each run by its own threads. The queues between stages hold at most
+# queue_depth items each, so only a bounded number of decoded images is in memory at any time.
+DEFAULT_QUEUE_DEPTH = 2
+
+_DONE = object()  # end of the items, passed down the pipeline once per thread of the next stage
+
+def run_thread_pipeline(items, stages, queue_depth=DEFAULT_QUEUE_DEPTH):
+    """
+    Pass each item through stages, a list of (function, number of threads): each function takes the previous
+    stage's result and returns the next. Yields the last stage's results as they finish, in no particular order.
+    Stages should return failures (e.g. an error for the next stage to report) rather than raise: if a stage raises,
+    the item is dropped, the rest carry on, and the first exception is raised once all have finished.
+    """
+    queues = [queue.Queue(queue_depth) for _ in range(len(stages) + 1)]
+    errors = []
+    threads = []
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        for _ in range(stages[0][1]):
+            queues[0].put(_DONE)
+
+    def work(function, inbox, outbox, stage_threads, next_threads):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            try:
+                outbox.put(function(item))
+            except Exception as e:
+                errors.append(e)
+        # the last thread of a stage to finish tells each thread of the next stage
+        with stage_threads['lock']:
+            stage_threads['running'] -= 1
+            last = stage_threads['running'] == 0
+        if last:
+            for _ in range(next_threads):
+                outbox.put(_DONE)
+
+    threads.append(threading.Thread(target=feed, daemon=True))
+    for i, (function, n_threads) in enumerate(stages):
+        next_threads = stages[i + 1][1] if i + 1 < len(stages) else 1
+        stage_threads = {'running': n_threads, 'lock': threading.Lock()}
+        for _ in range(n_threads):
+            threads.append(threading.Thread(target=work, daemon=True,
+                                            args=(function, queues[i], queues[i + 1], stage_threads, next_threads)))
+    for thread in threads:
+        thread.start()
+
+    while True:
+        result = queues[-1].get()
+        if result is _DONE:
+            break
+        yield result
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def per_thread(factory):
+    """A function returning an object made by factory, one per thread, e.g. for OpenCV detectors"""
+    local = threading.local()
+    def get():
+        if not hasattr(local, 'value'):
+            local.value = factory()
+        return local.value
+    return get
+########################################################################################################################
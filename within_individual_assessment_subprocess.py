@@ -1,4 +1,3 @@
-import cv2 as cv
 import datetime
 import sys
 import os
@@ -7,6 +6,14 @@ import numpy as np
 from pathlib import Path
 import pandas as pd
 import multiprocessing
+from descriptor_storage import summarise_cache_stats
+from comparison_engine import (MATCHERS, init_worker, run_missing_results, summarise_worker_utilisation,
+                               count_missing_results, batch_counts, record_result_batch, format_missing_values,
+                               comparison_columns, comparison_map)
+from score_store import ScoreStore, score_store_path, detector_parameter_hash, load_stored_scores, save_result_batch
+from pipeline_options import split_arguments
+from progress_status import ProgressReporter
+from pipeline_metrics import stage_clock, record_stage
 from itertools import combinations
 
 
@@ -15,9 +22,34 @@ from itertools import combinations
 BASE_DIR = Path(sys.argv[1])
 # Define the target subdirectory (should only be fingerprints)
 directory = BASE_DIR / "fingerprints"
+# Optional consolidated descriptor packs (see descriptor_storage.py). Used whenever the project has built them
+pack_dir = BASE_DIR / "descriptor_packs"
+if not pack_dir.exists():
+    pack_dir = None
 
 # Define the initial list of comparison types
-comparison_types = sys.argv[2:]  # All remaining arguments are types of comparison to run
+# All remaining arguments are types of comparison to run, plus optional --name=value engine settings
+comparison_types, options = split_arguments(sys.argv[2:])
+# memory budget (MB) for each worker's cache of decoded descriptors
+cache_mb = float(options.get("cache_mb", 256))
+# number of worker processes, one per core unless --workers is given
+n_workers = int(options.get("workers", multiprocessing.cpu_count()))
+# --matcher=vectorised scores pairs in blocks with numpy (see matching_kernels.py) instead of one cv.BFMatcher per pair
+matcher = options.get("matcher", "bfmatcher")
+if matcher not in MATCHERS:
+    raise ValueError(f"Unknown matcher {matcher}, expected one of: {', '.join(MATCHERS)}")
+# scores are looked up in, and saved to, the project's persistent score store unless --no-score-store is given
+use_score_store = not options.get("no_score_store", False)
+
+# Load user-set parameters for fingerprint extraction
+df = pd.read_csv(os.path.join(BASE_DIR, "data/user_parameters.csv"))
+# Convert to dictionary (keys = parameters, values = converted numbers)
+params = {row["Parameter"]: float(row["Value"]) for _, row in df.iterrows()}
+# detector settings for each algorithm, so stored scores are only reused for fingerprints extracted the same way
+params_hashes = {}
+for comp_type in comparison_types:
+    suffix = comparison_map[comp_type]['suffix']
+    params_hashes[f"{suffix}_values"] = detector_parameter_hash(params, suffix)
 ########################################################################################################################
 
 
@@ -45,90 +77,6 @@ comparison_types = sys.argv[2:]  # All remaining arguments are types of comparis
 #if check_surf_available():
 #    comparison_types.append('surf_compare')
 
-########################################################################################################################
-def pairwise_surf(x, y):
-    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
-    matches_surf = bf.match(x, y)
-    dist = [m.distance for m in matches_surf]
-    values = sum(dist) / len(dist)
-    return values
-def pairwise_sift(x, y):
-    bf = cv.BFMatcher(cv.NORM_L2, crossCheck=True)
-    matches_sift = bf.match(x, y)
-    dist = [m.distance for m in matches_sift]
-    values = sum(dist) / len(dist)
-    return values
-def pairwise_orb(x, y):
-    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
-    matches_orb = bf.match(x, y)
-    dist = [m.distance for m in matches_orb]
-    values = sum(dist) / len(dist)
-    return values
-def pairwise_akaze(x, y):
-    bf = cv.BFMatcher(cv.NORM_HAMMING, crossCheck=True)
-    matches_akaze = bf.match(x, y)
-    dist = [m.distance for m in matches_akaze]
-    values = sum(dist) / len(dist)
-    return values
-########################################################################################################################
-
-def compare(a, b, results_dict):
-    print(f"Comparing {a} vs {b}")
-
-    # Dictionary mapping comparison types to their functions and descriptor files
-    comparison_map = {
-        'surf_compare': {
-            'func': pairwise_surf,
-            'suffix': 'surf',
-            'dtype': 'float32',
-            'norm': cv.NORM_L2
-        },
-        'sift_compare': {
-            'func': pairwise_sift,
-            'suffix': 'sift',
-            'dtype': 'float32',
-            'norm': cv.NORM_L2
-        },
-        'orb_compare': {
-            'func': pairwise_orb,
-            'suffix': 'orb',
-            'dtype': 'uint8',
-            'norm': cv.NORM_HAMMING
-        },
-        'akaze_compare': {
-            'func': pairwise_akaze,
-            'suffix': 'akaze',
-            'dtype': 'uint8',
-            'norm': cv.NORM_HAMMING
-        }
-    }
-
-    results = {}
-
-    # Process only the selected comparison types
-    for comp_type in comparison_types:
-        try:
-            comp_info = comparison_map[comp_type]
-
-            des1_path = directory / a / f"{a}_{comp_info['suffix']}_mask.txt"
-            des2_path = directory / b / f"{b}_{comp_info['suffix']}_mask.txt"
-            des1 = np.loadtxt(str(des1_path)).astype(comp_info['dtype'])
-            des2 = np.loadtxt(str(des2_path)).astype(comp_info['dtype'])
-
-            value = comp_info['func'](des1, des2)
-            results[f"{comp_info['suffix']}_values"] = value
-
-        except Exception as e:
-            results[f"{comp_info['suffix']}_values"] = "NA"
-            error_log_file = BASE_DIR / "logs" / "crossmatching_error_logs.txt"
-            with open(error_log_file, 'a') as f:
-                f.write(f'\nAn error occurred while comparing {a} vs {b} with {comp_info["suffix"]}: {str(e)} \n')
-
-    results_dict[(a, b)] = results
-
-def compare_wrapper(chunk, results_dict):
-    for row in chunk[['focal_image', 'test_image']].itertuples(index=False):
-        compare(row[0], row[1], results_dict)
 
 def get_list_focal_examples(images_list):
     # Create a DataFrame from the list of filenames
@@ -167,6 +115,10 @@ def store_output(df):
 
 if __name__ == '__main__':
     start_time = datetime.datetime.now()
+    clock = stage_clock()
+    # live progress for the Batch Processing page
+    progress = ProgressReporter(BASE_DIR, "self_comparisons", "Within-individual quality check")
+    progress.start_stage("Listing photo pairs")
 
     images_list = os.listdir(str(directory))  # List and print all files in directory.
     #print(images_list)
@@ -197,48 +149,53 @@ if __name__ == '__main__':
     with open(log_file, 'a') as f:
         f.write('\n{0} - Performing self comparisons \n'.format(datetime.datetime.now()))
 
-
-    # Define the chunk size - subsets of data to work on to avoid RAM issues
-    chunk_size = 100000
-
-    # Split the dataframe into chunks
-    chunks = [df_unique_pairs[i:i + chunk_size] for i in range(0, len(df_unique_pairs), chunk_size)]
-
-    # Set up the multiprocessing pool
-    with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-        manager = multiprocessing.Manager()
-        results_dict = manager.dict()
-
-        # Map the compare_wrapper function to each chunk of the dataframe
-        results = [pool.apply_async(compare_wrapper, args=(chunk, results_dict)) for chunk in chunks]
-
-        # Wait for all processes to finish
-        for result in results:
-            result.get()  # Make sure to handle exceptions here if needed
+    columns = comparison_columns(comparison_types)
+    scores = {column: np.full(N, np.nan) for column in columns}
+    done = {column: np.zeros(N, dtype=bool) for column in columns}
+
+    # scores computed by earlier runs of either comparison script, for the same images and detector settings
+    n_stored = 0
+    if use_score_store:
+        store = ScoreStore(score_store_path(BASE_DIR))
+        stored_ids = load_stored_scores(store, df_unique_pairs, scores, done, params_hashes, directory)
+        n_stored = sum(len(ids) for ids in stored_ids.values())
+    print(f"{n_stored} results reused from the score store, {N * len(columns) - n_stored} still to compute")
+
+    n_to_compute = count_missing_results(df_unique_pairs, done, comparison_types)
+    progress.start_stage("Comparing fingerprints", n_to_compute)
+
+    def save_batch(batch):
+        # collect scores as tasks complete
+        if use_score_store:
+            save_result_batch(store, df_unique_pairs, batch, params_hashes)
+        record_result_batch(scores, batch)
+        progress.advance(*batch_counts(batch))
+
+    # Set up the multiprocessing pool. Each worker returns compact batches of pair ids and score arrays
+    worker_args = (directory, comparison_types, log_file, int(cache_mb * 1024 ** 2), pack_dir, matcher)
+    pool_start = datetime.datetime.now()
+    with multiprocessing.Pool(n_workers, initializer=init_worker, initargs=worker_args) as pool:
+        # Missing results are grouped into per-focal-image bundles, so each worker loads a focal image's descriptors
+        # once, and tasks sized from the measured cost of a pair are handed out as workers become free
+        task_cache_stats = run_missing_results(pool, n_workers, df_unique_pairs, done, comparison_types, save_batch)
 
     pool.close()
     pool.join()
-    # Set up the multiprocessing pool
-    #manager = multiprocessing.Manager()
-    #results_dict = manager.dict()
-    #pool = multiprocessing.Pool(multiprocessing.cpu_count())
-    #print(multiprocessing.cpu_count())
-
-    # Map the compare_wrapper function to each chunk of the dataframe
-    #results = [pool.apply_async(compare_wrapper, args=(chunk, results_dict)) for chunk in chunks]
+    utilisation = summarise_worker_utilisation(task_cache_stats, n_workers,
+                                               (datetime.datetime.now() - pool_start).total_seconds())
+    print(f"Worker utilisation: {utilisation['utilisation']:.1%} of {n_workers} workers' time busy over "
+          f"{utilisation['tasks']} tasks ({utilisation['cpu_share']:.1%} of busy time on the CPU)")
+    if use_score_store:
+        store.close()
 
-    # Wait for all processes to finish
-    #for result in results:
-    #    result.get()
+    cache_summary = summarise_cache_stats(task_cache_stats)
+    print(f"Descriptor cache: {cache_summary['hits']} hits, {cache_summary['misses']} misses "
+          f"({cache_summary['hit_rate']:.1%} hit rate), {cache_summary['evictions']} evictions")
 
     # Create a new dataframe with the results
-    results_list = []
-    for (focal, test), values in results_dict.items():
-        row = {'focal_image': focal, 'test_image': test}
-        row.update(values)
-        results_list.append(row)
-
-    new_df = pd.DataFrame(results_list)
+    new_df = df_unique_pairs.copy()
+    for column in columns:
+        new_df[column] = format_missing_values(scores[column])
 
     # Add new columns to the DataFrame
     #new_df["focal_image_path"] = new_df["focal_image"].apply(lambda x: f"fingerprints/{x}/{x}_img.png")
@@ -246,8 +203,9 @@ if __name__ == '__main__':
     new_df["focal_name"] = new_df["focal_image"].apply(extract_name)
     new_df["test_name"] = new_df["test_image"].apply(extract_name)
 
+    progress.start_stage("Writing results")
     store_output(new_df)
-
+    progress.finish()
 
     processing_time = datetime.datetime.now() - start_time
     # print the time taken to process all images
@@ -255,4 +213,13 @@ if __name__ == '__main__':
 
     timing_log_file = BASE_DIR / "logs" / "processing_times.txt"
     with open(timing_log_file, 'a') as f:
-        f.write(f'\n Self comparisons - {str(len(df_unique_pairs))} comparisons processed in {str(processing_time)} minutes. {date.today()} \n')
\ No newline at end of file
+        f.write(f'\n Self comparisons - {str(len(df_unique_pairs))} comparisons processed in {str(processing_time)} minutes. '
+                f'{n_stored} results reused from the score store. '
+                f'Descriptor cache: {cache_summary["hits"]} hits, {cache_summary["misses"]} misses. '
+                f'{n_workers} workers, {utilisation["utilisation"]:.1%} utilisation over {utilisation["tasks"]} tasks. '
+                f'{date.today()} \n')
+
+    record_stage(BASE_DIR, "self_comparisons", clock, n_to_compute, n_workers, progress.status['errors'],
+                 {'comparison_types': comparison_types, 'detector_parameters': params_hashes, 'options': options},
+                 pairs=N, stored=n_stored, utilisation=utilisation['utilisation'],
+                 cache_hit_rate=cache_summary['hit_rate'])
\ No newline at end of file